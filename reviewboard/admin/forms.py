@@ -33,6 +33,7 @@ import urlparse
 from django import forms
 from django.contrib.sites.models import Site
 from django.core.cache import parse_backend_uri, InvalidCacheBackendError
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.translation import ugettext as _
 from djblets.log import restart_logging
 from djblets.siteconfig.forms import SiteSettingsForm
@@ -44,6 +45,8 @@ from reviewboard.admin.checks import get_can_enable_search, \
                                      get_can_use_amazon_s3, \
                                      get_can_use_couchdb
 from reviewboard.admin.siteconfig import load_site_config
+from reviewboard.diffviewer.prerender import PrerenderQueue, \
+                                             get_backend_class
 from reviewboard.scmtools import sshutils
 
 
@@ -405,6 +408,97 @@ class DiffSettingsForm(SiteSettingsForm):
                     "page to the diff viewer."),
         initial=10)
 
+    diffviewer_chunk_threads = forms.IntegerField(
+        label=_("Concurrent files per diff"),
+        help_text=_("The number of files in a diff that will be fetched "
+                    "and processed at the same time when showing a diff. "
+                    "Enter 0 to process files one at a time."),
+        min_value=0,
+        initial=0)
+
+    diffviewer_chunk_processes = forms.IntegerField(
+        label=_("Diff worker processes"),
+        help_text=_("The number of worker processes in each server process "
+                    "used for diffing and syntax highlighting files. This "
+                    "is used along with concurrent files per diff. Enter 0 "
+                    "to do this work in the server process."),
+        min_value=0,
+        initial=0)
+
+    diffviewer_patched_file_cache_dir = forms.CharField(
+        label=_("Patched file cache directory"),
+        help_text=_("An optional directory used to store patched files, in "
+                    "addition to the main cache. This saves having to "
+                    "re-apply diffs when the main cache evicts them. This "
+                    "must be writable by the web server."),
+        required=False,
+        widget=forms.TextInput(attrs={'size': '60'}))
+
+    diffviewer_patched_file_cache_max_size = forms.IntegerField(
+        label=_("Maximum patched file cache size"),
+        help_text=_("The size, in megabytes, that the patched file cache "
+                    "directory can grow to before the least recently used "
+                    "patched files are removed."),
+        min_value=1,
+        initial=1024)
+
+    diffviewer_file_store_dir = forms.CharField(
+        label=_("Repository file store directory"),
+        help_text=_("An optional directory used to store files fetched "
+                    "from repositories. Files at a specific revision never "
+                    "change, so they're kept here until there's no more "
+                    "room for them, saving trips to the repository when "
+                    "the main cache evicts them. This must be writable by "
+                    "the web server."),
+        required=False,
+        widget=forms.TextInput(attrs={'size': '60'}))
+
+    diffviewer_file_store_max_size = forms.IntegerField(
+        label=_("Maximum file store size"),
+        help_text=_("The size, in megabytes, that the repository file "
+                    "store can grow to before the least recently used "
+                    "files are removed."),
+        min_value=1,
+        initial=1024)
+
+    diffviewer_file_store_compress = forms.BooleanField(
+        label=_("Compress stored files"),
+        help_text=_("Compress files in the repository file store. This "
+                    "fits more files in the store, at the cost of some "
+                    "time spent compressing and decompressing them."),
+        required=False)
+
+    scmtools_git_use_mirrors = forms.BooleanField(
+        label=_("Mirror remote Git repositories"),
+        help_text=_("Keep a local mirror of each remote Git repository in "
+                    "the site's data directory, and read files from it "
+                    "instead of the raw file URL. The mirror is updated "
+                    "when a file can't be found in it. The raw file URL "
+                    "is still used while the mirror is first cloned, or if "
+                    "it can't be updated."),
+        required=False)
+
+    diffviewer_prerender_enabled = forms.BooleanField(
+        label=_("Pre-render new diffs"),
+        help_text=_("Fetch, diff and render newly uploaded diffs in the "
+                    "background, so that they're already cached when "
+                    "they're first viewed."),
+        required=False)
+
+    diffviewer_prerender_workers = forms.IntegerField(
+        label=_("Pre-render workers"),
+        help_text=_("The number of diffs pre-rendered at the same time "
+                    "by each server process."),
+        min_value=1,
+        initial=1)
+
+    diffviewer_prerender_backend = forms.CharField(
+        label=_("Pre-render backend"),
+        help_text=_("The Python class used to queue diffs for "
+                    "pre-rendering. The default runs them in threads in "
+                    "each server process."),
+        widget=forms.TextInput(attrs={'size': '60'}))
+
     def load(self):
         # TODO: Move this check into a dependencies module so we can catch it
         #       when the user starts up Review Board.
@@ -421,6 +515,49 @@ class DiffSettingsForm(SiteSettingsForm):
 
         super(DiffSettingsForm, self).load()
 
+    def clean_diffviewer_patched_file_cache_dir(self):
+        """Validates that the patched file cache directory is valid."""
+        return self._clean_cache_dir(
+            'diffviewer_patched_file_cache_dir',
+            _("The patched file cache directory must be absolute."))
+
+    def clean_diffviewer_file_store_dir(self):
+        """Validates that the repository file store directory is valid."""
+        return self._clean_cache_dir(
+            'diffviewer_file_store_dir',
+            _("The repository file store directory must be absolute."))
+
+    def _clean_cache_dir(self, field_name, not_absolute_error):
+        cache_dir = self.cleaned_data[field_name].strip()
+
+        if cache_dir:
+            if not os.path.isabs(cache_dir):
+                raise forms.ValidationError(not_absolute_error)
+
+            if (os.path.exists(cache_dir) and
+                not os.access(cache_dir, os.W_OK)):
+                raise forms.ValidationError(
+                    _("This path is not writable by the web server."))
+
+        return cache_dir
+
+    def clean_diffviewer_prerender_backend(self):
+        """Validates that the pre-render backend can be loaded."""
+        backend_path = \
+            self.cleaned_data['diffviewer_prerender_backend'].strip()
+
+        try:
+            backend_cls = get_backend_class(backend_path)
+        except ImproperlyConfigured, e:
+            raise forms.ValidationError(str(e))
+
+        if (not isinstance(backend_cls, type) or
+            not issubclass(backend_cls, PrerenderQueue)):
+            raise forms.ValidationError(
+                _("%s is not a diff pre-render backend.") % backend_path)
+
+        return backend_path
+
     def save(self):
         self.siteconfig.set('diffviewer_include_space_patterns',
             re.split(r",\s*", self.cleaned_data['include_space_patterns']))
@@ -450,7 +587,26 @@ class DiffSettingsForm(SiteSettingsForm):
                 'classes': ('wide',),
                 'fields': ('diffviewer_context_num_lines',
                            'diffviewer_paginate_by',
-                           'diffviewer_paginate_orphans')
+                           'diffviewer_paginate_orphans',
+                           'diffviewer_chunk_threads',
+                           'diffviewer_chunk_processes',
+                           'diffviewer_patched_file_cache_dir',
+                           'diffviewer_patched_file_cache_max_size')
+            },
+            {
+                'title': _("Repository files"),
+                'classes': ('wide',),
+                'fields': ('diffviewer_file_store_dir',
+                           'diffviewer_file_store_max_size',
+                           'diffviewer_file_store_compress',
+                           'scmtools_git_use_mirrors'),
+            },
+            {
+                'title': _("Pre-rendering"),
+                'classes': ('wide',),
+                'fields': ('diffviewer_prerender_enabled',
+                           'diffviewer_prerender_workers',
+                           'diffviewer_prerender_backend'),
             }
         )
 
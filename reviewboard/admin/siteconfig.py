@@ -116,15 +116,27 @@ defaults.update({
     'auth_x509_username_field':            'SSL_CLIENT_S_DN_CN',
     'auth_x509_username_regex':            '',
     'auth_x509_autocreate_users':          False,
+    'diffviewer_chunk_processes':          0,
+    'diffviewer_chunk_threads':            0,
     'diffviewer_context_num_lines':        5,
+    'diffviewer_file_store_compress':      False,
+    'diffviewer_file_store_dir':           '',
+    'diffviewer_file_store_max_size':      1024,
     'diffviewer_include_space_patterns':   [],
     'diffviewer_paginate_by':              20,
     'diffviewer_paginate_orphans':         10,
+    'diffviewer_patched_file_cache_dir':   '',
+    'diffviewer_patched_file_cache_max_size': 1024,
+    'diffviewer_prerender_backend':
+        'reviewboard.diffviewer.prerender.LocalPrerenderQueue',
+    'diffviewer_prerender_enabled':        False,
+    'diffviewer_prerender_workers':        1,
     'diffviewer_syntax_highlighting':      True,
     'diffviewer_syntax_highlighting_threshold': 0,
     'diffviewer_show_trailing_whitespace': True,
     'mail_send_review_mail':               False,
     'mail_send_new_user_mail':             False,
+    'scmtools_git_use_mirrors':            False,
     'search_enable':                       False,
     'site_domain_method':                  'http',
 
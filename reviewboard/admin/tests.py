@@ -1,7 +1,16 @@
 from django.conf import settings
 from django.test import TestCase
+from djblets.siteconfig.models import SiteConfiguration
 
 from reviewboard.admin import checks
+from reviewboard.diffviewer.prerender import PrerenderJob, PrerenderQueue, \
+                                             PRIORITY_LOW
+
+
+class TestPrerenderQueue(PrerenderQueue):
+    """A pre-render queue backend with a fixed list of jobs."""
+    def get_jobs(self):
+        return [PrerenderJob(1, 2, priority=PRIORITY_LOW)]
 
 
 class UpdateTests(TestCase):
@@ -41,3 +50,44 @@ class UpdateTests(TestCase):
         response = self.client.get("/")
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, "admin/manual_updates_required.html")
+
+
+class PrerenderStatusTests(TestCase):
+    """Tests for the diff pre-rendering status page."""
+    fixtures = ['test_users']
+
+    def setUp(self):
+        self.client.login(username='admin', password='admin')
+
+    def tearDown(self):
+        self._set_prerender_settings(
+            False, 'reviewboard.diffviewer.prerender.LocalPrerenderQueue')
+
+    def testDisabled(self):
+        """Testing the pre-rendering status page with pre-rendering disabled"""
+        self._set_prerender_settings(
+            False, 'reviewboard.diffviewer.prerender.LocalPrerenderQueue')
+
+        response = self.client.get('/admin/prerender/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['prerender_enabled'])
+        self.assertEqual(response.context['jobs'], [])
+
+    def testJobs(self):
+        """Testing the pre-rendering status page listing jobs"""
+        self._set_prerender_settings(
+            True, 'reviewboard.admin.tests.TestPrerenderQueue')
+
+        response = self.client.get('/admin/prerender/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['prerender_enabled'])
+        self.assertEqual(response.context['prerender_backend'],
+                         'TestPrerenderQueue')
+        self.assertEqual(len(response.context['jobs']), 1)
+        self.assertEqual(response.context['jobs'][0].interdiffset_id, 2)
+
+    def _set_prerender_settings(self, enabled, backend):
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_prerender_enabled', enabled)
+        siteconfig.set('diffviewer_prerender_backend', backend)
+        siteconfig.save()
@@ -64,6 +64,7 @@ settings_urlpatterns = patterns('reviewboard.admin.views',
 urlpatterns = patterns('reviewboard.admin.views',
     (r'^$', 'dashboard'),
     (r'^cache/$', 'cache_stats'),
+    (r'^prerender/$', 'prerender_status'),
     (r'^settings/', include(settings_urlpatterns)),
     (r'^widget-toggle/', 'widget_toggle'),
     (r'^widget-activity/','widget_activity'),
@@ -18,6 +18,7 @@ from reviewboard.admin.forms import SSHSettingsForm
 from reviewboard.admin.widgets import dynamic_activity_data, \
                                       primary_widgets, \
                                       secondary_widgets
+from reviewboard.diffviewer.prerender import get_prerender_queue
 from reviewboard.scmtools import sshutils
 
 
@@ -51,6 +52,28 @@ def cache_stats(request, template_name="admin/cache_stats.html"):
     }))
 
 
+@staff_member_required
+def prerender_status(request, template_name="admin/prerender_status.html"):
+    """
+    Displays the diffs being pre-rendered by this server process, and
+    those recently finished.
+    """
+    queue = get_prerender_queue()
+
+    if queue:
+        jobs = queue.get_jobs()
+    else:
+        jobs = []
+
+    return render_to_response(template_name, RequestContext(request, {
+        'prerender_enabled': queue is not None,
+        'prerender_backend': queue and queue.__class__.__name__,
+        'jobs': jobs,
+        'title': _("Diff Pre-rendering"),
+        'root_path': settings.SITE_ROOT + "admin/db/"
+    }))
+
+
 @staff_member_required
 def site_settings(request, form_class,
                   template_name="siteconfig/settings.html"):
@@ -12,6 +12,7 @@ from djblets.util.misc import cache_memoize
 from reviewboard.admin.cache_stats import get_cache_stats
 from reviewboard.attachments.models import FileAttachment
 from reviewboard.changedescs.models import ChangeDescription
+from reviewboard.diffviewer.diffutils import get_patched_file_cache_stats
 from reviewboard.diffviewer.models import DiffSet
 from reviewboard.reviews.models import ReviewRequest, Group, \
                                        Comment, Review, Screenshot, \
@@ -253,6 +254,7 @@ class ServerCacheWidget(Widget):
 
         return {
             'cache_stats': cache_stats,
+            'patched_file_stats': get_patched_file_cache_stats(),
             'uptime': uptime
         }
 
@@ -0,0 +1,422 @@
+/*
+ * Optional C implementation of the core of MyersDiffer.
+ *
+ * This implements the divide-and-conquer LCS and the Shortest Middle Snake
+ * search from MyersDiffer._lcs, _find_sms and _find_diagonal in
+ * reviewboard/diffviewer/myersdiff.py. It must produce exactly the same
+ * results as the Python version, so any change made there must be made
+ * here as well.
+ *
+ * The Python code takes care of turning lines into codes and discarding
+ * confusing lines. It then calls lcs() with the lists of undiscarded codes,
+ * and gets back the indexes (into those lists) of the lines that were
+ * modified.
+ */
+#include <Python.h>
+
+#define SNAKE_LIMIT 20
+
+
+typedef struct {
+    long *a;
+    long *b;
+    char *a_modified;
+    char *b_modified;
+    long *fdiag;
+    long *bdiag;
+    long downoff;
+    long upoff;
+    long max_lines;
+} DiffState;
+
+
+static int
+find_diagonal(DiffState *s, long minimum, long maximum, long k, long best,
+              long diagoff, long *vector, int forward,
+              long a_lower, long a_upper, long b_lower, long b_upper,
+              long cost, long *ret_x, long *ret_y)
+{
+    long d;
+
+    for (d = maximum; d >= minimum; d -= 2) {
+        long dd = d - k;
+        long x = vector[diagoff + d];
+        long y = x - d;
+        long v = (forward ? x - a_lower : a_upper - x) * 2 + dd;
+        long x_index, y_index;
+
+        if (v <= 12 * (cost + labs(dd)) || v <= best) {
+            continue;
+        }
+
+        if (forward) {
+            if (!(a_lower + SNAKE_LIMIT <= x && x < a_upper) ||
+                !(b_lower + SNAKE_LIMIT <= y && y < b_upper)) {
+                continue;
+            }
+
+            x_index = x - 1;
+            y_index = y - 1;
+        } else {
+            if (!(a_lower < x && x <= a_upper - SNAKE_LIMIT) ||
+                !(b_lower < y && y <= b_upper - SNAKE_LIMIT)) {
+                continue;
+            }
+
+            x_index = x;
+            y_index = y;
+        }
+
+        if (s->a[x_index] == s->b[y_index]) {
+            *ret_x = x;
+            *ret_y = y;
+            return v;
+        }
+    }
+
+    *ret_x = 0;
+    *ret_y = 0;
+    return 0;
+}
+
+
+static void
+find_sms(DiffState *s, long a_lower, long a_upper, long b_lower,
+         long b_upper, int find_minimal, long *ret_x, long *ret_y,
+         int *low_minimal, int *high_minimal)
+{
+    long *down_vector = s->fdiag;
+    long *up_vector = s->bdiag;
+    long downoff = s->downoff;
+    long upoff = s->upoff;
+    long down_k = a_lower - b_lower;
+    long up_k = a_upper - b_upper;
+    int odd_delta = (down_k - up_k) % 2 != 0;
+    long dmin = a_lower - b_upper;
+    long dmax = a_upper - b_lower;
+    long down_min = down_k, down_max = down_k;
+    long up_min = up_k, up_max = up_k;
+    long cost = 0;
+
+    down_vector[downoff + down_k] = a_lower;
+    up_vector[upoff + up_k] = a_upper;
+
+    for (;;) {
+        int big_snake = 0;
+        long k;
+
+        cost++;
+
+        if (down_min > dmin) {
+            down_min--;
+            down_vector[downoff + down_min - 1] = -1;
+        } else {
+            down_min++;
+        }
+
+        if (down_max < dmax) {
+            down_max++;
+            down_vector[downoff + down_max + 1] = -1;
+        } else {
+            down_max--;
+        }
+
+        /* Extend the forward path. */
+        for (k = down_max; k >= down_min; k -= 2) {
+            long tlo = down_vector[downoff + k - 1];
+            long thi = down_vector[downoff + k + 1];
+            long x = (tlo >= thi) ? tlo + 1 : thi;
+            long y = x - k;
+            long old_x = x;
+
+            while (x < a_upper && y < b_upper && s->a[x] == s->b[y]) {
+                x++;
+                y++;
+            }
+
+            if (odd_delta && up_min <= k && k <= up_max &&
+                up_vector[upoff + k] <= x) {
+                *ret_x = x;
+                *ret_y = y;
+                *low_minimal = 1;
+                *high_minimal = 1;
+                return;
+            }
+
+            if (x - old_x > SNAKE_LIMIT) {
+                big_snake = 1;
+            }
+
+            down_vector[downoff + k] = x;
+        }
+
+        /* Extend the reverse path. */
+        if (up_min > dmin) {
+            up_min--;
+            up_vector[upoff + up_min - 1] = s->max_lines;
+        } else {
+            up_min++;
+        }
+
+        if (up_max < dmax) {
+            up_max++;
+            up_vector[upoff + up_max + 1] = s->max_lines;
+        } else {
+            up_max--;
+        }
+
+        for (k = up_max; k >= up_min; k -= 2) {
+            long tlo = up_vector[upoff + k - 1];
+            long thi = up_vector[upoff + k + 1];
+            long x = (tlo < thi) ? tlo : thi - 1;
+            long y = x - k;
+            long old_x = x;
+
+            while (x > a_lower && y > b_lower && s->a[x - 1] == s->b[y - 1]) {
+                x--;
+                y--;
+            }
+
+            if (!odd_delta && down_min <= k && k <= down_max &&
+                x <= down_vector[downoff + k]) {
+                *ret_x = x;
+                *ret_y = y;
+                *low_minimal = 1;
+                *high_minimal = 1;
+                return;
+            }
+
+            if (old_x - x > SNAKE_LIMIT) {
+                big_snake = 1;
+            }
+
+            up_vector[upoff + k] = x;
+        }
+
+        if (find_minimal) {
+            continue;
+        }
+
+        /* Heuristics courtesy of GNU diff. See myersdiff.py. */
+        if (cost > 200 && big_snake) {
+            long best;
+
+            best = find_diagonal(s, down_min, down_max, down_k, 0, downoff,
+                                 down_vector, 1, a_lower, a_upper,
+                                 b_lower, b_upper, cost, ret_x, ret_y);
+
+            if (best > 0) {
+                *low_minimal = 1;
+                *high_minimal = 0;
+                return;
+            }
+
+            best = find_diagonal(s, up_min, up_max, up_k, best, upoff,
+                                 up_vector, 0, a_lower, a_upper,
+                                 b_lower, b_upper, cost, ret_x, ret_y);
+
+            if (best > 0) {
+                *low_minimal = 0;
+                *high_minimal = 1;
+                return;
+            }
+        }
+    }
+}
+
+
+static void
+lcs(DiffState *s, long a_lower, long a_upper, long b_lower, long b_upper,
+    int find_minimal)
+{
+    long x, y;
+    int low_minimal, high_minimal;
+
+    /* Fast walkthrough equal lines at the start and end. */
+    while (a_lower < a_upper && b_lower < b_upper &&
+           s->a[a_lower] == s->b[b_lower]) {
+        a_lower++;
+        b_lower++;
+    }
+
+    while (a_upper > a_lower && b_upper > b_lower &&
+           s->a[a_upper - 1] == s->b[b_upper - 1]) {
+        a_upper--;
+        b_upper--;
+    }
+
+    if (a_lower == a_upper) {
+        /* Inserted lines. */
+        while (b_lower < b_upper) {
+            s->b_modified[b_lower++] = 1;
+        }
+    } else if (b_lower == b_upper) {
+        /* Deleted lines. */
+        while (a_lower < a_upper) {
+            s->a_modified[a_lower++] = 1;
+        }
+    } else {
+        find_sms(s, a_lower, a_upper, b_lower, b_upper, find_minimal,
+                 &x, &y, &low_minimal, &high_minimal);
+
+        lcs(s, a_lower, x, b_lower, y, low_minimal);
+        lcs(s, x, a_upper, y, b_upper, high_minimal);
+    }
+}
+
+
+static long *
+codes_from_sequence(PyObject *seq, long *length)
+{
+    PyObject *fast;
+    long *codes;
+    Py_ssize_t i, n;
+
+    fast = PySequence_Fast(seq, "expected a sequence of ints");
+
+    if (fast == NULL) {
+        return NULL;
+    }
+
+    n = PySequence_Fast_GET_SIZE(fast);
+
+    /* Always allocate at least one item, so that malloc(0) can't fail. */
+    codes = (long *)PyMem_Malloc(sizeof(long) * (n + 1));
+
+    if (codes == NULL) {
+        Py_DECREF(fast);
+        PyErr_NoMemory();
+        return NULL;
+    }
+
+    for (i = 0; i < n; i++) {
+        codes[i] = PyInt_AsLong(PySequence_Fast_GET_ITEM(fast, i));
+
+        if (codes[i] == -1 && PyErr_Occurred()) {
+            PyMem_Free(codes);
+            Py_DECREF(fast);
+            return NULL;
+        }
+    }
+
+    Py_DECREF(fast);
+    *length = (long)n;
+
+    return codes;
+}
+
+
+static PyObject *
+modified_to_list(char *modified, long length)
+{
+    PyObject *result = PyList_New(0);
+    long i;
+
+    if (result == NULL) {
+        return NULL;
+    }
+
+    for (i = 0; i < length; i++) {
+        if (modified[i]) {
+            PyObject *index = PyInt_FromLong(i);
+
+            if (index == NULL || PyList_Append(result, index) == -1) {
+                Py_XDECREF(index);
+                Py_DECREF(result);
+                return NULL;
+            }
+
+            Py_DECREF(index);
+        }
+    }
+
+    return result;
+}
+
+
+static PyObject *
+myersdiff_lcs(PyObject *self, PyObject *args)
+{
+    PyObject *a_seq, *b_seq;
+    PyObject *a_result = NULL, *b_result = NULL, *result = NULL;
+    int find_minimal = 0;
+    long a_len = 0, b_len = 0, vector_size;
+    DiffState s;
+
+    if (!PyArg_ParseTuple(args, "OO|i:lcs", &a_seq, &b_seq, &find_minimal)) {
+        return NULL;
+    }
+
+    memset(&s, 0, sizeof(s));
+
+    s.a = codes_from_sequence(a_seq, &a_len);
+
+    if (s.a == NULL) {
+        goto done;
+    }
+
+    s.b = codes_from_sequence(b_seq, &b_len);
+
+    if (s.b == NULL) {
+        goto done;
+    }
+
+    vector_size = a_len + b_len + 3;
+    s.max_lines = vector_size;
+    s.downoff = s.upoff = b_len + 1;
+    s.fdiag = (long *)PyMem_Malloc(sizeof(long) * vector_size);
+    s.bdiag = (long *)PyMem_Malloc(sizeof(long) * vector_size);
+    s.a_modified = (char *)PyMem_Malloc(a_len + 1);
+    s.b_modified = (char *)PyMem_Malloc(b_len + 1);
+
+    if (s.fdiag == NULL || s.bdiag == NULL ||
+        s.a_modified == NULL || s.b_modified == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    memset(s.fdiag, 0, sizeof(long) * vector_size);
+    memset(s.bdiag, 0, sizeof(long) * vector_size);
+    memset(s.a_modified, 0, a_len + 1);
+    memset(s.b_modified, 0, b_len + 1);
+
+    Py_BEGIN_ALLOW_THREADS
+    lcs(&s, 0, a_len, 0, b_len, find_minimal);
+    Py_END_ALLOW_THREADS
+
+    a_result = modified_to_list(s.a_modified, a_len);
+    b_result = modified_to_list(s.b_modified, b_len);
+
+    if (a_result != NULL && b_result != NULL) {
+        result = PyTuple_Pack(2, a_result, b_result);
+    }
+
+done:
+    Py_XDECREF(a_result);
+    Py_XDECREF(b_result);
+    PyMem_Free(s.a);
+    PyMem_Free(s.b);
+    PyMem_Free(s.fdiag);
+    PyMem_Free(s.bdiag);
+    PyMem_Free(s.a_modified);
+    PyMem_Free(s.b_modified);
+
+    return result;
+}
+
+
+static PyMethodDef myersdiff_methods[] = {
+    {"lcs", myersdiff_lcs, METH_VARARGS,
+     "lcs(a, b, find_minimal=False) -> (a_modified, b_modified)\n\n"
+     "Computes the LCS of two lists of line codes, returning the indexes\n"
+     "of the lines in each list that were modified."},
+    {NULL, NULL, 0, NULL}
+};
+
+
+PyMODINIT_FUNC
+init_myersdiff(void)
+{
+    Py_InitModule3("_myersdiff", myersdiff_methods,
+                   "Optional C implementation of the MyersDiffer core.");
+}
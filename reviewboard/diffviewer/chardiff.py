@@ -0,0 +1,379 @@
+from reviewboard.diffviewer.myersdiff import MyersDiffer
+
+
+# The number of bits set in each hex digit, for counting the bits in an
+# integer from its hex representation.
+_HEX_DIGIT_BITS = {
+    '0': 0, '1': 1, '2': 1, '3': 2, '4': 1, '5': 2, '6': 2, '7': 3,
+    '8': 1, '9': 2, 'a': 2, 'b': 3, 'c': 2, 'd': 3, 'e': 3, 'f': 4,
+}
+
+
+class CharDiffer(object):
+    """
+    Diffs the characters of two lines of text.
+
+    This is used to find the changed regions within a pair of replaced
+    lines. It supports the ratio and get_opcodes methods of
+    difflib.SequenceMatcher.
+
+    Any common prefix and suffix of the lines are matched up front, and the
+    rest is diffed with MyersDiffer's implementation of the Myers diff
+    algorithm, which is accelerated in C when the extension is built.
+    Changes are then moved as far forward in the lines as they can go, so
+    that a deletion or insertion of repeated text is always shown in the
+    same place.
+    """
+    # The longest changed part of a line that ratio() finds the exact
+    # number of matching characters for.
+    max_lcs_len = 10000
+
+    # The size of the blocks that ratio() matches up between longer lines.
+    block_size = 16
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+        self._a_runs = None
+        self._b_runs = None
+        self._affixes = None
+
+    def real_quick_ratio(self):
+        """
+        Returns an upper bound on ratio(), based only on the line lengths.
+        """
+        total = len(self.a) + len(self.b)
+
+        if total:
+            return 2.0 * min(len(self.a), len(self.b)) / total
+        else:
+            return 1.0
+
+    def quick_ratio(self):
+        """
+        Returns an upper bound on ratio(), based on the characters in each
+        line, regardless of order.
+        """
+        a, b = self.a, self.b
+        total = len(a) + len(b)
+
+        if not total:
+            return 1.0
+
+        prefix, suffix = self._get_common_affixes()
+        a_middle = a[prefix:len(a) - suffix]
+        b_middle = b[prefix:len(b) - suffix]
+        matches = prefix + suffix
+
+        if len(a_middle) > len(b_middle):
+            a_middle, b_middle = b_middle, a_middle
+
+        for c in set(a_middle):
+            matches += min(a_middle.count(c), b_middle.count(c))
+
+        return 2.0 * matches / total
+
+    def ratio(self):
+        """
+        Returns the similarity of the lines, between 0 and 1.
+
+        This is twice the number of matching characters, divided by the
+        total number of characters in both lines. The number of matching
+        characters is computed without diffing the lines, so that lines
+        that turn out to be too different to show the changes of are
+        cheap to rule out.
+
+        Computing it exactly takes time proportional to the product of the
+        lengths of the changed parts of the lines, so once either is longer
+        than max_lcs_len, it's estimated from the blocks of the new line
+        that appear in the old one instead.
+        """
+        a, b = self.a, self.b
+        total = len(a) + len(b)
+
+        if not total:
+            return 1.0
+
+        prefix, suffix = self._get_common_affixes()
+        a_middle = a[prefix:len(a) - suffix]
+        b_middle = b[prefix:len(b) - suffix]
+
+        if (len(a_middle) <= self.max_lcs_len and
+            len(b_middle) <= self.max_lcs_len):
+            matches = _get_lcs_len(a_middle, b_middle)
+        else:
+            matches = _get_block_matches_len(a_middle, b_middle,
+                                             self.block_size)
+
+        matches += prefix + suffix
+
+        return 2.0 * matches / total
+
+    def get_opcodes(self):
+        """
+        Returns the opcodes for turning the old line into the new one.
+
+        These are in the same format as those returned by
+        difflib.SequenceMatcher.get_opcodes.
+        """
+        self._compute()
+
+        a_len, b_len = len(self.a), len(self.b)
+        a_runs = self._a_runs + [(a_len, a_len)]
+        b_runs = self._b_runs + [(b_len, b_len)]
+        opcodes = []
+        i = j = 0
+        ai = bi = 0
+
+        while i < a_len or j < b_len:
+            a_start, a_end = a_runs[ai]
+            b_start, b_end = b_runs[bi]
+
+            # The unchanged characters between the changes on each side
+            # match up, in order.
+            num_equal = min(a_start - i, b_start - j)
+
+            if num_equal > 0:
+                opcodes.append(('equal', i, i + num_equal, j, j + num_equal))
+                i += num_equal
+                j += num_equal
+
+            i1, j1 = i, j
+
+            if i == a_start and a_start < a_len:
+                i = a_end
+                ai += 1
+
+            if j == b_start and b_start < b_len:
+                j = b_end
+                bi += 1
+
+            if i1 < i and j1 < j:
+                opcodes.append(('replace', i1, i, j1, j))
+            elif i1 < i:
+                opcodes.append(('delete', i1, i, j1, j))
+            elif j1 < j:
+                opcodes.append(('insert', i1, i, j1, j))
+
+        return opcodes
+
+    def _compute(self):
+        """Finds the runs of changed characters in each line."""
+        if self._a_runs is not None:
+            return
+
+        a, b = self.a, self.b
+        prefix, suffix = self._get_common_affixes()
+        a_end = len(a) - suffix
+        b_end = len(b) - suffix
+
+        if prefix == a_end:
+            a_changed = []
+            b_changed = range(prefix, b_end)
+        elif prefix == b_end:
+            a_changed = range(prefix, a_end)
+            b_changed = []
+        else:
+            differ = _CodeDiffer([ord(c) for c in a[prefix:a_end]],
+                                 [ord(c) for c in b[prefix:b_end]])
+            differ._gen_diff_data()
+
+            a_changed = sorted([prefix + i
+                                for i, modified in
+                                differ.a_data.modified.iteritems()
+                                if modified])
+            b_changed = sorted([prefix + i
+                                for i, modified in
+                                differ.b_data.modified.iteritems()
+                                if modified])
+
+        self._a_runs = self._shift_runs(a, self._get_runs(a_changed))
+        self._b_runs = self._shift_runs(b, self._get_runs(b_changed))
+
+    def _get_common_affixes(self):
+        """
+        Returns the lengths of the common prefix and suffix of the lines.
+
+        These never overlap.
+        """
+        if self._affixes is not None:
+            return self._affixes
+
+        a, b = self.a, self.b
+        max_len = min(len(a), len(b))
+        prefix = _get_common_prefix_len(a, b, max_len)
+
+        # The suffix can't overlap the prefix in either line.
+        suffix_max_len = max_len - prefix
+        lo, hi = 0, suffix_max_len
+
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+
+            if a[len(a) - mid:] == b[len(b) - mid:]:
+                lo = mid
+            else:
+                hi = mid - 1
+
+        self._affixes = (prefix, lo)
+
+        return self._affixes
+
+    def _get_runs(self, indexes):
+        """
+        Returns the runs of consecutive indexes in a sorted list of indexes,
+        as (start, end) tuples.
+        """
+        runs = []
+
+        for i in indexes:
+            if runs and runs[-1][1] == i:
+                runs[-1][1] = i + 1
+            else:
+                runs.append([i, i + 1])
+
+        return runs
+
+    def _shift_runs(self, s, runs):
+        """
+        Moves runs of changed characters forward while they can be.
+
+        A run can move forward by one character if its first character is
+        the same as the unchanged character after it. This doesn't change
+        which characters match, only which copy of the repeated text is
+        shown as changed. Runs that meet are merged.
+        """
+        result = []
+        num_runs = len(runs)
+        s_len = len(s)
+        k = 0
+
+        while k < num_runs:
+            start, end = runs[k]
+            k += 1
+
+            while True:
+                if k < num_runs:
+                    limit = runs[k][0]
+                else:
+                    limit = s_len
+
+                while end < limit and s[start] == s[end]:
+                    start += 1
+                    end += 1
+
+                if end == limit and k < num_runs:
+                    end = runs[k][1]
+                    k += 1
+                else:
+                    break
+
+            result.append((start, end))
+
+        return result
+
+
+class _CodeDiffer(MyersDiffer):
+    """
+    Runs MyersDiffer on sequences of character codes.
+
+    None of the codes are discarded as being too common, since that's
+    tuned for lines of files, and CharDiffer moves the changes itself.
+    """
+    def _gen_diff_codes(self, codes, is_modified_file):
+        return codes
+
+    def _discard_confusing_lines(self):
+        for data in (self.a_data, self.b_data):
+            data.undiscarded = data.data
+            data.real_indexes = range(data.length)
+            data.undiscarded_lines = data.length
+
+    def _shift_chunks(self, data, other_data):
+        pass
+
+
+def _get_common_prefix_len(a, b, max_len):
+    """
+    Returns the length of the common prefix of two strings.
+
+    This compares slices of the strings, which is much faster for long
+    strings than comparing one character at a time.
+    """
+    lo, hi = 0, max_len
+
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+def _get_lcs_len(a, b):
+    """
+    Returns the length of the longest common subsequence of two strings.
+
+    This uses the bit-parallel algorithm from Hyyro's "Bit-Parallel LCS-length
+    Computation Revisited", with a bit for each character of a. Python's long
+    integers do the work for a whole row of the dynamic programming table at
+    once, so this takes len(b) steps rather than len(a) * len(b).
+    """
+    if not a or not b:
+        return 0
+
+    all_bits = (1 << len(a)) - 1
+    match_masks = {}
+
+    for i, c in enumerate(a):
+        match_masks[c] = match_masks.get(c, 0) | (1 << i)
+
+    v = all_bits
+
+    for c in b:
+        u = v & match_masks.get(c, 0)
+        v = ((v + u) | (v - u)) & all_bits
+
+    # Each zero bit left in v is a match.
+    return len(a) - _count_bits(v)
+
+
+def _count_bits(v):
+    """Returns the number of bits set in a non-negative integer."""
+    return sum([_HEX_DIGIT_BITS[digit] for digit in '%x' % v])
+
+
+def _get_block_matches_len(a, b, block_size):
+    """
+    Returns an estimate of the length of the longest common subsequence of
+    two strings, in time proportional to their lengths.
+
+    b is split into blocks of block_size characters, and a is scanned for
+    them, with each block only matched once. Lines with a few scattered
+    changes share most of their blocks, while lines that are different
+    throughout share hardly any, even if they use the same characters.
+    """
+    blocks = {}
+
+    for i in xrange(0, len(b) - block_size + 1, block_size):
+        block = b[i:i + block_size]
+        blocks[block] = blocks.get(block, 0) + 1
+
+    matches = 0
+    i = 0
+    end = len(a) - block_size
+
+    while i <= end:
+        block = a[i:i + block_size]
+
+        if blocks.get(block):
+            blocks[block] -= 1
+            matches += block_size
+            i += block_size
+        else:
+            i += 1
+
+    return matches
@@ -1,10 +1,13 @@
 from __future__ import with_statement
 import fnmatch
+import hashlib
+import logging
 import os
 import re
+import string
 import subprocess
 import tempfile
-from difflib import SequenceMatcher
+import threading
 
 try:
     import pygments
@@ -14,6 +17,9 @@ try:
 except ImportError:
     pass
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 from django.utils.html import escape
 from django.utils.http import urlquote
 from django.utils.safestring import mark_safe
@@ -22,17 +28,36 @@ from django.utils.translation import ugettext as _
 from djblets.log import log_timed
 from djblets.siteconfig.models import SiteConfiguration
 from djblets.util.contextmanagers import controlled_subprocess
-from djblets.util.misc import cache_memoize
+from djblets.util.misc import cache_memoize, make_cache_key
 
 from reviewboard.accounts.models import Profile
 from reviewboard.admin.checks import get_can_enable_syntax_highlighting
+from reviewboard.diffviewer.chardiff import CharDiffer
 from reviewboard.diffviewer.myersdiff import MyersDiffer
+from reviewboard.diffviewer.patcher import PatchError, apply_patch
 from reviewboard.diffviewer.smdiff import SMDiffer
+from reviewboard.lrucache import LRUCache
 from reviewboard.scmtools.core import PRE_CREATION, HEAD
+from reviewboard.scmtools.filestore import get_store
 
 
 DEFAULT_DIFF_COMPAT_VERSION = 1
 
+# The number of virtual lines of a diff that are generated and cached
+# together. See load_chunk_lines.
+CHUNK_WINDOW_NUM_LINES = 500
+
+# The number of pairs of lines whose changed regions are remembered. See
+# get_line_changed_regions.
+LINE_REGIONS_CACHE_SIZE = 1000
+
+_chunk_pools_lock = threading.Lock()
+_chunk_thread_pool = None
+_chunk_process_pool = None
+
+_line_regions_cache = LRUCache(LINE_REGIONS_CACHE_SIZE)
+_line_regions_cache_lock = threading.Lock()
+
 NEW_FILE_STR = _("New File")
 NEW_CHANGE_STR = _("New Change")
 
@@ -40,7 +65,21 @@ NEWLINES_RE = re.compile(r'\r?\n')
 NEWLINE_CONVERSION_RE = re.compile(r'\r(\r?\n)?')
 
 ALPHANUM_RE = re.compile(r'\w')
-WHITESPACE_RE = re.compile(r'\s')
+
+# The whitespace characters removed when comparing lines that only have
+# whitespace changes.
+WHITESPACE_CHARS = ' \t\n\r\f\v'
+
+# A translation table that leaves every byte as it is, for removing
+# characters with str.translate.
+IDENTITY_TRANS_TABLE = string.maketrans('', '')
+
+# Splits HTML markup into text, with the tags and entities between them.
+MARKUP_TOKEN_RE = re.compile(r'(<[^>]*>|&[^;]*;)')
+
+# Matches a region highlighted by highlight_regions, which never contains
+# any tags.
+HIGHLIGHTED_REGION_RE = re.compile(r'<span class="hl">([^<]*)</span>')
 
 
 # A list of regular expressions for headers in the source code that we can
@@ -198,25 +237,37 @@ def convert_line_endings(data):
 
 
 def patch(diff, file, filename):
-    """Apply a diff to a file.  Delegates out to `patch` because noone
-       except Larry Wall knows how to patch."""
+    """Apply a diff to a file.
 
+    Most diffs are applied in-process. Anything the in-process patcher
+    can't apply exactly is delegated out to `patch`, because noone
+    except Larry Wall knows how to patch.
+    """
     log_timer = log_timed("Patching file %s" % filename)
 
     if diff.strip() == "":
         # Someone uploaded an unchanged file. Return the one we're patching.
         return file
 
+    file = convert_line_endings(file)
+    diff = convert_line_endings(diff)
+
+    try:
+        data = apply_patch(diff, file)
+        log_timer.done()
+
+        return data
+    except PatchError, e:
+        logging.debug("Falling back on patch for %s: %s", filename, e)
+
     # Prepare the temporary directory if none is available
     tempdir = tempfile.mkdtemp(prefix='reviewboard.')
 
     (fd, oldfile) = tempfile.mkstemp(dir=tempdir)
     f = os.fdopen(fd, "w+b")
-    f.write(convert_line_endings(file))
+    f.write(file)
     f.close()
 
-    diff = convert_line_endings(diff)
-
     newfile = '%s-new' % oldfile
 
     process = subprocess.Popen(['patch', '-o', newfile, oldfile],
@@ -259,20 +310,78 @@ def patch(diff, file, filename):
 
 
 def get_line_changed_regions(oldline, newline):
+    """
+    Returns the regions of a pair of lines that changed.
+
+    This returns a tuple of lists of (start, end) ranges of characters in
+    each line, or (None, None) if too much of the line changed for the
+    regions to be useful.
+
+    The regions of the most recently diffed lines are remembered, so that
+    lines that were changed the same way several times, or that are
+    rendered again, don't have to be diffed again.
+    """
     if oldline is None or newline is None:
         return (None, None)
 
-    # Use the SequenceMatcher directly. It seems to give us better results
-    # for this. We should investigate steps to move to the new differ.
-    differ = SequenceMatcher(None, oldline, newline)
+    key = (_hash_line(oldline), _hash_line(newline))
+
+    _line_regions_cache_lock.acquire()
+
+    try:
+        regions = _line_regions_cache.get(key)
+
+        if regions is not None:
+            return regions
+    finally:
+        _line_regions_cache_lock.release()
+
+    regions = _get_line_changed_regions(oldline, newline)
+
+    _line_regions_cache_lock.acquire()
+
+    try:
+        _line_regions_cache.set(key, regions)
+    finally:
+        _line_regions_cache_lock.release()
+
+    return regions
+
+
+def clear_line_regions_cache():
+    """Forgets the changed regions of all lines diffed so far."""
+    _line_regions_cache_lock.acquire()
+
+    try:
+        _line_regions_cache.clear()
+    finally:
+        _line_regions_cache_lock.release()
+
+
+def _hash_line(line):
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+
+    return hashlib.sha1(line).digest()
+
+
+def _get_line_changed_regions(oldline, newline):
+    """Computes the changed regions for get_line_changed_regions."""
+    differ = CharDiffer(oldline, newline)
 
     # This thresholds our results -- we don't want to show inter-line diffs if
     # most of the line has changed, unless those lines are very short.
+    #
+    # The upper bounds on the ratio are checked first, since they're much
+    # cheaper to compute, and rule out most lines that are completely
+    # different.
 
     # FIXME: just a plain, linear threshold is pretty crummy here.  Short
     # changes in a short line get lost.  I haven't yet thought of a fancy
     # nonlinear test.
-    if differ.ratio() < 0.6:
+    if (differ.real_quick_ratio() < 0.6 or
+        differ.quick_ratio() < 0.6 or
+        differ.ratio() < 0.6):
         return (None, None)
 
     oldchanges = []
@@ -303,6 +412,101 @@ def get_line_changed_regions(oldline, newline):
     return (oldchanges, newchanges)
 
 
+def highlight_regions(markup, regions):
+    """
+    Highlights regions of the text in a line of HTML markup.
+
+    Each region is a (start, end) range of characters in the text of the
+    line without any markup, as returned by get_line_changed_regions. The
+    regions must be sorted. The text in each region is wrapped in
+    ``<span class="hl">...</span>`` tags, which are closed and reopened
+    around any tags in the markup so that they nest properly. Entities
+    count as a single character.
+    """
+    if not regions:
+        return markup
+
+    result = []
+    num_regions = len(regions)
+    r = 0
+    start, end = regions[0]
+    in_hl = False
+    j = 0
+
+    # Splitting on a pattern with a group alternates between text (at
+    # even indexes) and the tags and entities that matched (at odd ones).
+    for i, token in enumerate(MARKUP_TOKEN_RE.split(markup)):
+        if not token:
+            continue
+        elif r == num_regions:
+            result.append(token)
+            continue
+        elif i % 2 == 1 and token[0] == '<':
+            if in_hl:
+                result.append('</span>')
+                in_hl = False
+
+            result.append(token)
+            continue
+
+        # An entity is a single character of text, and can't be split.
+        is_entity = (i % 2 == 1)
+
+        if is_entity:
+            num_chars = 1
+        else:
+            num_chars = len(token)
+
+        pos = 0
+
+        while pos < num_chars:
+            if j >= end:
+                # This region is empty, or overlaps the previous one.
+                r += 1
+
+                if r == num_regions:
+                    break
+
+                start, end = regions[r]
+            else:
+                if j < start:
+                    step = min(num_chars - pos, start - j)
+                else:
+                    step = min(num_chars - pos, end - j)
+
+                    if not in_hl:
+                        result.append('<span class="hl">')
+                        in_hl = True
+
+                if is_entity:
+                    result.append(token)
+                else:
+                    result.append(token[pos:pos + step])
+
+                pos += step
+                j += step
+
+                if in_hl and j == end:
+                    result.append('</span>')
+                    in_hl = False
+
+        if pos < num_chars:
+            result.append(token[pos:])
+
+    if in_hl:
+        result.append('</span>')
+
+    return ''.join(result)
+
+
+def unhighlight_regions(markup):
+    """
+    Removes the regions highlighted by highlight_regions from a line of
+    HTML markup, returning the markup as it was.
+    """
+    return HIGHLIGHTED_REGION_RE.sub(r'\1', markup)
+
+
 def convert_to_utf8(s, enc):
     """
     Returns the passed string as a unicode string. If conversion to UTF-8
@@ -343,18 +547,16 @@ def get_original_file(filediff):
         def fetch_file(file, revision):
             log_timer = log_timed("Fetching file '%s' r%s from %s" %
                                   (file, revision, repository))
-            data = tool.get_file(file, revision)
+            data = repository.get_file(file, revision)
             data = convert_line_endings(data)
             log_timer.done()
             return data
 
         repository = filediff.diffset.repository
-        tool = repository.get_scmtool()
         file = filediff.source_file
         revision = filediff.source_revision
 
-        key = "%s:%s:%s" % (urlquote(filediff.diffset.repository.path),
-                            urlquote(file), urlquote(revision))
+        key = _get_original_file_cache_key(repository, file, revision)
 
         # We wrap the result of get_file in a list and then return the first
         # element after getting the result from the cache. This prevents the
@@ -369,153 +571,214 @@ def get_original_file(filediff):
 
     # If there's a parent diff set, apply it to the buffer.
     if filediff.parent_diff:
-        data = patch(filediff.parent_diff, data, filediff.source_file)
+        data = get_cached_patched_file(data, filediff.parent_diff_hash_id,
+                                       lambda: filediff.parent_diff,
+                                       filediff.source_file)
 
     return data
 
 
+def prefetch_original_files(repository, files):
+    """
+    Fetches several original files from a repository at once, caching them.
+
+    ``files`` is a list of (path, revision) tuples. Any files that aren't
+    already cached are fetched in a single call to SCMTool.get_files, which
+    may use one command or connection for all of them. The results are
+    cached the same way get_original_file caches them, so that later calls
+    don't have to go back to the repository one file at a time.
+
+    SCM exceptions are passed back to the caller.
+    """
+    keys = []
+    seen_keys = set()
+    files_to_fetch = []
+
+    for file, revision in files:
+        if revision == PRE_CREATION:
+            continue
+
+        key = _get_original_file_cache_key(repository, file, revision)
+
+        if key not in seen_keys and not cache.has_key(make_cache_key(key)):
+            keys.append(key)
+            seen_keys.add(key)
+            files_to_fetch.append((file, revision))
+
+    if not files_to_fetch:
+        return
+
+    log_timer = log_timed("Fetching %d files from %s" %
+                          (len(files_to_fetch), repository))
+    contents = repository.get_files(files_to_fetch)
+    log_timer.done()
+
+    for key, data in zip(keys, contents):
+        data = convert_line_endings(data)
+        cache_memoize(key, lambda: [data], force_overwrite=True,
+                      large_data=True)
+
+
+def _get_original_file_cache_key(repository, file, revision):
+    return "%s:%s:%s" % (urlquote(repository.path), urlquote(file),
+                         urlquote(revision))
+
+
 def get_patched_file(buffer, filediff):
-    return patch(filediff.diff, buffer, filediff.dest_file)
+    return get_cached_patched_file(buffer, filediff.diff_hash_id,
+                                   lambda: filediff.diff, filediff.dest_file)
 
 
-def register_interesting_lines_for_filename(differ, filename):
-    """Registers regexes for interesting lines to a differ based on filename.
+def get_cached_patched_file(buffer, diff_hash, get_diff, filename):
+    """
+    Returns a patched file, looking it up in the patched file cache first.
 
-    This will add watches for headers (functions, classes, etc.) to the diff
-    viewer. The regular expressions used are based on the filename provided.
+    Patched files are content-addressed by the SHA1 of the original buffer
+    and the SHA1 of the diff (which is the FileDiffData hash, when
+    available). They're looked up in the Django cache first and then, if
+    configured, in the on-disk patched file cache directory. Only on a miss
+    in both will the diff actually be applied.
+
+    ``get_diff`` is a function returning the diff, so that the diff doesn't
+    have to be loaded from the database on a cache hit.
     """
-    # Add any interesting lines we may want to show.
-    regexes = []
+    if not diff_hash:
+        diff = get_diff()
 
-    if file in HEADER_REGEX_ALIASES:
-        regexes = HEADER_REGEXES[HEADER_REGEX_ALIASES[filename]]
+        if diff.strip() == "":
+            return buffer
+
+        diff_hash = hashlib.sha1(diff).hexdigest()
+
+    _incr_patched_file_cache_stat('requests')
+
+    if isinstance(buffer, unicode):
+        buffer_hash = hashlib.sha1(buffer.encode('utf-8')).hexdigest()
     else:
-        basename, ext = os.path.splitext(filename)
+        buffer_hash = hashlib.sha1(buffer).hexdigest()
 
-        if ext in HEADER_REGEXES:
-            regexes = HEADER_REGEXES[ext]
-        elif ext in HEADER_REGEX_ALIASES:
-            regexes = HEADER_REGEXES[HEADER_REGEX_ALIASES[ext]]
+    key = 'patched-file-%s-%s' % (buffer_hash, diff_hash)
+    missed = []
 
-    for regex in regexes:
-        differ.add_interesting_line_regex('header', regex)
+    def lookup():
+        missed.append(True)
+        store = _get_patched_file_store()
+        data = None
 
+        if store:
+            data = store.get_by_key(key)
 
-def get_chunks(diffset, filediff, interfilediff, force_interdiff,
-               enable_syntax_highlighting):
-    def diff_line(vlinenum, oldlinenum, newlinenum, oldline, newline,
-                  oldmarkup, newmarkup):
-        # This function accesses the variable meta, defined in an outer context.
-        if oldline and newline and oldline != newline:
-            oldregion, newregion = get_line_changed_regions(oldline, newline)
+        if data is not None:
+            _incr_patched_file_cache_stat('disk_hits')
         else:
-            oldregion = newregion = []
+            _incr_patched_file_cache_stat('misses')
+            data = patch(get_diff(), buffer, filename)
 
-        result = [vlinenum,
-                  oldlinenum or '', mark_safe(oldmarkup or ''), oldregion,
-                  newlinenum or '', mark_safe(newmarkup or ''), newregion,
-                  (oldlinenum, newlinenum) in meta['whitespace_lines']]
+            if store:
+                store.set_by_key(key, data)
 
-        if oldlinenum and oldlinenum in meta.get('moved', {}):
-            destination = meta["moved"][oldlinenum]
-            result.append(destination)
-        elif newlinenum and newlinenum in meta.get('moved', {}):
-            destination = meta["moved"][newlinenum]
-            result.append(destination)
+        return [data]
 
-        return result
+    # See get_original_file for why this is wrapped in a list.
+    data = cache_memoize(key, lookup, large_data=True)[0]
 
-    def new_chunk(lines, start, end, collapsable=False,
-                  tag='equal', meta=None):
-        if not meta:
-            meta = {}
+    if not missed:
+        _incr_patched_file_cache_stat('hits')
 
-        left_headers = list(get_interesting_headers(differ, lines,
-                                                    start, end - 1, False))
-        right_headers = list(get_interesting_headers(differ, lines,
-                                                     start, end - 1, True))
+    return data
 
-        meta['left_headers'] = left_headers
-        meta['right_headers'] = right_headers
 
-        if left_headers:
-            last_header[0] = left_headers[-1][1]
+def _get_patched_file_store():
+    """
+    Returns the on-disk store for patched files, or None if it's disabled.
 
-        if right_headers:
-            last_header[1] = right_headers[-1][1]
+    Patched files are kept in a FileStore, so the least recently used ones
+    are removed once the directory grows past its maximum size.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+    cache_dir = siteconfig.get('diffviewer_patched_file_cache_dir')
 
-        if (collapsable and end < len(lines) and
-            (last_header[0] or last_header[1])):
-            meta['headers'] = [
-                (last_header[0] or "").strip(),
-                (last_header[1] or "").strip(),
-            ]
+    if not cache_dir:
+        return None
 
-        return {
-            'lines': lines[start:end],
-            'numlines': end - start,
-            'change': tag,
-            'collapsable': collapsable,
-            'meta': meta,
-        }
+    # The default is given here too, in case the site configuration's
+    # defaults haven't been registered.
+    return get_store(
+        cache_dir,
+        siteconfig.get('diffviewer_patched_file_cache_max_size', 1024))
 
-    def get_interesting_headers(differ, lines, start, end, is_modified_file):
-        """Returns all headers for a region of a diff.
 
-        This scans for all headers that fall within the specified range
-        of the specified lines on both the original and modified files.
-        """
-        possible_functions = differ.get_interesting_lines('header',
-                                                          is_modified_file)
+def _incr_patched_file_cache_stat(name):
+    key = 'patched-file-cache-stats-%s' % name
 
-        if not possible_functions:
-            raise StopIteration
+    try:
+        # The counters are given the same long expiration as everything
+        # else, rather than the backend's default, so that they don't
+        # disappear while the rest of the cache is still warm.
+        cache.add(key, 0, settings.CACHE_EXPIRATION_TIME)
+        cache.incr(key)
+    except ValueError:
+        # The cache backend doesn't support counters, or the key was
+        # evicted between the add and the incr.
+        pass
 
-        try:
-            if is_modified_file:
-                last_index = last_header_index[1]
-                i1 = lines[start][4]
-                i2 = lines[end - 1][4]
-            else:
-                last_index = last_header_index[0]
-                i1 = lines[start][1]
-                i2 = lines[end - 1][1]
-        except IndexError:
-            raise StopIteration
 
-        for i in xrange(last_index, len(possible_functions)):
-            linenum, line = possible_functions[i]
-            linenum += 1
+def get_patched_file_cache_stats():
+    """
+    Returns hit and miss statistics for the patched file cache.
 
-            if linenum > i2:
-                break
-            elif linenum >= i1:
-                last_index = i
-                yield (linenum, line)
+    The result is a dictionary with the number of requests, hits and
+    misses, the number of hits that came from the on-disk cache, and the
+    hit and miss rates as percentages.
 
-        if is_modified_file:
-            last_header_index[1] = last_index
-        else:
-            last_header_index[0] = last_index
+    Disk hits are counted separately from hits in the main cache. The
+    rates are based on the hits and misses, rather than the requests, so
+    that they stay consistent even if one counter is evicted before the
+    others.
+    """
+    stats = {}
 
-    def apply_pygments(data, filename):
-        # XXX Guessing is preferable but really slow, especially on XML
-        #     files.
-        #if filename.endswith(".xml"):
-        lexer = get_lexer_for_filename(filename, stripnl=False,
-                                       encoding='utf-8')
-        #else:
-        #    lexer = guess_lexer_for_filename(filename, data, stripnl=False)
+    for name in ('requests', 'hits', 'disk_hits', 'misses'):
+        stats[name] = cache.get('patched-file-cache-stats-%s' % name) or 0
 
-        try:
-            # This is only available in 0.7 and higher
-            lexer.add_filter('codetagify')
-        except AttributeError:
-            pass
+    stats['hits'] += stats['disk_hits']
+    total = stats['hits'] + stats['misses']
+
+    if total == 0:
+        stats['hit_rate'] = 0
+        stats['miss_rate'] = 0
+    else:
+        stats['hit_rate'] = 100 * stats['hits'] / total
+        stats['miss_rate'] = 100 * stats['misses'] / total
+
+    return stats
+
+
+def register_interesting_lines_for_filename(differ, filename):
+    """Registers regexes for interesting lines to a differ based on filename.
+
+    This will add watches for headers (functions, classes, etc.) to the diff
+    viewer. The regular expressions used are based on the filename provided.
+    """
+    # Add any interesting lines we may want to show.
+    regexes = []
+
+    if file in HEADER_REGEX_ALIASES:
+        regexes = HEADER_REGEXES[HEADER_REGEX_ALIASES[filename]]
+    else:
+        basename, ext = os.path.splitext(filename)
+
+        if ext in HEADER_REGEXES:
+            regexes = HEADER_REGEXES[ext]
+        elif ext in HEADER_REGEX_ALIASES:
+            regexes = HEADER_REGEXES[HEADER_REGEX_ALIASES[ext]]
 
-        return pygments.highlight(data, lexer, NoWrapperHtmlFormatter()).splitlines()
+    for regex in regexes:
+        differ.add_interesting_line_regex('header', regex)
 
 
+def get_chunks(diffset, filediff, interfilediff, force_interdiff,
+               enable_syntax_highlighting):
     # There are three ways this function is called:
     #
     #     1) filediff, no interfilediff
@@ -550,8 +813,21 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
 
     assert filediff
 
-    file = filediff.source_file
+    old, new = get_chunk_file_contents(filediff, interfilediff,
+                                       force_interdiff)
+    options = get_chunk_generation_options(diffset, filediff, interfilediff,
+                                           enable_syntax_highlighting)
+
+    for chunk in generate_chunks(old, new, **options):
+        yield chunk
+
+
+def get_chunk_file_contents(filediff, interfilediff, force_interdiff):
+    """
+    Returns the old and new file contents to generate chunks from.
 
+    See get_chunks for the different ways this can be called.
+    """
     old = get_original_file(filediff)
     new = get_patched_file(old, filediff)
 
@@ -563,120 +839,491 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
         # Basically, revert the change.
         old, new = new, old
 
-    encoding = diffset.repository.encoding or 'iso-8859-15'
-    old = convert_to_utf8(old, encoding)
-    new = convert_to_utf8(new, encoding)
-
-    # Normalize the input so that if there isn't a trailing newline, we add
-    # it.
-    if old and old[-1] != '\n':
-        old += '\n'
-
-    if new and new[-1] != '\n':
-        new += '\n'
-
-    a = NEWLINES_RE.split(old or '')
-    b = NEWLINES_RE.split(new or '')
-
-    # Remove the trailing newline, now that we've split this. This will
-    # prevent a duplicate line number at the end of the diff.
-    del(a[-1])
-    del(b[-1])
+    return old, new
 
-    a_num_lines = len(a)
-    b_num_lines = len(b)
 
-    markup_a = markup_b = None
+def get_chunk_generation_options(diffset, filediff, interfilediff,
+                                 enable_syntax_highlighting):
+    """
+    Returns the keyword arguments to pass to generate_chunks for a filediff.
 
+    This looks up everything from the site configuration, repository and
+    SCMTool that generate_chunks needs.
+    """
     siteconfig = SiteConfiguration.objects.get_current()
 
-    threshold = siteconfig.get('diffviewer_syntax_highlighting_threshold')
-
-    if threshold and (a_num_lines > threshold or b_num_lines > threshold):
-        enable_syntax_highlighting = False
+    source_display_name = filediff.source_file
+    dest_display_name = filediff.dest_file
 
     if enable_syntax_highlighting:
-        repository = filediff.diffset.repository
-        tool = repository.get_scmtool()
-        source_file = tool.normalize_path_for_display(filediff.source_file)
-        dest_file = tool.normalize_path_for_display(filediff.dest_file)
-        try:
-            # TODO: Try to figure out the right lexer for these files
-            #       once instead of twice.
-            markup_a = apply_pygments(old or '', source_file)
-            markup_b = apply_pygments(new or '', dest_file)
-        except:
-            pass
-
-    if not markup_a:
-        markup_a = NEWLINES_RE.split(escape(old))
-
-    if not markup_b:
-        markup_b = NEWLINES_RE.split(escape(new))
-
-    linenum = 1
-    last_header = [None, None]
-    last_header_index = [0, 0]
+        tool = filediff.diffset.repository.get_scmtool()
+        source_display_name = \
+            tool.normalize_path_for_display(filediff.source_file)
+        dest_display_name = tool.normalize_path_for_display(filediff.dest_file)
 
     ignore_space = True
+
     for pattern in siteconfig.get("diffviewer_include_space_patterns"):
-        if fnmatch.fnmatch(file, pattern):
+        if fnmatch.fnmatch(filediff.source_file, pattern):
             ignore_space = False
             break
 
-    differ = Differ(a, b, ignore_space=ignore_space,
-                    compat_version=diffset.diffcompat)
-
-    # Register any regexes for interesting lines we may want to show.
-    register_interesting_lines_for_filename(differ, file)
-
-    # TODO: Make this back into a preference if people really want it.
-    context_num_lines = siteconfig.get("diffviewer_context_num_lines")
-    collapse_threshold = 2 * context_num_lines + 3
-
     if interfilediff:
-        log_timer = log_timed(
-            "Generating diff chunks for interdiff ids %s-%s (%s)" %
-            (filediff.id, interfilediff.id, filediff.source_file))
+        description = "interdiff ids %s-%s (%s)" % (
+            filediff.id, interfilediff.id, filediff.source_file)
     else:
-        log_timer = log_timed(
-            "Generating diff chunks for filediff id %s (%s)" %
-            (filediff.id, filediff.source_file))
+        description = "filediff id %s (%s)" % (
+            filediff.id, filediff.source_file)
+
+    return {
+        'filename': filediff.source_file,
+        'source_display_name': source_display_name,
+        'dest_display_name': dest_display_name,
+        'encoding': diffset.repository.encoding or 'iso-8859-15',
+        'compat_version': diffset.diffcompat,
+        'enable_syntax_highlighting': enable_syntax_highlighting,
+        'syntax_highlighting_threshold':
+            siteconfig.get('diffviewer_syntax_highlighting_threshold'),
+        'ignore_space': ignore_space,
+
+        # TODO: Make this back into a preference if people really want it.
+        'context_num_lines': siteconfig.get("diffviewer_context_num_lines"),
+        'description': description,
+    }
+
+
+def generate_chunks(old, new, filename, source_display_name,
+                    dest_display_name, encoding, compat_version,
+                    enable_syntax_highlighting, syntax_highlighting_threshold,
+                    ignore_space, context_num_lines, description):
+    """
+    Generates the chunks for the differences between two files.
 
-    for tag, i1, i2, j1, j2, meta in opcodes_with_metadata(differ):
-        oldlines = markup_a[i1:i2]
-        newlines = markup_b[j1:j2]
-        numlines = max(len(oldlines), len(newlines))
+    This is a generator that does all the work for get_chunks once the
+    contents of both files are known. It doesn't make use of the database
+    or the site configuration (everything needed is passed in, usually
+    from get_chunk_generation_options), so it's safe to run in a worker
+    process.
 
-        lines = map(diff_line,
-                    xrange(linenum, linenum + numlines),
-                    xrange(i1 + 1, i2 + 1), xrange(j1 + 1, j2 + 1),
-                    a[i1:i2], b[j1:j2], oldlines, newlines)
+    All the lines of the file are generated at once. The diff viewer
+    instead uses generate_chunk_layout and generate_chunk_lines to
+    generate only the parts of large files that are being shown.
+    """
+    layout = generate_chunk_layout(old, new, filename, encoding,
+                                   compat_version, ignore_space,
+                                   context_num_lines, description)
+    chunk_lines = dict(generate_chunk_lines(
+        old, new, layout['chunks'], layout['ranges'],
+        1, layout['num_lines'] + 1,
+        source_display_name=source_display_name,
+        dest_display_name=dest_display_name,
+        encoding=encoding,
+        enable_syntax_highlighting=enable_syntax_highlighting,
+        syntax_highlighting_threshold=syntax_highlighting_threshold))
+
+    for i, chunk in enumerate(layout['chunks']):
+        chunk['lines'] = chunk_lines.get(i, [])
+        yield chunk
+
+
+def generate_chunk_layout(old, new, filename, encoding, compat_version,
+                          ignore_space, context_num_lines, description,
+                          **kwargs):
+    """
+    Generates the layout of the chunks for the differences between two files.
 
-        if tag == 'equal' and numlines > collapse_threshold:
-            last_range_start = numlines - context_num_lines
+    This diffs the files and works out where each chunk starts and ends,
+    along with its metadata, but doesn't generate the lines in the chunks.
+    Those are generated separately by generate_chunk_lines, a range of
+    lines at a time, so that the whole of a large file doesn't have to be
+    highlighted and rendered in order to show part of it.
 
-            if linenum == 1:
-                yield new_chunk(lines, 0, last_range_start, True)
-                yield new_chunk(lines, last_range_start, numlines)
-            else:
-                yield new_chunk(lines, 0, context_num_lines)
+    This returns a dictionary with the following keys:
 
-                if i2 == a_num_lines and j2 == b_num_lines:
-                    yield new_chunk(lines, context_num_lines, numlines, True)
-                else:
-                    yield new_chunk(lines, context_num_lines,
-                                    last_range_start, True)
-                    yield new_chunk(lines, last_range_start, numlines)
+      ============= ========================================================
+      Key           Description
+      ============= ========================================================
+      ``chunks``    The list of chunks, without their ``lines``.
+      ``ranges``    A (first virtual line, old start, old end, new start,
+                    new end) tuple for each chunk. The file positions are
+                    0-based indexes into the lines of each file.
+      ``num_lines`` The total number of virtual lines in the diff.
+      ============= ========================================================
+
+    Any other options from get_chunk_generation_options are ignored, so
+    that the same options can be passed here and to generate_chunk_lines.
+    """
+    def get_line_number(index, numlines, side_start, side_end):
+        # This mirrors looking up the real line number of a line from the
+        # list of all lines in an opcode, including Python's handling of
+        # negative indexes. Lines past the end of one side of the opcode
+        # have no line number on that side.
+        if index < 0:
+            index += numlines
+
+        if not 0 <= index < numlines:
+            raise IndexError
+
+        if index < side_end - side_start:
+            return side_start + index + 1
         else:
-            yield new_chunk(lines, 0, numlines, False, tag, meta)
+            return ''
 
-        linenum += numlines
+    def get_interesting_headers(opcode, start, end, is_modified_file):
+        """Returns all headers for a region of a diff.
 
-    log_timer.done()
+        This scans for all headers that fall within the specified range
+        of the specified lines on both the original and modified files.
+        """
+        possible_functions = differ.get_interesting_lines('header',
+                                                          is_modified_file)
 
+        if not possible_functions:
+            return []
 
-def is_valid_move_range(lines):
+        tag, i1, i2, j1, j2, numlines = opcode
+
+        try:
+            if is_modified_file:
+                last_index = last_header_index[1]
+                first_linenum = get_line_number(start, numlines, j1, j2)
+                last_linenum = get_line_number(end - 1, numlines, j1, j2)
+            else:
+                last_index = last_header_index[0]
+                first_linenum = get_line_number(start, numlines, i1, i2)
+                last_linenum = get_line_number(end - 1, numlines, i1, i2)
+        except IndexError:
+            return []
+
+        headers = []
+
+        for i in xrange(last_index, len(possible_functions)):
+            linenum, line = possible_functions[i]
+            linenum += 1
+
+            if linenum > last_linenum:
+                break
+            elif linenum >= first_linenum:
+                last_index = i
+                headers.append((linenum, line))
+
+        if is_modified_file:
+            last_header_index[1] = last_index
+        else:
+            last_header_index[0] = last_index
+
+        return headers
+
+    def new_chunk(opcode, start, end, collapsable=False,
+                  tag='equal', meta=None):
+        if not meta:
+            meta = {}
+
+        i1, i2, j1, j2, numlines = opcode[1:]
+
+        left_headers = get_interesting_headers(opcode, start, end - 1, False)
+        right_headers = get_interesting_headers(opcode, start, end - 1, True)
+
+        meta['left_headers'] = left_headers
+        meta['right_headers'] = right_headers
+
+        if left_headers:
+            last_header[0] = left_headers[-1][1]
+
+        if right_headers:
+            last_header[1] = right_headers[-1][1]
+
+        if (collapsable and end < numlines and
+            (last_header[0] or last_header[1])):
+            meta['headers'] = [
+                (last_header[0] or "").strip(),
+                (last_header[1] or "").strip(),
+            ]
+
+        chunks.append({
+            'numlines': end - start,
+            'change': tag,
+            'collapsable': collapsable,
+            'meta': meta,
+        })
+        ranges.append((linenum + start,
+                       i1 + min(start, i2 - i1), i1 + min(end, i2 - i1),
+                       j1 + min(start, j2 - j1), j1 + min(end, j2 - j1)))
+
+    a = _prepare_chunk_file(old, encoding)[0]
+    b = _prepare_chunk_file(new, encoding)[0]
+
+    a_num_lines = len(a)
+    b_num_lines = len(b)
+
+    chunks = []
+    ranges = []
+    linenum = 1
+    last_header = [None, None]
+    last_header_index = [0, 0]
+
+    differ = Differ(a, b, ignore_space=ignore_space,
+                    compat_version=compat_version)
+
+    # Register any regexes for interesting lines we may want to show.
+    register_interesting_lines_for_filename(differ, filename)
+
+    collapse_threshold = 2 * context_num_lines + 3
+
+    log_timer = log_timed("Generating diff chunk layout for %s" % description)
+
+    for tag, i1, i2, j1, j2, meta in opcodes_with_metadata(differ):
+        numlines = max(i2 - i1, j2 - j1)
+        opcode = (tag, i1, i2, j1, j2, numlines)
+
+        if tag == 'equal' and numlines > collapse_threshold:
+            last_range_start = numlines - context_num_lines
+
+            if linenum == 1:
+                new_chunk(opcode, 0, last_range_start, True)
+                new_chunk(opcode, last_range_start, numlines)
+            else:
+                new_chunk(opcode, 0, context_num_lines)
+
+                if i2 == a_num_lines and j2 == b_num_lines:
+                    new_chunk(opcode, context_num_lines, numlines, True)
+                else:
+                    new_chunk(opcode, context_num_lines, last_range_start,
+                              True)
+                    new_chunk(opcode, last_range_start, numlines)
+        else:
+            new_chunk(opcode, 0, numlines, False, tag, meta)
+
+        linenum += numlines
+
+    log_timer.done()
+
+    return {
+        'chunks': chunks,
+        'ranges': ranges,
+        'num_lines': linenum - 1,
+    }
+
+
+def generate_chunk_lines(old, new, chunks, ranges, first_line, last_line,
+                         source_display_name, dest_display_name, encoding,
+                         enable_syntax_highlighting,
+                         syntax_highlighting_threshold, **kwargs):
+    """
+    Generates the lines for part of a diff laid out by generate_chunk_layout.
+
+    Only the lines from the virtual line numbers first_line up to (but not
+    including) last_line are generated, and only the parts of the files
+    shown in those lines are syntax highlighted. See get_highlighted_lines
+    for how highlighting works for large files.
+
+    This returns a list of (chunk index, lines) tuples for each chunk that
+    overlaps the range. See get_file_chunks_in_range for the format of the
+    lines. Like generate_chunks, this is safe to run in a worker process.
+    """
+    return _generate_chunk_lines(_prepare_chunk_file(old, encoding),
+                                 _prepare_chunk_file(new, encoding),
+                                 chunks, ranges, first_line, last_line,
+                                 source_display_name, dest_display_name,
+                                 enable_syntax_highlighting,
+                                 syntax_highlighting_threshold)
+
+
+def _generate_chunk_lines(old_file, new_file, chunks, ranges, first_line,
+                          last_line, source_display_name, dest_display_name,
+                          enable_syntax_highlighting,
+                          syntax_highlighting_threshold, markup_cache=None,
+                          **kwargs):
+    """
+    Generates the lines for part of a diff from prepared files.
+
+    This does the work for generate_chunk_lines. old_file and new_file are
+    the (lines, content hash) tuples returned by _prepare_chunk_file, so
+    that the files don't have to be prepared again for each window of
+    lines. markup_cache is passed to get_highlighted_lines for the same
+    reason.
+    """
+    def diff_line(vlinenum, oldlinenum, newlinenum, oldline, newline,
+                  oldmarkup, newmarkup):
+        # This function accesses the variables whitespace_lines and moved,
+        # defined in an outer context.
+        if oldline and newline and oldline != newline:
+            oldregion, newregion = get_line_changed_regions(oldline, newline)
+
+            # The changed regions are highlighted once here and cached with
+            # the rest of the line, so that templates don't have to do it on
+            # every render.
+            oldmarkup = highlight_regions(oldmarkup, oldregion)
+            newmarkup = highlight_regions(newmarkup, newregion)
+        else:
+            oldregion = newregion = []
+
+        result = [vlinenum,
+                  oldlinenum or '', mark_safe(oldmarkup or ''), oldregion,
+                  newlinenum or '', mark_safe(newmarkup or ''), newregion,
+                  (oldlinenum, newlinenum) in whitespace_lines]
+
+        if oldlinenum and oldlinenum in moved:
+            result.append(moved[oldlinenum])
+        elif newlinenum and newlinenum in moved:
+            result.append(moved[newlinenum])
+
+        return result
+
+    # Find the parts of each chunk, and of each file, within the range.
+    spans = []
+
+    for i, (chunk_first_line, i1, i2, j1, j2) in enumerate(ranges):
+        chunk_last_line = chunk_first_line + chunks[i]['numlines']
+
+        if chunk_first_line >= last_line or chunk_last_line <= first_line:
+            continue
+
+        start = max(first_line, chunk_first_line) - chunk_first_line
+        end = min(last_line, chunk_last_line) - chunk_first_line
+
+        spans.append((i, chunk_first_line + start,
+                      i1 + min(start, i2 - i1), i1 + min(end, i2 - i1),
+                      j1 + min(start, j2 - j1), j1 + min(end, j2 - j1)))
+
+    if not spans:
+        return []
+
+    a, a_hash = old_file
+    b, b_hash = new_file
+
+    a_start, a_end = spans[0][2], spans[-1][3]
+    b_start, b_end = spans[0][4], spans[-1][5]
+
+    markup_a = markup_b = None
+
+    threshold = syntax_highlighting_threshold
+
+    if threshold and (len(a) > threshold or len(b) > threshold):
+        enable_syntax_highlighting = False
+
+    if enable_syntax_highlighting:
+        try:
+            # TODO: Try to figure out the right lexer for these files
+            #       once instead of twice.
+            markup_a = get_highlighted_lines(a, a_hash, a_start, a_end,
+                                             source_display_name,
+                                             markup_cache)
+            markup_b = get_highlighted_lines(b, b_hash, b_start, b_end,
+                                             dest_display_name,
+                                             markup_cache)
+        except:
+            pass
+
+    if not markup_a:
+        markup_a = [escape(line) for line in a[a_start:a_end]]
+
+    if not markup_b:
+        markup_b = [escape(line) for line in b[b_start:b_end]]
+
+    log_timer = log_timed("Generating diff chunk lines %s-%s" %
+                          (first_line, last_line - 1))
+
+    result = []
+
+    for i, vlinenum, i1, i2, j1, j2 in spans:
+        meta = chunks[i]['meta']
+        whitespace_lines = set(meta.get('whitespace_lines', []))
+        moved = meta.get('moved', {})
+
+        result.append((i, map(diff_line,
+                              xrange(vlinenum,
+                                     vlinenum + max(i2 - i1, j2 - j1)),
+                              xrange(i1 + 1, i2 + 1), xrange(j1 + 1, j2 + 1),
+                              a[i1:i2], b[j1:j2],
+                              markup_a[i1 - a_start:i2 - a_start],
+                              markup_b[j1 - b_start:j2 - b_start])))
+
+    log_timer.done()
+
+    return result
+
+
+def get_highlighted_lines(lines, content_hash, start, end, filename,
+                          markup_cache=None):
+    """
+    Returns the syntax-highlighted markup for lines[start:end] of a file.
+
+    content_hash is the SHA1 of the file's content, as returned by
+    _prepare_chunk_file. The whole file is highlighted at once, so that
+    constructs spanning many lines (such as multi-line comments) are
+    highlighted correctly, and its lines of markup are cached by the
+    content hash, the name of the lexer and the version of Pygments.
+    Nothing about the diff is part of the key, so the markup is shared by
+    every FileDiff, diff revision and interdiff showing the same file, and
+    the file only needs to be highlighted once for all of its chunk
+    windows.
+
+    If markup_cache is given, it's a dictionary that the file's lines of
+    markup are kept in once they've been loaded from the cache, so that
+    generating several windows of a file doesn't load and unpickle the
+    whole file's markup for each one.
+    """
+    if start >= end:
+        return []
+
+    # XXX Guessing is preferable but really slow, especially on XML
+    #     files.
+    #if filename.endswith(".xml"):
+    lexer = get_lexer_for_filename(filename, stripnl=False,
+                                   encoding='utf-8')
+    #else:
+    #    lexer = guess_lexer_for_filename(filename, data, stripnl=False)
+
+    try:
+        # This is only available in 0.7 and higher
+        lexer.add_filter('codetagify')
+    except AttributeError:
+        pass
+
+    key = 'diff-highlight-%s-%s-%s' % (content_hash, urlquote(lexer.name),
+                                       pygments.__version__)
+
+    if markup_cache is not None and key in markup_cache:
+        markup = markup_cache[key]
+    else:
+        markup = cache_memoize(
+            key,
+            lambda: pygments.highlight('\n'.join(lines) + '\n', lexer,
+                                       NoWrapperHtmlFormatter()).splitlines(),
+            large_data=True)
+
+        if markup_cache is not None:
+            markup_cache[key] = markup
+
+    return markup[start:end]
+
+
+def _prepare_chunk_file(data, encoding):
+    """
+    Prepares a file for generating chunks.
+
+    The file is converted to UTF-8 and split into lines for diffing. This
+    returns a tuple of the lines and the SHA1 of the converted content, for
+    use with get_highlighted_lines.
+    """
+    data = convert_to_utf8(data, encoding)
+
+    # Normalize the input so that if there isn't a trailing newline, we add
+    # it.
+    if data and data[-1] != '\n':
+        data += '\n'
+
+    lines = NEWLINES_RE.split(data or '')
+
+    # Remove the trailing newline, now that we've split this. This will
+    # prevent a duplicate line number at the end of the diff.
+    del(lines[-1])
+
+    return lines, hashlib.sha1(data).hexdigest()
+
+
+def is_valid_move_range(lines):
     """Determines if a move range is valid and should be included.
 
     This performs some tests to try to eliminate trivial changes that
@@ -705,8 +1352,9 @@ def opcodes_with_metadata(differ):
     This returns a list of opcodes as tuples in the form of
     (tag, i1, i2, j1, j2, meta).
     """
+    a, b = differ.a, differ.b
     groups = []
-    removes = {}
+    deletes = []
     inserts = []
 
     for tag, i1, i2, j1, j2 in differ.get_opcodes():
@@ -723,8 +1371,7 @@ def opcodes_with_metadata(differ):
             assert (i2 - i1) == (j2 - j1)
 
             for i, j in zip(xrange(i1, i2), xrange(j1, j2)):
-                if (WHITESPACE_RE.sub("", differ.a[i]) ==
-                    WHITESPACE_RE.sub("", differ.b[j])):
+                if _remove_whitespace(a[i]) == _remove_whitespace(b[j]):
                     # Both original lines are equal when removing all
                     # whitespace, so include their original line number in
                     # the meta dict.
@@ -738,178 +1385,163 @@ def opcodes_with_metadata(differ):
         group = (tag, i1, i2, j1, j2, meta)
         groups.append(group)
 
-        # Store delete/insert ranges for later lookup. We will be building
-        # keys that in most cases will be unique for the particular block
-        # of text being inserted/deleted. There is a chance of collision,
-        # so we store a list of matching groups under that key.
-        #
-        # Later, we will loop through the keys and attempt to find insert
-        # keys/groups that match remove keys/groups.
         if tag == 'delete':
-            for i in xrange(i1, i2):
-                line = differ.a[i].strip()
-
-                if line:
-                    removes.setdefault(line, []).append((i, group))
+            deletes.append(group)
         elif tag == 'insert':
             inserts.append(group)
 
     # We now need to figure out all the moved locations.
     #
-    # At this point, we know all the inserted groups, and all the individually
-    # deleted lines. We'll be going through and finding consecutive groups
-    # of matching inserts/deletes that represent a move block.
-    #
-    # The algorithm will be documented as we go in the code.
-    #
-    # We start by looping through all the inserted groups.
+    # Each removed line is indexed by its text, with the surrounding
+    # whitespace stripped. Every distinct line of text is given a number,
+    # so that the rest of the work compares numbers instead of strings.
+    line_ids, first_removes, removed_lines, num_valid_before = \
+        _index_removed_lines(a, deletes)
+
+    # We then loop through all the inserted groups, looking for runs of
+    # consecutive inserted lines that match consecutive removed lines.
     for itag, ii1, ii2, ij1, ij2, imeta in inserts:
-        # Store some state on the range we'll be working with inside this
-        # insert group.
-        #
-        # i_move_cur is the current location inside the insert group
-        # (from ij1 through ij2).
+        # i_move_start is the first inserted line in the current run.
         #
-        # i_move_range is the current range of consecutive lines that we'll
-        # use for a move. Each line in this range has a corresponding
-        # consecutive delete line.
-        #
-        # r_move_ranges represents deleted move ranges. The key is a
-        # string in the form of "{i1}-{i2}-{j1}-{j2}", with those positions
-        # taken from the remove group for the line. The value
-        # is an array of tuples of (r_start, r_end, r_group). These values
-        # are used to quickly locate deleted lines we've found that match
-        # the inserted lines, so we can assemble ranges later.
-        i_move_cur = ij1
-        i_move_range = (i_move_cur, i_move_cur)
-        r_move_ranges = {} # key -> [(start, end, group)]
-
-        # Loop through every location from ij1 through ij2 until we've
-        # reached the end.
-        while i_move_cur <= ij2:
-            try:
-                iline = differ.b[i_move_cur].strip()
-            except IndexError:
-                iline = None
-
-            if iline is not None and iline in removes:
+        # r_move_range is the range of removed lines that the run matches,
+        # as a tuple of (r_start, r_end, r_group), or None if nothing
+        # in the run has matched yet.
+        i_move_start = ij1
+        r_move_range = None
+
+        # Loop through every location from ij1 through ij2, which is the
+        # line after the insert group.
+        for i_move_cur in xrange(ij1, ij2 + 1):
+            if i_move_cur < len(b):
+                line_id = line_ids.get(b[i_move_cur].strip())
+            else:
+                line_id = None
+
+            if line_id is not None:
                 # The inserted line at this location has a corresponding
                 # removed line.
                 #
-                # If there's already some information on removed line ranges
-                # for this particular move block we're processing then we'll
-                # update the range.
-                #
-                # The way we do that is to find each removed line that
-                # matches this inserted line, and for each of those find
-                # out if there's an existing move range that the found
-                # removed line immediately follows. If there is, we update
-                # the existing range.
-                #
-                # If there isn't any move information for this line, we'll
-                # simply add it to the move ranges.
-                for ri, rgroup in removes.get(iline, []):
-                    key = "%s-%s-%s-%s" % rgroup[1:5]
-
-                    if r_move_ranges:
-                        for i, r_move_range in \
-                            enumerate(r_move_ranges.get(key, [])):
-                            # If the remove information for the line is next in
-                            # the sequence for this calculated move range...
-                            if ri == r_move_range[1] + 1:
-                                r_move_ranges[key][i] = (r_move_range[0], ri,
-                                                         rgroup)
-                                break
-                    else:
-                        # We don't have any move ranges yet, so it's time to
-                        # build one based on any removed lines we find that
-                        # match the inserted line.
-                        r_move_ranges[key] = [(ri, ri, rgroup)]
-
-                # On to the next line in the sequence...
-                i_move_cur += 1
+                # If this is the first match in the run, the run starts
+                # at the first removed line with this text.
+                if r_move_range is None:
+                    r_start, r_group = first_removes[line_id]
+                    r_end = r_start
+                else:
+                    r_start, r_end, r_group = r_move_range
+
+                    # Otherwise, the range grows if the removed line right
+                    # after it, in the same group, has this text.
+                    if (r_end + 1 in removed_lines and
+                        removed_lines[r_end + 1][0] == line_id and
+                        removed_lines[r_end + 1][1] is r_group):
+                        r_end += 1
+
+                # A run of identical removed lines all match this one
+                # inserted line, so the range covers the whole run.
+                r_end = removed_lines[r_end][2]
+                r_move_range = (r_start, r_end, r_group)
             else:
-                # We've reached the very end of the insert group. See if
-                # we have anything that looks like a move.
-                if r_move_ranges:
-                    r_move_range = None
-
-                    # Go through every range of lines we've found and
-                    # find the longest.
-                    #
-                    # The longest move range wins. If we find two ranges that
-                    # are equal, though, we'll ignore both. The idea is that
-                    # if we have two identical moves, then it's probably
-                    # common enough code that we don't want to show the move.
-                    # An example might be some standard part of a comment
-                    # block, with no real changes in content.
-                    #
-                    # Note that with the current approach, finding duplicate
-                    # moves doesn't cause us to reset the winning range
-                    # to the second-highest identical match. We may want to
-                    # do that down the road, but it means additional state,
-                    # and this is hopefully uncommon enough to not be a real
-                    # problem.
-                    for ranges in r_move_ranges.itervalues():
-                        for r1, r2, rgroup in ranges:
-                            if not r_move_range:
-                                r_move_range = (r1, r2, rgroup)
-                            else:
-                                len1 = r_move_range[2] - r_move_range[1]
-                                len2 = r2 - r1
-
-                                if len1 < len2:
-                                    r_move_range = (r1, r2, rgroup)
-                                elif len1 == len2:
-                                    # If there are two that are the same, it
-                                    # may be common code that we don't want to
-                                    # see moves for. Comments, for example.
-                                    r_move_range = None
-
-                    # If we have a move range, see if it's one we want to
-                    # include or filter out. Some moves are not impressive
-                    # enough to display. For example, a small portion of a
-                    # comment, or whitespace-only changes.
-                    if (r_move_range and
-                        is_valid_move_range(
-                            differ.a[r_move_range[0]:r_move_range[1]])):
-
-                        # Rebuild the insert and remove ranges based on
-                        # where we are now and which range we won.
-                        #
-                        # The new ranges will be actual lists of positions,
-                        # rather than a beginning and end. These will be
-                        # provided to the renderer.
-                        #
-                        # The ranges expected by the renderers are 1-based,
-                        # whereas our calculations for this algorithm are
-                        # 0-based, so we add 1 to the numbers.
-                        #
-                        # The upper boundaries passed to the range() function
-                        # must actually be one higher than the value we want.
-                        # So, for r_move_range, we actually increment by 2.
-                        # We only increment i_move_cur by one, because
-                        # i_move_cur already factored in the + 1 by being
-                        # at the end of the while loop.
-                        i_move_range = range(i_move_range[0] + 1,
-                                             i_move_cur + 1)
-                        r_move_range = range(r_move_range[0] + 1,
-                                             r_move_range[1] + 2)
-
-                        rmeta = rgroup[-1]
-                        rmeta.setdefault('moved', {}).update(
-                            dict(zip(r_move_range, i_move_range)))
-                        imeta.setdefault('moved', {}).update(
-                            dict(zip(i_move_range, r_move_range)))
-
-                # Reset the state for the next range.
-                i_move_cur += 1
-                i_move_range = (i_move_cur, i_move_cur)
-                r_move_ranges = {}
+                # We've reached the end of the run. See if we have anything
+                # that looks like a move.
+                #
+                # Some moves are not impressive enough to display. For
+                # example, a small portion of a comment, or whitespace-only
+                # changes. These are filtered out the same way that
+                # is_valid_move_range does, using the counts of lines that
+                # would be valid on their own.
+                if (r_move_range and
+                    num_valid_before[r_move_range[1]] >
+                    num_valid_before[r_move_range[0]]):
+                    r_start, r_end, r_group = r_move_range
+
+                    # The inserted lines are paired up with the removed
+                    # lines, in order, up to the shorter of the two.
+                    num_lines = min(i_move_cur - i_move_start,
+                                    r_end - r_start + 1)
+
+                    # The ranges expected by the renderers are 1-based,
+                    # whereas our calculations for this algorithm are
+                    # 0-based, so we add 1 to the numbers.
+                    i_move_range = range(i_move_start + 1,
+                                         i_move_start + num_lines + 1)
+                    r_move_range = range(r_start + 1,
+                                         r_start + num_lines + 1)
+
+                    rmeta = r_group[-1]
+                    rmeta.setdefault('moved', {}).update(
+                        zip(r_move_range, i_move_range))
+                    imeta.setdefault('moved', {}).update(
+                        zip(i_move_range, r_move_range))
+
+                # Reset the state for the next run.
+                i_move_start = i_move_cur + 1
+                r_move_range = None
 
     return groups
 
 
+def _index_removed_lines(a, deletes):
+    """Indexes the removed lines in the delete groups, for move detection.
+
+    This returns a tuple of:
+
+    * A dictionary mapping the stripped text of each non-blank removed line
+      to a number for that text.
+    * A dictionary mapping each of those numbers to the first removed line
+      with that text, as a tuple of (index, group).
+    * A dictionary mapping the index of each non-blank removed line to a
+      list of [number, group, run end], where the run end is the index of
+      the last line in the group's run of identical lines that the line is
+      part of.
+    * A dictionary mapping the index of each non-blank removed line to the
+      number of removed lines before it that are valid move ranges on their
+      own (see is_valid_move_range).
+    """
+    line_ids = {}
+    first_removes = {}
+    removed_lines = {}
+    num_valid_before = {}
+    num_valid = 0
+
+    for group in deletes:
+        i1, i2 = group[1:3]
+
+        for i in xrange(i1, i2):
+            line = a[i].strip()
+
+            if line:
+                line_id = line_ids.setdefault(line, len(line_ids))
+                first_removes.setdefault(line_id, (i, group))
+                removed_lines[i] = [line_id, group, i]
+                num_valid_before[i] = num_valid
+
+                if is_valid_move_range([line]):
+                    num_valid += 1
+
+        # Work backwards through the group to find where each run of
+        # identical lines ends.
+        for i in xrange(i2 - 2, i1 - 1, -1):
+            if (i in removed_lines and i + 1 in removed_lines and
+                removed_lines[i][0] == removed_lines[i + 1][0]):
+                removed_lines[i][2] = removed_lines[i + 1][2]
+
+    return line_ids, first_removes, removed_lines, num_valid_before
+
+
+def _remove_whitespace(line):
+    """Returns a line with all its whitespace removed.
+
+    Only ASCII whitespace is removed, for both byte strings and Unicode
+    strings.
+    """
+    if isinstance(line, unicode):
+        # None of the bytes in a multi-byte UTF-8 character are whitespace,
+        # so this compares the same way the Unicode strings would.
+        line = line.encode('utf-8')
+
+    return line.translate(IDENTITY_TRANS_TABLE, WHITESPACE_CHARS)
+
+
 def get_revision_str(revision):
     if revision == HEAD:
         return "HEAD"
@@ -921,7 +1553,20 @@ def get_revision_str(revision):
 
 def get_diff_files(diffset, filediff=None, interdiffset=None,
                    enable_syntax_highlighting=True,
-                   load_chunks=True):
+                   load_chunks=True, load_lines=True):
+    """
+    Returns information on each file in a diffset, for the diff viewer.
+
+    If load_chunks is set, the chunks for each file are loaded into
+    file['chunks']. Their lines are only loaded as well if load_lines is
+    set. Otherwise, load_chunk_lines must be called for any chunks whose
+    lines are needed.
+
+    If load_chunks isn't set, this only builds an index of the files, which
+    never fetches files from the repository. file['stats'] contains the
+    statistics stored for each diff (see FileDiff.get_stats), or None for
+    the files of an interdiff.
+    """
     if filediff:
         filediffs = [filediff]
 
@@ -995,6 +1640,8 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
 
 
     files = []
+    chunk_jobs = []
+    tool = diffset.repository.get_scmtool()
 
     for parts in filediff_parts:
         filediff, interfilediff, force_interdiff = parts
@@ -1033,7 +1680,6 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
             basepath = ""
             basename = filediff.source_file
 
-        tool = filediff.diffset.repository.get_scmtool()
         depot_filename = tool.normalize_path_for_display(filediff.source_file)
         dest_filename = tool.normalize_path_for_display(filediff.dest_file)
 
@@ -1053,8 +1699,13 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
             'index': len(files),
         }
 
+        if force_interdiff:
+            file['stats'] = None
+        else:
+            file['stats'] = filediff.get_stats()
+
         if load_chunks:
-            chunks = []
+            file['chunks'] = []
 
             if not filediff.binary and not filediff.deleted:
                 key = key_prefix
@@ -1066,23 +1717,21 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
                 else:
                     key += "interdiff-%s-none" % filediff.id
 
-                chunks = cache_memoize(
-                    key,
-                    lambda: list(get_chunks(filediff.diffset,
-                                            filediff, interfilediff,
-                                            force_interdiff,
-                                            enable_syntax_highlighting)),
-                    large_data=True)
+                chunk_jobs.append((file, key))
 
-            file['chunks'] = chunks
+        files.append(file)
+
+    if load_chunks:
+        if chunk_jobs:
+            _load_chunks(chunk_jobs, enable_syntax_highlighting, load_lines)
+
+        for file in files:
             file['changed_chunk_indexes'] = []
             file['whitespace_only'] = True
 
-            for j, chunk in enumerate(file['chunks']):
-                chunk['index'] = j
-
+            for chunk in file['chunks']:
                 if chunk['change'] != 'equal':
-                    file['changed_chunk_indexes'].append(j)
+                    file['changed_chunk_indexes'].append(chunk['index'])
                     meta = chunk.get('meta', {})
 
                     if not meta.get('whitespace_chunk', False):
@@ -1090,8 +1739,6 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
 
             file['num_changes'] = len(file['changed_chunk_indexes'])
 
-        files.append(file)
-
     def cmp_file(x, y):
         # Sort based on basepath in asc order
         if x["basepath"] != y["basepath"]:
@@ -1113,6 +1760,322 @@ def get_diff_files(diffset, filediff=None, interdiffset=None,
     return files
 
 
+def _load_chunks(chunk_jobs, enable_syntax_highlighting, load_lines):
+    """
+    Loads the chunks for a list of (file, cache key) pairs.
+
+    Each file's chunk layout (see generate_chunk_layout) is loaded and
+    stored in file['chunks']. If load_lines is set, the lines for all
+    the chunks are loaded as well. Otherwise, the lines can be loaded
+    later, only for the chunks that are needed, using load_chunk_lines.
+
+    By default, the chunks for each file are loaded one after another.
+    If the diffviewer_chunk_threads setting is set, the files are instead
+    processed concurrently in a pool of threads, which mostly helps with
+    fetching files from the repositories. If diffviewer_chunk_processes is
+    set, the diffing and syntax highlighting are further handed off to a
+    pool of worker processes.
+
+    Files are processed in the order given, and results are stored back on
+    the same file dictionaries, so the caller's ordering of files is
+    unaffected.
+    """
+    thread_pool, process_pool = _get_chunk_pools()
+
+    _prefetch_chunk_files(chunk_jobs)
+
+    def load_file_chunks(job):
+        file, key = job
+        get_source = _make_chunk_source_loader(file,
+                                               enable_syntax_highlighting)
+
+        def generate():
+            old, new, options = get_source()
+
+            if process_pool:
+                return process_pool.apply(generate_chunk_layout, (old, new),
+                                          options)
+            else:
+                return generate_chunk_layout(old, new, **options)
+
+        layout = cache_memoize('%s-layout' % key, generate, large_data=True)
+
+        for i, chunk in enumerate(layout['chunks']):
+            chunk['index'] = i
+
+        file['chunks'] = layout['chunks']
+        file['chunk_source'] = {
+            'key': key,
+            'chunks': layout['chunks'],
+            'ranges': layout['ranges'],
+            'enable_syntax_highlighting': enable_syntax_highlighting,
+        }
+
+        if load_lines:
+            _load_chunk_lines(file, file['chunks'], get_source, process_pool)
+
+    def load_file_chunks_in_thread(job):
+        try:
+            load_file_chunks(job)
+        finally:
+            # Each thread has its own database connection, which won't
+            # be closed at the end of the request like the main one.
+            connection.close()
+
+    if thread_pool and len(chunk_jobs) > 1:
+        thread_pool.map(load_file_chunks_in_thread, chunk_jobs)
+    else:
+        map(load_file_chunks, chunk_jobs)
+
+
+def load_chunk_lines(file, chunks):
+    """
+    Loads the lines for some of the chunks of a file from get_diff_files.
+
+    The lines of a diff are generated and cached in windows of
+    CHUNK_WINDOW_NUM_LINES lines, and only the windows covering the given
+    chunks are loaded. This allows showing part of a large file without
+    generating or loading the lines for the rest of it.
+
+    The lines are stored in chunk['lines'] for each chunk.
+    """
+    chunks = [chunk for chunk in chunks if 'lines' not in chunk]
+
+    if chunks:
+        _load_chunk_lines(
+            file, chunks,
+            _make_chunk_source_loader(
+                file, file['chunk_source']['enable_syntax_highlighting']),
+            _get_chunk_pools()[1])
+
+
+def _load_chunk_lines(file, chunks, get_source, process_pool):
+    """Loads the lines for chunks of a file. See load_chunk_lines."""
+    ranges = file['chunk_source']['ranges']
+    windows = set()
+
+    for chunk in chunks:
+        first_line = ranges[chunk['index']][0]
+        windows.update(_get_chunk_windows(first_line,
+                                          first_line + chunk['numlines']))
+
+    chunk_lines = _load_chunk_windows(file, windows, get_source, process_pool)
+
+    for chunk in chunks:
+        chunk['lines'] = chunk_lines.get(chunk['index'], [])
+
+
+def _get_chunk_windows(first_line, last_line):
+    """
+    Returns the windows of lines covering a range of virtual line numbers.
+
+    The range includes first_line, but not last_line.
+    """
+    return xrange((first_line - 1) // CHUNK_WINDOW_NUM_LINES,
+                  (last_line - 2) // CHUNK_WINDOW_NUM_LINES + 1)
+
+
+def _load_chunk_windows(file, windows, get_source, process_pool):
+    """
+    Loads windows of lines for a file, generating any that aren't cached.
+
+    This returns a dictionary mapping chunk indexes to the lines in those
+    chunks that fall within the windows.
+    """
+    source = file['chunk_source']
+    ranges = source['ranges']
+    prepared_files = []
+    markup_cache = {}
+
+    def generate():
+        old, new, options = get_source()
+        first_line = window * CHUNK_WINDOW_NUM_LINES + 1
+        last_line = first_line + CHUNK_WINDOW_NUM_LINES
+
+        if process_pool:
+            # Only send what's needed to the worker process, rather than
+            # any lines that have already been loaded.
+            layout_chunks = [
+                {
+                    'numlines': chunk['numlines'],
+                    'meta': chunk['meta'],
+                }
+                for chunk in source['chunks']
+            ]
+
+            return process_pool.apply(generate_chunk_lines,
+                                      (old, new, layout_chunks, ranges,
+                                       first_line, last_line),
+                                      options)
+        else:
+            # The files only need to be prepared, and their highlighted
+            # markup loaded, once for all the windows.
+            if not prepared_files:
+                prepared_files.append(
+                    _prepare_chunk_file(old, options['encoding']))
+                prepared_files.append(
+                    _prepare_chunk_file(new, options['encoding']))
+
+            return _generate_chunk_lines(prepared_files[0], prepared_files[1],
+                                         source['chunks'], ranges,
+                                         first_line, last_line,
+                                         markup_cache=markup_cache,
+                                         **options)
+
+    chunk_lines = {}
+
+    for window in sorted(windows):
+        # The "-hl" marks windows whose lines have the changed regions
+        # highlighted in their markup, which those cached by older versions
+        # don't.
+        key = '%s-window-%s-hl' % (source['key'], window)
+
+        for i, lines in cache_memoize(key, generate, large_data=True):
+            chunk_lines.setdefault(i, []).extend(lines)
+
+    return chunk_lines
+
+
+def _make_chunk_source_loader(file, enable_syntax_highlighting):
+    """
+    Returns a function for loading what's needed to generate a file's chunks.
+
+    The function returns the old and new file contents and the options for
+    generating chunks. These are only loaded the first time the function is
+    called, since they're not needed at all if everything is cached.
+    """
+    source = []
+
+    def get_source():
+        if not source:
+            filediff = file['filediff']
+            interfilediff = file['interfilediff']
+            old, new = get_chunk_file_contents(filediff, interfilediff,
+                                               file['force_interdiff'])
+            options = get_chunk_generation_options(
+                filediff.diffset, filediff, interfilediff,
+                enable_syntax_highlighting)
+            source.append((old, new, options))
+
+        return source[0]
+
+    return get_source
+
+
+def _prefetch_chunk_files(chunk_jobs):
+    """
+    Fetches the original files needed for any uncached chunks in one batch.
+
+    This is only an optimization. If the files can't be fetched together,
+    they'll be fetched (and any errors reported) one at a time when
+    generating the chunks.
+    """
+    files_by_repository = {}
+
+    for file, key in chunk_jobs:
+        if cache.has_key(make_cache_key('%s-layout' % key)):
+            continue
+
+        for filediff in (file['filediff'], file['interfilediff']):
+            if filediff:
+                repository = filediff.diffset.repository
+                files_by_repository.setdefault(
+                    repository.pk, (repository, []))[1].append(
+                        (filediff.source_file, filediff.source_revision))
+
+    for repository, files in files_by_repository.itervalues():
+        try:
+            prefetch_original_files(repository, files)
+        except Exception, e:
+            logging.warning("Unable to prefetch %d files from %s: %s" %
+                            (len(files), repository, e))
+
+
+def _get_chunk_pools():
+    """
+    Returns the thread and process pools used to load chunks.
+
+    The pools are shared by all requests in this process, and are sized
+    based on the diffviewer_chunk_threads and diffviewer_chunk_processes
+    settings. Either pool will be None if its setting is 0.
+    """
+    global _chunk_thread_pool, _chunk_process_pool
+
+    siteconfig = SiteConfiguration.objects.get_current()
+    num_threads = siteconfig.get('diffviewer_chunk_threads')
+    num_processes = siteconfig.get('diffviewer_chunk_processes')
+
+    _chunk_pools_lock.acquire()
+
+    try:
+        _chunk_thread_pool = _resize_pool(_chunk_thread_pool, num_threads,
+                                          _make_chunk_thread_pool)
+        _chunk_process_pool = _resize_pool(_chunk_process_pool,
+                                           num_processes,
+                                           _make_chunk_process_pool)
+
+        return (_chunk_thread_pool and _chunk_thread_pool[1],
+                _chunk_process_pool and _chunk_process_pool[1])
+    finally:
+        _chunk_pools_lock.release()
+
+
+def _make_chunk_thread_pool(size):
+    """Creates a pool of threads for loading chunks."""
+    # multiprocessing is only available on Python 2.6 and higher, so it's
+    # only imported once a pool is needed.
+    from multiprocessing.pool import ThreadPool
+
+    return ThreadPool(size)
+
+
+def _make_chunk_process_pool(size):
+    """Creates a pool of worker processes for generating chunks."""
+    import multiprocessing
+
+    return multiprocessing.Pool(size, _init_chunk_process)
+
+
+def _init_chunk_process():
+    """
+    Sets up a worker process for generating chunks.
+
+    Worker processes use the cache for syntax highlighting. Any cache
+    connections inherited from the parent process are closed, so that the
+    worker opens its own rather than sharing the parent's sockets.
+    """
+    if hasattr(cache, 'close'):
+        cache.close()
+
+
+def _resize_pool(pool_info, size, pool_cls):
+    """
+    Returns a (size, pool) tuple for a pool of the given size.
+
+    The existing pool is reused if it's already the right size. Otherwise,
+    it's shut down once its pending work is finished.
+
+    If pools aren't supported by this version of Python, the pool in the
+    tuple is None, and chunks are loaded one after another.
+    """
+    if pool_info and pool_info[0] == size:
+        return pool_info
+
+    if pool_info and pool_info[1]:
+        pool_info[1].close()
+
+    if size:
+        try:
+            return (size, pool_cls(size))
+        except ImportError, e:
+            logging.warning('Unable to create a pool of %d workers for '
+                            'loading diff chunks, so they will be loaded '
+                            'one at a time: %s' % (size, e))
+            return (size, None)
+
+    return None
+
+
 def get_file_chunks_in_range(context, filediff, interfilediff,
                              first_line, num_lines):
     """
@@ -1143,12 +2106,16 @@ def get_file_chunks_in_range(context, filediff, interfilediff,
       ======== =============================================================
       0        Virtual line number (union of the original and patched files)
       1        Real line number in the original file
-      2        HTML markup of the original file
+      2        HTML markup of the original file, with changed regions
+               highlighted
       3        Changed regions of the original line (for "replace" chunks)
       4        Real line number in the patched file
-      5        HTML markup of the patched file
+      5        HTML markup of the patched file, with changed regions
+               highlighted
       6        Changed regions of the patched line (for "replace" chunks)
       7        True if line consists of only whitespace changes
+      8        The line number the line was moved to or from, if it was
+               moved (this is left out otherwise)
       ======== =============================================================
     """
     def find_header(headers):
@@ -1169,32 +2136,49 @@ def get_file_chunks_in_range(context, filediff, interfilediff,
     else:
         assert 'user' in context
         files = get_diff_files(filediff.diffset, filediff, interdiffset,
-                               get_enable_highlighting(context['user']))
+                               get_enable_highlighting(context['user']),
+                               load_lines=False)
         context[key] = files
 
     if not files:
         raise StopIteration
 
     assert len(files) == 1
+    file = files[0]
+
+    if not file['chunks']:
+        raise StopIteration
+
+    # Only the lines in the range are loaded, rather than the lines for
+    # the whole of each chunk in the range, which may be very large.
+    source = file['chunk_source']
+    chunk_lines = _load_chunk_windows(
+        file, _get_chunk_windows(first_line, first_line + num_lines),
+        _make_chunk_source_loader(file,
+                                  source['enable_syntax_highlighting']),
+        _get_chunk_pools()[1])
+
     last_header = (None, None)
 
-    for chunk in files[0]['chunks']:
+    for chunk in file['chunks']:
         if ('headers' in chunk['meta'] and
             (chunk['meta']['headers'][0] or chunk['meta']['headers'][1])):
             last_header = chunk['meta']['headers']
 
-        lines = chunk['lines']
+        chunk_first_line = source['ranges'][chunk['index']][0]
+        chunk_last_line = chunk_first_line + chunk['numlines'] - 1
 
-        if lines[-1][0] >= first_line >= lines[0][0]:
+        if chunk_last_line >= first_line >= chunk_first_line:
+            lines = chunk_lines[chunk['index']]
             start_index = first_line - lines[0][0]
 
-            if first_line + num_lines <= lines[-1][0]:
+            if first_line + num_lines <= chunk_last_line:
                 last_index = start_index + num_lines
             else:
                 last_index = len(lines)
 
             new_chunk = {
-                'lines': chunk['lines'][start_index:last_index],
+                'lines': lines[start_index:last_index],
                 'numlines': last_index - start_index,
                 'change': chunk['change'],
                 'meta': chunk.get('meta', {}),
@@ -4,4 +4,6 @@ SEQUENCE = [
     'diffset_basedir',
     'filediff_status',
     'add_diff_hash',
+    'filediffdata_compressed_binary',
+    'diff_stats',
 ]
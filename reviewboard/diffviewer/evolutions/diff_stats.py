@@ -0,0 +1,12 @@
+from django_evolution.mutations import AddField
+from django.db import models
+
+
+MUTATIONS = [
+    AddField('FileDiff', 'lines_added', models.IntegerField, null=True),
+    AddField('FileDiff', 'lines_removed', models.IntegerField, null=True),
+    AddField('FileDiff', 'hunk_count', models.IntegerField, null=True),
+    AddField('DiffSet', 'lines_added', models.IntegerField, null=True),
+    AddField('DiffSet', 'lines_removed', models.IntegerField, null=True),
+    AddField('DiffSet', 'hunk_count', models.IntegerField, null=True),
+]
@@ -0,0 +1,8 @@
+from django_evolution.mutations import AddField
+
+from reviewboard.diffviewer.fields import BinaryField
+
+
+MUTATIONS = [
+    AddField('FileDiffData', 'compressed_binary', BinaryField, null=True),
+]
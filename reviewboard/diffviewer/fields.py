@@ -0,0 +1,53 @@
+import base64
+
+from django.db import models
+
+
+class BinaryField(models.Field):
+    """
+    A field for storing raw binary data.
+
+    Unlike Base64Field, the data is stored as-is in the database's binary
+    column type, rather than being encoded as text.
+
+    When serialized (for instance, by dumpdb), the data is base64-encoded,
+    and it's decoded again when loaded.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def db_type(self, connection):
+        engine = connection.settings_dict['ENGINE']
+
+        if engine.endswith('mysql'):
+            return 'longblob'
+        elif 'postgresql' in engine:
+            return 'bytea'
+        else:
+            return 'blob'
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+
+        if connection.settings_dict['ENGINE'].endswith('mysql'):
+            return str(value)
+        else:
+            return buffer(value)
+
+    def to_python(self, value):
+        if isinstance(value, unicode):
+            # This is serialized data.
+            return base64.b64decode(value)
+        elif isinstance(value, buffer):
+            # Some database backends return binary data as buffers.
+            return str(value)
+        else:
+            return value
+
+    def value_to_string(self, obj):
+        value = self._get_val_from_obj(obj)
+
+        if value is None:
+            return None
+
+        return base64.b64encode(value)
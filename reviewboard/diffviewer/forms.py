@@ -4,9 +4,12 @@ from django import forms
 from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext as _
 
-from reviewboard.diffviewer.diffutils import DEFAULT_DIFF_COMPAT_VERSION
+from reviewboard.diffviewer.diffutils import DEFAULT_DIFF_COMPAT_VERSION, \
+                                             prefetch_original_files
 from reviewboard.diffviewer.models import DiffSet, FileDiff
+from reviewboard.diffviewer.parser import get_diff_stats
 from reviewboard.scmtools.core import PRE_CREATION, UNKNOWN, FileNotFoundError
+from reviewboard.scmtools.errors import SCMError
 
 
 class EmptyDiffError(ValueError):
@@ -88,14 +91,22 @@ class UploadDiffForm(forms.Form):
                 if f.origChangesetId:
                     parent_changeset_id = f.origChangesetId
 
+        # Statistics on the changes are stored now, from the parsed diff,
+        # so that they can be shown without generating the diffs.
+        file_stats = [get_diff_stats(f.data) for f in files]
+
         diffset = DiffSet(name=diff_file.name, revision=0,
                           basedir=basedir,
                           history=diffset_history,
                           diffcompat=DEFAULT_DIFF_COMPAT_VERSION)
         diffset.repository = self.repository
+
+        for stats in file_stats:
+            diffset.add_file_stats(stats)
+
         diffset.save()
 
-        for f in files:
+        for f, stats in zip(files, file_stats):
             if f.origFile in parent_files:
                 parent_file = parent_files[f.origFile]
                 parent_content = parent_file.data
@@ -126,34 +137,69 @@ class UploadDiffForm(forms.Form):
                                 parent_diff=parent_content,
                                 binary=f.binary,
                                 status=status)
+            filediff.set_stats(stats)
             filediff.save()
 
         return diffset
 
     def _process_files(self, file, basedir, check_existance=False):
         tool = self.repository.get_scmtool()
+        files = []
+        files_to_check = []
 
-        for f in tool.get_parser(file.read()).parse():
+        # The parser reads the uploaded file as it goes, rather than reading
+        # it into memory all at once.
+        for f in tool.get_parser(file).parse():
             f2, revision = tool.parse_diff_revision(f.origFile, f.origInfo)
             if f2.startswith("/"):
                 filename = f2
             else:
                 filename = os.path.join(basedir, f2).replace("\\", "/")
 
-            # FIXME: this would be a good place to find permissions errors
-            if (revision != PRE_CREATION and
+            if (check_existance and
+                revision != PRE_CREATION and
                 revision != UNKNOWN and
                 not f.binary and
-                not f.deleted and
-                (check_existance and
-                 not tool.file_exists(filename, revision))):
-                raise FileNotFoundError(filename, revision)
+                not f.deleted):
+                files_to_check.append((filename, revision))
 
             f.origFile = filename
             f.origInfo = revision
 
-            yield f
+            files.append(f)
+
+        if files_to_check:
+            self._check_files_exist(tool, files_to_check)
 
+        return files
+
+    def _check_files_exist(self, tool, files):
+        """
+        Checks that each of the given (filename, revision) files exists.
+
+        If the tool can't check for files without fetching them, the files
+        are fetched together and cached for when the diff is viewed, rather
+        than being fetched once to validate and again to display. A missing
+        file fails the upload right away. If fetching fails for any other
+        reason, or the tool can check for files more cheaply, all the files
+        are checked with a single call to files_exist.
+        """
+        # FIXME: this would be a good place to find permissions errors
+        if tool.files_exist_fetches_contents:
+            try:
+                prefetch_original_files(self.repository, files)
+                return
+            except FileNotFoundError:
+                # FileNotFoundError is an SCMError, but checking the files
+                # again would only fetch them all a second time.
+                raise
+            except SCMError:
+                pass
+
+        for (filename, revision), exists in zip(files,
+                                                tool.files_exist(files)):
+            if not exists:
+                raise FileNotFoundError(filename, revision)
 
     def _compare_files(self, filename1, filename2):
         """
@@ -0,0 +1,357 @@
+import difflib
+import optparse
+import random
+import shutil
+import tempfile
+import time
+
+from django.core.cache import get_cache
+from django.core.management.base import CommandError, NoArgsCommand
+from django.utils import simplejson
+from djblets.util import misc as djblets_misc
+
+try:
+    import pygments
+    from pygments.lexers import get_lexer_for_filename
+except ImportError:
+    pygments = None
+
+from reviewboard.diffviewer import diffutils
+from reviewboard.diffviewer.diffutils import DEFAULT_DIFF_COMPAT_VERSION, \
+                                             NEWLINES_RE, \
+                                             NoWrapperHtmlFormatter, \
+                                             clear_line_regions_cache, \
+                                             generate_chunks, \
+                                             get_line_changed_regions, \
+                                             opcodes_with_metadata, patch
+from reviewboard.diffviewer.myersdiff import MyersDiffer
+from reviewboard.scmtools.core import HEAD
+from reviewboard.scmtools.localfile import LocalFileTool
+from reviewboard.scmtools.models import Repository
+
+
+SHAPES = ('many-small', 'huge', 'moves', 'whitespace', 'long-lines')
+
+STAGES = ('parse', 'fetch', 'patch', 'diff', 'metadata', 'line_regions',
+          'highlight', 'chunks')
+
+
+class Command(NoArgsCommand):
+    help = ('Benchmarks each stage of the diff viewer pipeline against '
+            'synthesized diffs, printing the timings as JSON.')
+
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--shape', action='append', dest='shapes',
+                             choices=SHAPES,
+                             help='A shape of diff to benchmark. This can '
+                                  'be given more than once. One of: %s. '
+                                  'Defaults to all of them.'
+                                  % ', '.join(SHAPES)),
+        optparse.make_option('--iterations', type='int', default=3,
+                             help='The number of times to run each stage'),
+        optparse.make_option('--files', type='int', default=200,
+                             help='The number of files in the many-small '
+                                  'diff'),
+        optparse.make_option('--lines', type='int', default=100,
+                             help='The number of lines in each small file'),
+        optparse.make_option('--huge-lines', type='int', default=20000,
+                             dest='huge_lines',
+                             help='The number of lines in each file for '
+                                  'the huge, moves and whitespace diffs. '
+                                  'The long-lines diff has one line for '
+                                  'every 1000 of these.'),
+        optparse.make_option('--changes', type='int', default=5,
+                             help='The number of changes per 100 lines'),
+        optparse.make_option('--seed', type='int', default=0,
+                             help='The random seed used to generate files'),
+        optparse.make_option('--no-highlighting', action='store_false',
+                             dest='highlighting', default=True,
+                             help='Skip syntax highlighting'),
+        )
+
+    def handle_noargs(self, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be at least 1')
+
+        shapes = options['shapes'] or SHAPES
+        results = {}
+
+        # Stages are run against a local memory cache set up here, which is
+        # cleared before each one, so that they're timed without any data
+        # cached by earlier stages or iterations (such as highlighted
+        # lines). This keeps the benchmark's data out of the site's cache,
+        # where it would evict the site's own data. See _reset_caches.
+        self._cache = get_cache(
+            'django.core.cache.backends.locmem.LocMemCache',
+            LOCATION='rb-benchmarkdiffs')
+        cache_modules = (diffutils, djblets_misc)
+        orig_caches = [module.cache for module in cache_modules]
+
+        for module in cache_modules:
+            module.cache = self._cache
+
+        try:
+            for shape in shapes:
+                # Each shape gets the same random sequence, no matter which
+                # other shapes are being run.
+                rand = random.Random('%s-%s' % (options['seed'], shape))
+                files = getattr(self, '_make_%s' % shape.replace('-', '_'))(
+                    rand, options)
+                results[shape] = self._benchmark(files, options)
+        finally:
+            for module, orig_cache in zip(cache_modules, orig_caches):
+                module.cache = orig_cache
+
+            self._cache.clear()
+
+        print simplejson.dumps({
+            'options': {
+                'iterations': options['iterations'],
+                'files': options['files'],
+                'lines': options['lines'],
+                'huge_lines': options['huge_lines'],
+                'changes': options['changes'],
+                'seed': options['seed'],
+                'highlighting': options['highlighting'] and
+                                pygments is not None,
+            },
+            'results': results,
+        }, indent=2, sort_keys=True)
+
+    def _benchmark(self, files, options):
+        """Times each stage of the pipeline for a set of files.
+
+        The files are written to a temporary directory, which is used as
+        a local file repository, and a diff is generated for them. Each
+        stage is then run on the output of the stage before it, the given
+        number of times. The best, worst and mean times are returned for
+        each stage, in seconds.
+        """
+        tempdir = tempfile.mkdtemp(prefix='rb-benchmark.')
+
+        try:
+            diff = ''
+
+            for filename, old, new in files:
+                f = open('%s/%s' % (tempdir, filename), 'w')
+                f.write(old)
+                f.close()
+
+                diff += ''.join(difflib.unified_diff(
+                    old.splitlines(True), new.splitlines(True),
+                    filename, filename, '(original)', '(new)'))
+
+            tool = LocalFileTool(Repository(name='Benchmark', path=tempdir))
+            timings = dict([(stage, []) for stage in STAGES])
+
+            for i in xrange(options['iterations']):
+                self._run_stages(tool, diff, timings,
+                                 options['highlighting'])
+        finally:
+            shutil.rmtree(tempdir)
+
+        results = {
+            'num_files': len(files),
+            'num_lines': sum([old.count('\n') for filename, old, new
+                              in files]),
+            'diff_size': len(diff),
+            'stages': {},
+        }
+
+        for stage, times in timings.iteritems():
+            if times:
+                results['stages'][stage] = {
+                    'min': min(times),
+                    'max': max(times),
+                    'mean': sum(times) / len(times),
+                }
+
+        return results
+
+    def _run_stages(self, tool, diff, timings, highlighting):
+        def timed(stage, func, *args):
+            self._reset_caches()
+            start = time.time()
+            result = func(*args)
+            timings[stage].append(time.time() - start)
+
+            return result
+
+        parsed_files = timed('parse', lambda: tool.get_parser(diff).parse())
+
+        old_files = timed('fetch', tool.get_files,
+                          [(f.origFile, HEAD) for f in parsed_files])
+
+        new_files = timed('patch', lambda: [
+            patch(f.data, old, f.origFile)
+            for f, old in zip(parsed_files, old_files)])
+
+        file_lines = [(self._split_lines(old), self._split_lines(new))
+                      for old, new in zip(old_files, new_files)]
+
+        differs = timed('diff', lambda: [
+            self._diff(a, b) for a, b in file_lines])
+
+        opcodes = timed('metadata', lambda: [
+            list(opcodes_with_metadata(differ)) for differ in differs])
+
+        timed('line_regions', self._find_line_regions, file_lines, opcodes)
+
+        if highlighting and pygments:
+            timed('highlight', lambda: [
+                (self._highlight(old, f.origFile),
+                 self._highlight(new, f.newFile))
+                for f, old, new in zip(parsed_files, old_files, new_files)])
+
+        timed('chunks', lambda: [
+            list(generate_chunks(old, new,
+                                 filename=f.origFile,
+                                 source_display_name=f.origFile,
+                                 dest_display_name=f.newFile,
+                                 encoding='iso-8859-15',
+                                 compat_version=DEFAULT_DIFF_COMPAT_VERSION,
+                                 enable_syntax_highlighting=highlighting,
+                                 syntax_highlighting_threshold=0,
+                                 ignore_space=True,
+                                 context_num_lines=5,
+                                 description='benchmark'))
+            for f, old, new in zip(parsed_files, old_files, new_files)])
+
+    def _reset_caches(self):
+        """Starts with empty caches for the next stage."""
+        clear_line_regions_cache()
+        self._cache.clear()
+
+    def _split_lines(self, data):
+        # This matches how generate_chunks splits up files.
+        lines = NEWLINES_RE.split(data)
+        del lines[-1]
+
+        return lines
+
+    def _diff(self, a, b):
+        differ = MyersDiffer(a, b, ignore_space=True)
+
+        # Compute the diff now, so that it's timed as part of this stage.
+        # The differ keeps the diff once it's computed, so the metadata
+        # stage mostly leaves the move detection to be timed there.
+        list(differ.get_opcodes())
+
+        return differ
+
+    def _find_line_regions(self, file_lines, file_opcodes):
+        for (a, b), opcodes in zip(file_lines, file_opcodes):
+            for tag, i1, i2, j1, j2, meta in opcodes:
+                if tag == 'replace':
+                    for oldline, newline in zip(a[i1:i2], b[j1:j2]):
+                        get_line_changed_regions(oldline, newline)
+
+    def _highlight(self, data, filename):
+        lexer = get_lexer_for_filename(filename, stripnl=False,
+                                       encoding='utf-8')
+
+        return pygments.highlight(data, lexer, NoWrapperHtmlFormatter())
+
+    def _make_many_small(self, rand, options):
+        """Many small files, each with a few scattered changes."""
+        return [
+            ('file%d.py' % i,) +
+            self._change_lines(rand, self._make_lines(rand, options['lines']),
+                               options['changes'])
+            for i in xrange(options['files'])
+        ]
+
+    def _make_huge(self, rand, options):
+        """One huge file with changes scattered throughout."""
+        lines = self._make_lines(rand, options['huge_lines'])
+
+        return [('huge.py',) +
+                self._change_lines(rand, lines, options['changes'])]
+
+    def _make_moves(self, rand, options):
+        """One large file with blocks of code moved around."""
+        lines = self._make_lines(rand, options['huge_lines'])
+        new_lines = list(lines)
+        num_moves = max(1, len(lines) * options['changes'] / 1000)
+
+        for i in xrange(num_moves):
+            size = rand.randint(5, 40)
+            start = rand.randint(0, len(new_lines) - size)
+            block = new_lines[start:start + size]
+            del new_lines[start:start + size]
+
+            dest = rand.randint(0, len(new_lines))
+            new_lines[dest:dest] = block
+
+        return [('moves.py', ''.join(lines), ''.join(new_lines))]
+
+    def _make_whitespace(self, rand, options):
+        """One large file where only the indentation has changed."""
+        lines = self._make_lines(rand, options['huge_lines'])
+        new_lines = list(lines)
+
+        for i in xrange(len(lines) * options['changes'] / 100):
+            j = rand.randint(0, len(lines) - 1)
+            new_lines[j] = '    ' + new_lines[j]
+
+        return [('whitespace.py', ''.join(lines), ''.join(new_lines))]
+
+    def _make_long_lines(self, rand, options):
+        """A minified file with a few long lines, each changed a little."""
+        lines = []
+
+        for i in xrange(max(1, options['huge_lines'] / 1000)):
+            lines.append(''.join(self._make_lines(rand, 200))
+                         .replace('\n', ';').replace('    ', '') + '\n')
+
+        new_lines = list(lines)
+
+        for i, line in enumerate(new_lines):
+            for j in xrange(options['changes']):
+                k = rand.randint(0, len(line) - 2)
+                line = line[:k] + str(rand.randint(0, 100)) + line[k:]
+
+            new_lines[i] = line
+
+        return [('long_lines.js', ''.join(lines), ''.join(new_lines))]
+
+    def _make_lines(self, rand, num_lines):
+        """Generates some lines of Python-like code."""
+        words = ['self', 'data', 'result', 'value', 'items', 'count',
+                 'name', 'index', 'options', 'filename', 'lines']
+        lines = []
+
+        while len(lines) < num_lines:
+            name = '%s_%d' % (rand.choice(words), rand.randint(0, 10000))
+            lines.append('def %s(%s, %s):\n' % (name, rand.choice(words),
+                                                rand.choice(words)))
+
+            for i in xrange(rand.randint(2, 12)):
+                lines.append('    %s = %s(%s) + %d\n'
+                             % (rand.choice(words), rand.choice(words),
+                                rand.choice(words), rand.randint(0, 100)))
+
+            lines.append('    return %s\n' % rand.choice(words))
+            lines.append('\n')
+
+        return lines[:num_lines]
+
+    def _change_lines(self, rand, lines, changes):
+        """Returns the original and changed contents for a list of lines.
+
+        Lines are inserted, deleted and modified at random.
+        """
+        new_lines = list(lines)
+
+        for i in xrange(max(1, len(lines) * changes / 100)):
+            j = rand.randint(0, len(new_lines) - 1)
+            action = rand.randint(0, 2)
+
+            if action == 0:
+                new_lines.insert(j, '    # Added line %d\n' % i)
+            elif action == 1 and len(new_lines) > 1:
+                del new_lines[j]
+            else:
+                new_lines[j] = new_lines[j].rstrip('\n') + ' * 2\n'
+
+        return ''.join(lines), ''.join(new_lines)
@@ -0,0 +1,99 @@
+import optparse
+import sys
+
+from django import db
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import transaction
+
+from reviewboard.diffviewer.models import FileDiff, FileDiffData
+
+
+class Command(NoArgsCommand):
+    help = ('Moves diffs stored in the older base64 format over to '
+            'compressed storage, committing a batch of rows at a time.')
+
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--batch-size', type='int', default=100,
+                             dest='batch_size',
+                             help='The number of rows to migrate in each '
+                                  'transaction'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        self.verbosity = int(options.get('verbosity', 1))
+
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        transaction.commit_unless_managed()
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+
+        try:
+            # Diff data that's shared between FileDiffs.
+            self._migrate(
+                'diff data',
+                FileDiffData.objects.filter(compressed_binary__isnull=True),
+                self._compress_diff_data, batch_size)
+
+            # Diffs from older versions of Review Board may still be stored
+            # in the FileDiffs themselves. Setting them again stores them
+            # compressed in FileDiffData.
+            self._migrate(
+                'file diffs',
+                FileDiff.objects.filter(diff_hash__isnull=True)
+                                .exclude(diff64=''),
+                self._move_diff, batch_size)
+            self._migrate(
+                'parent diffs',
+                FileDiff.objects.filter(parent_diff_hash__isnull=True)
+                                .exclude(parent_diff64=''),
+                self._move_parent_diff, batch_size)
+        except:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+            raise
+
+        transaction.leave_transaction_management()
+
+    def _migrate(self, name, queryset, migrate_func, batch_size):
+        """
+        Migrates all objects in a queryset, a batch at a time.
+
+        Each object must no longer match the queryset once migrated, so
+        that each batch fetches the next set of objects.
+        """
+        total = queryset.count()
+        i = 0
+
+        while True:
+            batch = list(queryset.order_by('pk')[:batch_size])
+
+            if not batch:
+                break
+
+            for obj in batch:
+                migrate_func(obj)
+                obj.save()
+
+            transaction.commit()
+            db.reset_queries()
+
+            i += len(batch)
+
+            if self.verbosity > 0:
+                sys.stdout.write("  Migrated %s of %s %s\r" % (i, total, name))
+                sys.stdout.flush()
+
+        if self.verbosity > 0:
+            print "Migrated %s %s." % (i, name)
+
+    def _compress_diff_data(self, diff_data):
+        diff_data.data = diff_data.binary
+
+    def _move_diff(self, filediff):
+        filediff.diff = filediff.diff64
+
+    def _move_parent_diff(self, filediff):
+        filediff.parent_diff = filediff.parent_diff64
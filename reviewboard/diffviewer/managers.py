@@ -13,8 +13,26 @@ class FileDiffDataManager(models.Manager):
     def get_or_create(self, *args, **kwargs):
         defaults = kwargs.get('defaults', {})
 
-        if defaults and defaults['binary']:
+        if defaults and defaults.get('binary'):
             defaults['binary'] = \
                 Base64DecodedValue(kwargs['defaults']['binary'])
 
         return super(FileDiffDataManager, self).get_or_create(*args, **kwargs)
+
+    def get_or_create_for_data(self, binary_hash, data):
+        """
+        Returns the FileDiffData for the given diff data, creating it with
+        the data compressed if it doesn't already exist.
+
+        This returns a (FileDiffData, created) tuple, like get_or_create.
+        """
+        try:
+            return self.get(binary_hash=binary_hash), False
+        except self.model.DoesNotExist:
+            # Compress the data only if it's going to be stored.
+            diff_data = self.model(binary_hash=binary_hash)
+            diff_data.data = data
+
+            return self.get_or_create(binary_hash=binary_hash, defaults={
+                'compressed_binary': diff_data.compressed_binary,
+            })
@@ -1,24 +1,56 @@
 from datetime import datetime
 import hashlib
+import zlib
 
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from djblets.util.fields import Base64Field
 
+from reviewboard.diffviewer.fields import BinaryField
 from reviewboard.diffviewer.managers import FileDiffDataManager
+from reviewboard.diffviewer.parser import get_diff_stats
 from reviewboard.scmtools.models import Repository
 
 
 class FileDiffData(models.Model):
     """
-    Contains hash and base64 pairs.
+    Contains hash and diff data pairs.
 
     These pairs are used to reduce diff database storage.
+
+    The diff data is stored compressed in compressed_binary. The first byte
+    of the stored data is a marker saying how it was compressed. Older
+    entries may instead have their data base64-encoded in binary, until
+    they're migrated by the compressdiffs management command.
     """
+    # Markers for the formats of the data in compressed_binary.
+    COMPRESSED_ZLIB = '\x01'
+
     binary_hash = models.CharField(_("hash"), max_length=40, primary_key=True)
     binary = Base64Field(_("base64"))
+    compressed_binary = BinaryField(_("compressed data"), null=True,
+                                    blank=True)
     objects = FileDiffDataManager()
 
+    def _get_data(self):
+        if self.compressed_binary is None:
+            return self.binary
+
+        marker = self.compressed_binary[:1]
+        data = self.compressed_binary[1:]
+
+        if marker == self.COMPRESSED_ZLIB:
+            return zlib.decompress(data)
+        else:
+            raise ValueError('Unknown format marker %r for diff data %s'
+                             % (marker, self.binary_hash))
+
+    def _set_data(self, data):
+        self.compressed_binary = self.COMPRESSED_ZLIB + zlib.compress(data)
+        self.binary = ""
+
+    data = property(_get_data, _set_data)
+
 
 class FileDiff(models.Model):
     """
@@ -54,24 +86,59 @@ class FileDiff(models.Model):
                                          related_name='parent_filediff_set')
     status = models.CharField(_("status"), max_length=1, choices=STATUSES)
 
+    # Statistics on the changes in the diff, stored when it's uploaded.
+    # These are None for older diffs until get_stats is called.
+    lines_added = models.IntegerField(_("lines added"), null=True, blank=True)
+    lines_removed = models.IntegerField(_("lines removed"), null=True,
+                                        blank=True)
+    hunk_count = models.IntegerField(_("hunk count"), null=True, blank=True)
+
     @property
     def deleted(self):
         return self.status == 'D'
 
+    def get_stats(self):
+        """
+        Returns statistics on the changes in this diff.
+
+        This is a dictionary containing lines_added, lines_removed and
+        hunk_count. These are normally stored when the diff is uploaded.
+        For older diffs, they're computed from the diff and stored the first
+        time they're needed. Either way, the repository isn't accessed.
+        """
+        if self.lines_added is None:
+            self.set_stats(get_diff_stats(self.diff))
+
+            if self.pk:
+                FileDiff.objects.filter(pk=self.pk).update(
+                    lines_added=self.lines_added,
+                    lines_removed=self.lines_removed,
+                    hunk_count=self.hunk_count)
+
+        return {
+            'lines_added': self.lines_added,
+            'lines_removed': self.lines_removed,
+            'hunk_count': self.hunk_count,
+        }
+
+    def set_stats(self, stats):
+        """Sets the statistics on this diff, as returned by get_diff_stats."""
+        self.lines_added = stats['lines_added']
+        self.lines_removed = stats['lines_removed']
+        self.hunk_count = stats['hunk_count']
+
     def _get_diff(self):
         # If the diff is not in FileDiffData, it is in FileDiff.
         if not self.diff_hash:
             return self.diff64
         else:
             # Data exists in FileDiffData, retrieve it.
-            return self.diff_hash.binary
+            return self.diff_hash.data
 
     def _set_diff(self, diff):
-        hashkey = self._hash_hexdigest(diff)
-
         # Add hash to table if it doesn't exist, and set diff_hash to this.
-        self.diff_hash, is_new = FileDiffData.objects.get_or_create(
-            binary_hash=hashkey, defaults={'binary': diff})
+        self.diff_hash, is_new = FileDiffData.objects.get_or_create_for_data(
+            self._hash_hexdigest(diff), diff)
         self.diff64 = ""
 
     diff = property(_get_diff, _set_diff)
@@ -80,15 +147,14 @@ class FileDiff(models.Model):
         if not self.parent_diff_hash:
             return self.parent_diff64
         else:
-            return self.parent_diff_hash.binary
+            return self.parent_diff_hash.data
 
     def _set_parent_diff(self, parent_diff):
         if parent_diff != "":
-            hashkey = self._hash_hexdigest(parent_diff)
-
             # Add hash to table if it doesn't exist, and set diff_hash to this.
-            self.parent_diff_hash, is_new = FileDiffData.objects.get_or_create(
-                binary_hash=hashkey, defaults={'binary': diff})
+            self.parent_diff_hash, is_new = \
+                FileDiffData.objects.get_or_create_for_data(
+                    self._hash_hexdigest(parent_diff), parent_diff)
             self.parent_diff64 = ""
 
     parent_diff = property(_get_parent_diff, _set_parent_diff)
@@ -123,6 +189,12 @@ class DiffSet(models.Model):
         help_text=_("The diff generator compatibility version to use. "
                     "This can and should be ignored."))
 
+    # The totals of the statistics of each FileDiff. See get_stats.
+    lines_added = models.IntegerField(_("lines added"), null=True, blank=True)
+    lines_removed = models.IntegerField(_("lines removed"), null=True,
+                                        blank=True)
+    hunk_count = models.IntegerField(_("hunk count"), null=True, blank=True)
+
     def save(self, **kwargs):
         """
         Saves this diffset.
@@ -140,6 +212,40 @@ class DiffSet(models.Model):
 
         super(DiffSet, self).save()
 
+    def get_stats(self):
+        """
+        Returns the totals of the statistics on each file in this diffset.
+
+        This is a dictionary containing lines_added, lines_removed and
+        hunk_count, like FileDiff.get_stats. For older diffsets, the totals
+        are computed and stored the first time they're needed.
+        """
+        if self.lines_added is None:
+            self.lines_added = 0
+            self.lines_removed = 0
+            self.hunk_count = 0
+
+            for filediff in self.files.all():
+                self.add_file_stats(filediff.get_stats())
+
+            if self.pk:
+                DiffSet.objects.filter(pk=self.pk).update(
+                    lines_added=self.lines_added,
+                    lines_removed=self.lines_removed,
+                    hunk_count=self.hunk_count)
+
+        return {
+            'lines_added': self.lines_added,
+            'lines_removed': self.lines_removed,
+            'hunk_count': self.hunk_count,
+        }
+
+    def add_file_stats(self, stats):
+        """Adds the statistics on one file's diff to this diffset's totals."""
+        self.lines_added = (self.lines_added or 0) + stats['lines_added']
+        self.lines_removed = (self.lines_removed or 0) + stats['lines_removed']
+        self.hunk_count = (self.hunk_count or 0) + stats['hunk_count']
+
     def __unicode__(self):
         return u"[%s] %s r%s" % (self.id, self.name, self.revision)
 
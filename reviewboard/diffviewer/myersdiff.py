@@ -1,3 +1,9 @@
+try:
+    from reviewboard.diffviewer import _myersdiff
+except ImportError:
+    _myersdiff = None
+
+
 class MyersDiffer:
     """
     An implementation of Eugene Myers's O(ND) Diff algorithm based on GNU diff.
@@ -35,6 +41,10 @@ class MyersDiffer:
         self.interesting_lines = [{}, {}]
         self.interesting_line_table = {}
 
+        # Whether to use the optional C implementation of the LCS search,
+        # if it was built.
+        self.use_accelerated = _myersdiff is not None
+
         # SMS State
         self.max_lines = 0
         self.fdiag = None
@@ -165,21 +175,43 @@ class MyersDiffer:
 
         self._discard_confusing_lines()
 
-        self.max_lines = self.a_data.undiscarded_lines + \
-                         self.b_data.undiscarded_lines + 3
+        if self.use_accelerated:
+            self._accelerated_lcs()
+        else:
+            self.max_lines = self.a_data.undiscarded_lines + \
+                             self.b_data.undiscarded_lines + 3
+
+            vector_size = self.a_data.undiscarded_lines + \
+                          self.b_data.undiscarded_lines + 3
+            self.fdiag = [0] * vector_size
+            self.bdiag = [0] * vector_size
+            self.downoff = self.upoff = self.b_data.undiscarded_lines + 1
 
-        vector_size = self.a_data.undiscarded_lines + \
-                      self.b_data.undiscarded_lines + 3
-        self.fdiag = [0] * vector_size
-        self.bdiag = [0] * vector_size
-        self.downoff = self.upoff = self.b_data.undiscarded_lines + 1
+            self._lcs(0, self.a_data.undiscarded_lines,
+                      0, self.b_data.undiscarded_lines,
+                      self.minimal_diff)
 
-        self._lcs(0, self.a_data.undiscarded_lines,
-                  0, self.b_data.undiscarded_lines,
-                  self.minimal_diff)
         self._shift_chunks(self.a_data, self.b_data)
         self._shift_chunks(self.b_data, self.a_data)
 
+    def _accelerated_lcs(self):
+        """
+        Runs the LCS search using the optional C implementation.
+
+        This is the same algorithm as _lcs and _find_sms, and produces the
+        same results, but runs much faster on large files.
+        """
+        a_modified, b_modified = _myersdiff.lcs(
+            self.a_data.undiscarded[:self.a_data.undiscarded_lines],
+            self.b_data.undiscarded[:self.b_data.undiscarded_lines],
+            self.minimal_diff)
+
+        for i in a_modified:
+            self.a_data.modified[self.a_data.real_indexes[i]] = True
+
+        for i in b_modified:
+            self.b_data.modified[self.b_data.real_indexes[i]] = True
+
     def _gen_diff_codes(self, lines, is_modified_file):
         """
         Converts all unique lines of text into unique numbers. Comparing
@@ -1,5 +1,6 @@
 import logging
 import re
+from cStringIO import StringIO
 
 
 class File(object):
@@ -20,6 +21,121 @@ class DiffParserError(Exception):
         self.linenum = linenum
 
 
+class DiffLines(object):
+    """
+    The lines of a diff, read incrementally from a file-like object.
+
+    This acts like the list of lines that DiffParser normally works with,
+    but lines are only read from the file as they're needed, and lines
+    that have been released by the parser are discarded. This keeps only
+    a window of a large diff in memory at once.
+
+    The length of the list is the number of lines read so far. It's always
+    at least LOOKAHEAD_LINES past the last line that was looked at, unless
+    the end of the file has been reached, so the bounds checks that parsers
+    make before looking at the next few lines work as they would with a
+    list.
+    """
+    BLOCK_SIZE = 64 * 1024
+    LOOKAHEAD_LINES = 100
+
+    def __init__(self, fp):
+        self.fp = fp
+        self._lines = []
+        self._offset = 0
+        self._released = 0
+        self._max_linenum = -1
+        self._partial_line = ''
+        self._eof = False
+
+    def release(self, linenum):
+        """Discards the lines before the specified line number."""
+        self._released = max(self._released, linenum)
+
+        # Discarding lines means moving the rest of the buffer, so it's
+        # only done once there's enough to make it worthwhile.
+        num_lines = self._released - self._offset
+
+        if num_lines > len(self._lines) / 2 and num_lines > 1000:
+            del self._lines[:num_lines]
+            self._offset = self._released
+
+    def __len__(self):
+        num_lines = self._offset + len(self._lines)
+
+        if (not self._eof and
+            self._max_linenum + self.LOOKAHEAD_LINES >= num_lines):
+            self._read_to(self._max_linenum + self.LOOKAHEAD_LINES)
+            num_lines = self._offset + len(self._lines)
+
+        return num_lines
+
+    def __getitem__(self, linenum):
+        i = linenum - self._offset
+
+        if 0 <= i < len(self._lines):
+            # This is the common case, where the line has already been read.
+            if linenum > self._max_linenum:
+                self._max_linenum = linenum
+
+            return self._lines[i]
+        elif linenum < 0:
+            # Negative indexes are relative to the end of the diff, so all
+            # of it has to be read.
+            self._read_to(None)
+            linenum += self._offset + len(self._lines)
+        else:
+            self._read_to(linenum)
+
+        self._max_linenum = max(self._max_linenum, linenum)
+
+        if linenum < self._offset:
+            raise ValueError('Line %d of the diff has already been released'
+                             % linenum)
+
+        try:
+            return self._lines[linenum - self._offset]
+        except IndexError:
+            raise IndexError('Line %d is past the end of the diff' % linenum)
+
+    def _read_to(self, linenum):
+        """
+        Reads from the file until the specified line has been read.
+
+        If linenum is None, the whole file is read.
+        """
+        while (not self._eof and
+               (linenum is None or
+                linenum >= self._offset + len(self._lines))):
+            data = self.fp.read(self.BLOCK_SIZE)
+
+            if not data:
+                self._eof = True
+
+                if self._partial_line:
+                    self._lines.append(self._partial_line.rstrip('\r'))
+                    self._partial_line = ''
+
+                break
+
+            lines = (self._partial_line + data).splitlines(True)
+
+            # The last line may continue in the next block. This includes
+            # a line ending in "\r", which may be followed by a "\n".
+            if lines[-1].endswith('\n'):
+                self._partial_line = ''
+            else:
+                self._partial_line = lines.pop()
+
+            # This splits the lines the same way as str.splitlines, which
+            # is what DiffParser uses for a diff passed as a string.
+            for line in lines:
+                if line.endswith('\r\n'):
+                    self._lines.append(line[:-2])
+                else:
+                    self._lines.append(line[:-1])
+
+
 class DiffParser(object):
     """
     Parses diff files into fragments, taking into account special fields
@@ -29,40 +145,81 @@ class DiffParser(object):
     INDEX_SEP = "=" * 67
 
     def __init__(self, data):
+        """
+        Creates a parser for a diff.
+
+        The diff can be passed as a string or a file-like object. A file is
+        read incrementally while parsing (see DiffLines), which avoids
+        holding the whole of a very large diff in memory.
+        """
         self.data = data
-        self.lines = data.splitlines()
+
+        if hasattr(data, 'read'):
+            self.lines = DiffLines(data)
+        else:
+            self.lines = data.splitlines()
 
     def parse(self):
         """
         Parses the diff, returning a list of File objects representing each
         file in the diff.
         """
+        if isinstance(self.data, basestring):
+            size = len(self.data)
+        else:
+            size = getattr(self.data, 'size', 'unknown')
+
         logging.debug("DiffParser.parse: Beginning parse of diff, size = %s",
-                      len(self.data))
+                      size)
 
         self.files = []
         file = None
+        file_data = None
         i = 0
 
         # Go through each line in the diff, looking for diff headers.
         while i < len(self.lines):
+            self.release_lines(i)
             next_linenum, new_file = self.parse_change_header(i)
 
             if new_file:
                 # This line is the start of a new file diff.
+                self._finish_file(file, file_data)
                 file = new_file
+                file_data = StringIO()
                 self.files.append(file)
                 i = next_linenum
             else:
                 if file:
-                    file.data += self.lines[i] + "\n"
+                    # The file's data is collected in a buffer and added
+                    # once the whole file has been parsed, rather than
+                    # appended to a line at a time, which is quadratic in
+                    # the size of the file.
+                    file_data.write(self.lines[i])
+                    file_data.write("\n")
 
                 i += 1
 
+        self._finish_file(file, file_data)
+
         logging.debug("DiffParser.parse: Finished parsing diff.")
 
         return self.files
 
+    def release_lines(self, linenum):
+        """
+        Lets the parser discard the lines before the specified line number.
+
+        Parsers call this once they no longer need to look at earlier
+        lines. It only has an effect when parsing a file-like object.
+        """
+        if isinstance(self.lines, DiffLines):
+            self.lines.release(linenum)
+
+    def _finish_file(self, file, file_data):
+        if file:
+            file.data += file_data.getvalue()
+
     def parse_change_header(self, linenum):
         """
         Parses part of the diff beginning at the specified line number, trying
@@ -184,5 +341,88 @@ class DiffParser(object):
 
         The returned diff as composed of all FileDiffs in the provided diffset.
         """
-        return ''.join([filediff.diff for filediff in diffset.files.all()])
+        return ''.join(self.iter_raw_diff(diffset))
+
+    def iter_raw_diff(self, diffset):
+        """Yields the raw diff of each FileDiff in the provided diffset.
+
+        FileDiffs are loaded one at a time, in the order they were created,
+        so that only one file's diff needs to be in memory at once.
+        """
+        for filediff in diffset.files.order_by('pk').iterator():
+            yield filediff.diff
+
+
+UNIFIED_HUNK_RE = re.compile(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+CONTEXT_HUNK_SEP = '*' * 15
+CONTEXT_ORIG_RANGE_RE = re.compile(r'^\*\*\* \d+(?:,\d+)? \*\*\*\*$')
+CONTEXT_NEW_RANGE_RE = re.compile(r'^--- \d+(?:,\d+)? ----$')
+
 
+def get_diff_stats(data):
+    """
+    Returns statistics on the changes in the diff of a single file.
+
+    This reads the hunks of a unified or context diff, counting the lines
+    added and removed. It doesn't need the files being changed, so it's
+    cheap enough to do when a diff is uploaded.
+
+    A dictionary is returned, containing lines_added, lines_removed and
+    hunk_count.
+    """
+    lines_added = 0
+    lines_removed = 0
+    hunk_count = 0
+
+    # The number of lines left in the current hunk of a unified diff,
+    # taken from its header.
+    orig_remaining = 0
+    new_remaining = 0
+
+    # The side of the current hunk of a context diff being read.
+    context_side = None
+
+    for line in data.splitlines():
+        if orig_remaining > 0 or new_remaining > 0:
+            c = line[:1]
+
+            if c == '+':
+                lines_added += 1
+                new_remaining -= 1
+            elif c == '-':
+                lines_removed += 1
+                orig_remaining -= 1
+            elif c != '\\':
+                orig_remaining -= 1
+                new_remaining -= 1
+
+            continue
+
+        m = UNIFIED_HUNK_RE.match(line)
+
+        if m:
+            hunk_count += 1
+            context_side = None
+
+            # A missing line count means the range is a single line.
+            orig_remaining = int(m.group(1) or 1)
+            new_remaining = int(m.group(2) or 1)
+        elif line == CONTEXT_HUNK_SEP:
+            hunk_count += 1
+            context_side = None
+        elif CONTEXT_ORIG_RANGE_RE.match(line):
+            context_side = 'orig'
+        elif CONTEXT_NEW_RANGE_RE.match(line):
+            context_side = 'new'
+        elif context_side == 'orig':
+            if line.startswith('- ') or line.startswith('! '):
+                lines_removed += 1
+        elif context_side == 'new':
+            if line.startswith('+ ') or line.startswith('! '):
+                lines_added += 1
+
+    return {
+        'lines_added': lines_added,
+        'lines_removed': lines_removed,
+        'hunk_count': hunk_count,
+    }
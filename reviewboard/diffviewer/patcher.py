@@ -0,0 +1,296 @@
+import re
+
+
+HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+NO_NEWLINE_MARKER = '\\'
+
+
+class PatchError(Exception):
+    """An error indicating a diff couldn't be applied in-process.
+
+    This isn't necessarily a sign that the diff is bad. It only means that
+    the diff uses something the in-process patcher doesn't handle (context
+    diffs, fuzz, etc.), and that the `patch` command should be used instead.
+    """
+    pass
+
+
+class Hunk(object):
+    """A single unified diff hunk.
+
+    ``old_lines`` and ``new_lines`` contain the lines, including their
+    line endings, that the hunk expects to find and that it will produce.
+    """
+    def __init__(self, old_start, old_len, new_start, new_len):
+        self.old_start = old_start
+        self.old_len = old_len
+        self.new_start = new_start
+        self.new_len = new_len
+        self.old_lines = []
+        self.new_lines = []
+        self.prefix_context = 0
+        self.suffix_context = 0
+
+    def get_expected_pos(self):
+        """Returns the 0-based line where the hunk expects to apply.
+
+        Hunks that don't remove or reference any lines (such as
+        "@@ -5,0 +6,2 @@") insert after the given line, rather than at it.
+        """
+        if self.old_len == 0:
+            return self.old_start
+        else:
+            return self.old_start - 1
+
+
+def parse_hunks(diff):
+    """Parses the hunks out of a unified diff for a single file.
+
+    Headers and any other lines outside of hunks are ignored, as `patch`
+    does. A PatchError is raised for anything that `patch` may treat
+    differently than a plain unified diff.
+    """
+    hunks = []
+    lines = diff.splitlines(True)
+    num_lines = len(lines)
+    in_trailer = False
+    i = 0
+
+    while i < num_lines:
+        line = lines[i]
+
+        if line.startswith('***************'):
+            raise PatchError('Context diffs are not supported')
+
+        if (line.startswith('+++ /dev/null') or
+            (hunks and line.startswith('--- ') and
+             i + 1 < num_lines and lines[i + 1].startswith('+++ '))):
+            # Either a file deletion or a second file in the diff. Both
+            # have special meaning to patch.
+            raise PatchError('Unsupported file header at line %d' % (i + 1))
+
+        m = HUNK_HEADER_RE.match(line)
+
+        if not m:
+            if hunks:
+                in_trailer = True
+
+            i += 1
+            continue
+
+        if in_trailer:
+            raise PatchError('Hunk after trailing garbage at line %d' %
+                             (i + 1))
+
+        old_len = m.group(2)
+        new_len = m.group(4)
+
+        if old_len is None:
+            old_len = 1
+        else:
+            old_len = int(old_len)
+
+        if new_len is None:
+            new_len = 1
+        else:
+            new_len = int(new_len)
+
+        hunk = Hunk(int(m.group(1)), old_len, int(m.group(3)), new_len)
+        i = _parse_hunk_body(hunk, lines, i + 1)
+        hunks.append(hunk)
+
+    if not hunks:
+        raise PatchError('No hunks found in the diff')
+
+    return hunks
+
+
+def _parse_hunk_body(hunk, lines, i):
+    """Reads the body of a hunk, returning the index of the next line."""
+    num_lines = len(lines)
+    old_remaining = hunk.old_len
+    new_remaining = hunk.new_len
+    seen_change = False
+
+    while old_remaining > 0 or new_remaining > 0:
+        if i >= num_lines:
+            raise PatchError('Unexpected end of hunk')
+
+        line = lines[i]
+        c = line[:1]
+        text = line[1:]
+
+        if line in ('\n', ''):
+            # Some tools strip the leading space from empty context lines.
+            # patch accepts these, so we do as well.
+            c = ' '
+            text = '\n'
+
+        if c == ' ':
+            if old_remaining == 0 or new_remaining == 0:
+                raise PatchError('Malformed hunk at line %d' % (i + 1))
+
+            hunk.old_lines.append(text)
+            hunk.new_lines.append(text)
+            old_remaining -= 1
+            new_remaining -= 1
+
+            if seen_change:
+                hunk.suffix_context += 1
+            else:
+                hunk.prefix_context += 1
+        elif c == '-':
+            if old_remaining == 0:
+                raise PatchError('Malformed hunk at line %d' % (i + 1))
+
+            hunk.old_lines.append(text)
+            old_remaining -= 1
+            seen_change = True
+            hunk.suffix_context = 0
+        elif c == '+':
+            if new_remaining == 0:
+                raise PatchError('Malformed hunk at line %d' % (i + 1))
+
+            hunk.new_lines.append(text)
+            new_remaining -= 1
+            seen_change = True
+            hunk.suffix_context = 0
+        elif c == NO_NEWLINE_MARKER:
+            _strip_last_newline(hunk, lines[i - 1][:1])
+        else:
+            raise PatchError('Malformed hunk at line %d' % (i + 1))
+
+        i += 1
+
+    # A "\ No newline at end of file" marker may follow the final line.
+    if i < num_lines and lines[i].startswith(NO_NEWLINE_MARKER):
+        _strip_last_newline(hunk, lines[i - 1][:1])
+        i += 1
+
+    return i
+
+
+def _strip_last_newline(hunk, prev_type):
+    """Handles a "\ No newline at end of file" marker for a hunk.
+
+    The marker applies to the line before it, which may be on the original
+    side, the modified side, or both (for context lines).
+    """
+    if prev_type in (' ', '-', '\n', '\r', ''):
+        _strip_newline(hunk.old_lines)
+
+    if prev_type in (' ', '+', '\n', '\r', ''):
+        _strip_newline(hunk.new_lines)
+
+
+def _strip_newline(lines):
+    if lines and lines[-1].endswith('\n'):
+        lines[-1] = lines[-1][:-1]
+
+
+def _hunk_matches(file_lines, pattern, pos):
+    end = pos + len(pattern)
+
+    if pos < 0 or end > len(file_lines):
+        return False
+
+    return file_lines[pos:end] == pattern
+
+
+def locate_hunk(hunk, file_lines, first_guess, last_frozen):
+    """Finds the 0-based line where a hunk applies without any fuzz.
+
+    This follows the rules `patch` uses. A hunk with less leading context
+    than trailing context at the start of a diff can only apply at the
+    start of the file, and one with less trailing context than leading
+    context can only apply at the end of the file. Otherwise, the closest
+    matching offset is used, checking forward first and then backward, and
+    never before the end of the previous hunk.
+
+    Returns None if the hunk can't be located.
+    """
+    pattern = hunk.old_lines
+    max_pos = len(file_lines) - len(pattern)
+
+    if not pattern:
+        # patch considers an empty range to always match.
+        if last_frozen <= first_guess <= len(file_lines):
+            return first_guess
+
+        return None
+
+    if hunk.prefix_context < hunk.suffix_context:
+        if hunk.get_expected_pos() <= 0:
+            if (last_frozen <= hunk.prefix_context and
+                _hunk_matches(file_lines, pattern, 0)):
+                return 0
+
+            return None
+    elif hunk.suffix_context < hunk.prefix_context:
+        if (max_pos >= last_frozen and
+            _hunk_matches(file_lines, pattern, max_pos)):
+            return max_pos
+
+        return None
+
+    if first_guess >= last_frozen and _hunk_matches(file_lines, pattern,
+                                                    first_guess):
+        return first_guess
+
+    i = 1
+
+    while True:
+        check_after = (first_guess + i <= max_pos)
+        check_before = (first_guess - i >= last_frozen)
+
+        if not check_after and not check_before:
+            return None
+
+        if check_after and _hunk_matches(file_lines, pattern,
+                                         first_guess + i):
+            return first_guess + i
+        elif check_before and _hunk_matches(file_lines, pattern,
+                                            first_guess - i):
+            return first_guess - i
+
+        i += 1
+
+
+def apply_patch(diff, data):
+    """Applies a unified diff to a string, returning the patched string.
+
+    This mirrors what `patch` does for diffs that apply without fuzz,
+    including searching for the closest offset when a hunk's context has
+    moved.
+
+    Both the diff and the data are expected to have already had their line
+    endings normalized. A PatchError is raised when the diff can't be
+    applied exactly, in which case the caller should fall back on `patch`.
+    """
+    file_lines = data.splitlines(True)
+    result = []
+    offset = 0
+    last_frozen = 0
+
+    for hunk in parse_hunks(diff):
+        pos = locate_hunk(hunk, file_lines,
+                          hunk.get_expected_pos() + offset, last_frozen)
+
+        if pos is None:
+            raise PatchError('Hunk at line %d does not apply cleanly' %
+                             hunk.old_start)
+
+        result.extend(file_lines[last_frozen:pos])
+        result.extend(hunk.new_lines)
+        last_frozen = pos + len(hunk.old_lines)
+        offset = pos - hunk.get_expected_pos()
+
+    result.extend(file_lines[last_frozen:])
+
+    # A line marked as having no newline only keeps that status if it ends
+    # up at the very end of the file. patch adds the newline back otherwise.
+    for i in xrange(len(result) - 1):
+        if not result[i].endswith('\n'):
+            result[i] += '\n'
+
+    return ''.join(result)
@@ -0,0 +1,385 @@
+"""
+Pre-renders diffs in the background, before anyone views them.
+
+The first person to view a diff normally pays for fetching the files from
+the repository, patching, diffing, syntax highlighting and rendering. Diffs
+can instead be queued here when they're uploaded, so that all of that is
+done and cached ahead of time.
+
+Jobs are run by a queue backend, which is set by the
+diffviewer_prerender_backend setting. The default, LocalPrerenderQueue,
+runs jobs in worker threads in the server process. Other backends can
+subclass PrerenderQueue to run jobs elsewhere.
+"""
+import heapq
+import logging
+import os
+import threading
+from collections import deque
+from datetime import datetime
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.http import HttpRequest
+from djblets.siteconfig.models import SiteConfiguration
+
+from reviewboard.diffviewer.diffutils import get_diff_files, \
+                                             get_enable_highlighting, \
+                                             load_chunk_lines
+from reviewboard.diffviewer.models import DiffSet
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+_queue = None
+_queue_settings = None
+_queue_lock = threading.Lock()
+
+
+class PrerenderJob(object):
+    """
+    A diff or interdiff to pre-render.
+
+    Jobs with the same diffset and interdiffset are duplicates, and are
+    only queued once.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, diffset_id, interdiffset_id=None, base_url=None,
+                 priority=PRIORITY_NORMAL):
+        self.diffset_id = diffset_id
+        self.interdiffset_id = interdiffset_id
+        self.base_url = base_url
+        self.priority = priority
+        self.status = self.QUEUED
+        self.error = None
+        self.queued_time = datetime.now()
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def key(self):
+        return (self.diffset_id, self.interdiffset_id)
+
+    def run(self):
+        try:
+            diffset = DiffSet.objects.get(pk=self.diffset_id)
+
+            if self.interdiffset_id:
+                interdiffset = DiffSet.objects.get(pk=self.interdiffset_id)
+            else:
+                interdiffset = None
+        except DiffSet.DoesNotExist:
+            # The diff was deleted before it could be rendered.
+            return
+
+        prerender_diff(diffset, interdiffset, self.base_url)
+
+    def __repr__(self):
+        return '<PrerenderJob(diffset=%s, interdiffset=%s, priority=%s, ' \
+               'status=%s)>' % (self.diffset_id, self.interdiffset_id,
+                                self.priority, self.status)
+
+
+class PrerenderQueue(object):
+    """
+    A queue of diffs to pre-render.
+
+    This is the interface that queue backends implement. A backend is
+    created with the number of workers set in diffviewer_prerender_workers.
+    """
+    def __init__(self, num_workers=1):
+        self.num_workers = num_workers
+
+    def add(self, job):
+        """
+        Adds a job to the queue.
+
+        Jobs with a lower priority number are run first. If a duplicate of
+        the job is already queued, it's given the higher of the two
+        priorities, and the new job isn't added. This returns whether the
+        job was added.
+        """
+        raise NotImplementedError
+
+    def get_jobs(self):
+        """
+        Returns the jobs that are queued, running, or have recently
+        finished, for display.
+        """
+        return []
+
+    def shutdown(self):
+        """
+        Stops running jobs once the current ones are finished.
+
+        This is called when the queue is replaced because its settings
+        changed.
+        """
+        pass
+
+
+class LocalPrerenderQueue(PrerenderQueue):
+    """
+    Runs pre-rendering jobs in worker threads in this process.
+
+    Files are fetched and diffed using the same thread and process pools
+    as the diff viewer (see diffviewer_chunk_threads and
+    diffviewer_chunk_processes).
+    """
+    # The number of finished jobs to keep around for display.
+    MAX_FINISHED_JOBS = 50
+
+    def __init__(self, num_workers=1):
+        super(LocalPrerenderQueue, self).__init__(max(num_workers, 1))
+        self._cond = threading.Condition()
+        self._heap = []
+        self._jobs = {}
+        self._finished = deque()
+        self._workers = []
+        self._pid = os.getpid()
+        self._next_seq = 0
+        self._shutdown = False
+
+    def add(self, job):
+        self._cond.acquire()
+
+        try:
+            self._check_pid()
+
+            existing_job = self._jobs.get(job.key)
+
+            if existing_job:
+                if (existing_job.status == PrerenderJob.QUEUED and
+                    job.priority < existing_job.priority):
+                    # Queue it again at the new priority. The old entry in
+                    # the heap will be skipped when it's reached.
+                    existing_job.priority = job.priority
+                    self._push(existing_job)
+                    self._cond.notify()
+
+                return False
+
+            self._jobs[job.key] = job
+            self._push(job)
+            self._start_workers()
+            self._cond.notify()
+
+            return True
+        finally:
+            self._cond.release()
+
+    def get_jobs(self):
+        self._cond.acquire()
+
+        try:
+            jobs = sorted(self._jobs.itervalues(),
+                          key=lambda job: (job.status != PrerenderJob.RUNNING,
+                                           job.priority, job.queued_time))
+
+            return jobs + list(self._finished)
+        finally:
+            self._cond.release()
+
+    def shutdown(self):
+        self._cond.acquire()
+
+        try:
+            self._shutdown = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _push(self, job):
+        # The sequence number keeps jobs of the same priority in the order
+        # they were queued.
+        heapq.heappush(self._heap, (job.priority, self._next_seq, job))
+        self._next_seq += 1
+
+    def _check_pid(self):
+        """
+        Resets the queue if this process was forked.
+
+        The worker threads don't exist in the new process.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._heap = []
+            self._jobs = {}
+            self._workers = []
+
+    def _start_workers(self):
+        self._workers = [worker for worker in self._workers
+                         if worker.isAlive()]
+
+        while len(self._workers) < self.num_workers:
+            worker = threading.Thread(target=self._run_worker,
+                                      name='diff-prerender-worker')
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _get_next_job(self):
+        """Waits for the next job to run, or returns None on shutdown."""
+        self._cond.acquire()
+
+        try:
+            while not self._shutdown:
+                while self._heap:
+                    priority, seq, job = heapq.heappop(self._heap)
+
+                    # Skip entries for jobs that were requeued at a higher
+                    # priority and have already been run.
+                    if (job.status == PrerenderJob.QUEUED and
+                        job.priority == priority):
+                        job.status = PrerenderJob.RUNNING
+                        job.start_time = datetime.now()
+                        return job
+
+                self._cond.wait()
+
+            return None
+        finally:
+            self._cond.release()
+
+    def _run_worker(self):
+        while True:
+            job = self._get_next_job()
+
+            if job is None:
+                break
+
+            try:
+                job.run()
+                status = PrerenderJob.DONE
+            except Exception, e:
+                logging.error('Unable to pre-render diff for %r: %s',
+                              job, e, exc_info=1)
+                job.error = str(e)
+                status = PrerenderJob.FAILED
+            finally:
+                # This thread isn't part of a request, so nothing else will
+                # close its database connection.
+                connection.close()
+
+            self._cond.acquire()
+
+            try:
+                job.status = status
+                job.end_time = datetime.now()
+                self._jobs.pop(job.key, None)
+                self._finished.appendleft(job)
+
+                while len(self._finished) > self.MAX_FINISHED_JOBS:
+                    self._finished.pop()
+            finally:
+                self._cond.release()
+
+
+def get_prerender_queue():
+    """
+    Returns the queue used to pre-render diffs.
+
+    The queue is created from the diffviewer_prerender_backend and
+    diffviewer_prerender_workers settings, and is shared by everything in
+    this process. This returns None if pre-rendering is disabled.
+    """
+    global _queue, _queue_settings
+
+    siteconfig = SiteConfiguration.objects.get_current()
+
+    if not siteconfig.get('diffviewer_prerender_enabled'):
+        return None
+
+    queue_settings = (siteconfig.get('diffviewer_prerender_backend'),
+                      siteconfig.get('diffviewer_prerender_workers'))
+
+    _queue_lock.acquire()
+
+    try:
+        if _queue is None or _queue_settings != queue_settings:
+            if _queue:
+                _queue.shutdown()
+
+            backend_path, num_workers = queue_settings
+            _queue = get_backend_class(backend_path)(num_workers)
+            _queue_settings = queue_settings
+
+        return _queue
+    finally:
+        _queue_lock.release()
+
+
+def get_backend_class(path):
+    """
+    Returns the queue backend class at the given path.
+
+    This raises ImproperlyConfigured if the class can't be loaded.
+    """
+    i = path.rfind('.')
+    module, attr = path[:i], path[i + 1:]
+
+    try:
+        mod = __import__(module, {}, {}, [attr])
+    except (ImportError, ValueError), e:
+        raise ImproperlyConfigured, \
+            'Error importing diff pre-render backend %s: "%s"' % (module, e)
+
+    try:
+        return getattr(mod, attr)
+    except AttributeError:
+        raise ImproperlyConfigured, \
+            'Module "%s" does not define a "%s" diff pre-render backend' % \
+            (module, attr)
+
+
+def queue_prerender(diffset, interdiffset=None, base_url=None,
+                    priority=PRIORITY_NORMAL):
+    """
+    Queues a diff or interdiff to be pre-rendered, if this is enabled.
+
+    base_url is the URL of the page the diff is shown on. If it's not
+    given, the diff's chunks are cached, but the rendered files aren't.
+    """
+    queue = get_prerender_queue()
+
+    if queue:
+        queue.add(PrerenderJob(diffset.pk,
+                               interdiffset and interdiffset.pk,
+                               base_url, priority))
+
+
+def prerender_diff(diffset, interdiffset=None, base_url=None):
+    """
+    Renders a diff or interdiff, filling the caches used by the diff viewer.
+
+    This loads the chunks of every file, which fetches, patches, diffs and
+    syntax highlights the files. If base_url is given, each file is
+    rendered as the diff viewer first shows it to users, with its changes
+    collapsed and the site's default syntax highlighting.
+    """
+    # Imported here, since the views import the rest of the diff viewer.
+    from reviewboard.diffviewer.views import build_diff_fragment
+
+    request = HttpRequest()
+    request.user = AnonymousUser()
+    highlighting = get_enable_highlighting(request.user)
+
+    files = get_diff_files(diffset, None, interdiffset, highlighting,
+                           load_lines=False)
+
+    for file in files:
+        if base_url:
+            build_diff_fragment(request, file, None, highlighting, True, {
+                'standalone': False,
+                'base_url': base_url,
+            })
+        else:
+            load_chunk_lines(file, [chunk for chunk in file['chunks']
+                                    if not chunk['collapsable']])
@@ -2,6 +2,8 @@ import re
 
 from django import template
 
+from reviewboard.diffviewer.diffutils import highlight_regions
+
 register = template.Library()
 
 
@@ -47,70 +49,12 @@ def highlightregion(value, regions):
 
     This is used to insert ``<span class="hl">...</span>`` tags in the
     text as specified by the ``regions`` variable.
+
+    The markup in the lines of diffs returned by get_diff_files and
+    get_file_chunks_in_range already has the changed regions highlighted,
+    and doesn't need this.
     """
-    if not regions:
-        return value
-
-    s = ""
-
-    # We need to insert span tags into a string already consisting
-    # of span tags. We have a list of ranges that our span tags should
-    # go into, but those ranges are in the markup-less string.
-    #
-    # We go through the string and keep track of the location in the
-    # markup and in the markup-less string. We make sure to insert our
-    # span tag any time that we're within the current region, so long
-    # as we haven't already created one. We close the span tag whenever
-    # we're done with the region or when we're about to enter a tag in
-    # the markup string.
-    #
-    # This code makes the assumption that the list of regions is sorted.
-    # This is safe to assume in practice, but if we ever at some point
-    # had reason to doubt it, we could always sort the regions up-front.
-    in_tag = in_entity = in_hl = False
-    i = j = r = 0
-    region = regions[r]
-
-    for i in xrange(len(value)):
-        if value[i] == "<":
-            in_tag = True
-
-            if in_hl:
-                s += "</span>"
-                in_hl = False
-        elif value[i] == ">":
-            in_tag = False
-        elif value[i] == ';' and in_entity:
-            in_entity = False
-            j += 1
-        elif not in_tag and not in_entity:
-            if not in_hl and region[0] <= j < region[1]:
-                s += '<span class="hl">'
-                in_hl = True
-
-            if value[i] == '&':
-                in_entity = True
-            else:
-                j += 1
-
-        s += value[i]
-
-        if j == region[1]:
-            r += 1
-
-            if in_hl:
-                s += '</span>'
-                in_hl = False
-
-            if r == len(regions):
-                break
-
-            region = regions[r]
-
-    if i + 1 < len(value):
-        s += value[i + 1:]
-
-    return s
+    return highlight_regions(value, regions)
 highlightregion.is_safe = True
 
 
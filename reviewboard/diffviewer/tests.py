@@ -1,14 +1,38 @@
+import hashlib
 import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from StringIO import StringIO
 
+import nose
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.http import HttpRequest
 from django.test import TestCase
 from djblets.siteconfig.models import SiteConfiguration
-
-from reviewboard.diffviewer.models import DiffSet, FileDiff
+from djblets.util.misc import make_cache_key
+
+from reviewboard.diffviewer.chardiff import CharDiffer
+from reviewboard.diffviewer.forms import UploadDiffForm
+from reviewboard.diffviewer.models import DiffSet, FileDiff, FileDiffData
+from reviewboard.diffviewer.prerender import LocalPrerenderQueue, \
+                                             PrerenderJob, PRIORITY_HIGH, \
+                                             PRIORITY_LOW, PRIORITY_NORMAL, \
+                                             prerender_diff
 from reviewboard.diffviewer.templatetags.difftags import highlightregion
 import reviewboard.diffviewer.diffutils as diffutils
+import reviewboard.diffviewer.myersdiff as myersdiff
 import reviewboard.diffviewer.parser as diffparser
-from reviewboard.scmtools.models import Repository
+import reviewboard.diffviewer.patcher as patcher
+import reviewboard.diffviewer.views as diffviews
+from reviewboard.scmtools.models import Repository, Tool
 
 
 class MyersDifferTest(TestCase):
@@ -34,6 +58,33 @@ class MyersDifferTest(TestCase):
                           ("insert",  5, 5, 5, 9),
                           ("equal",   5, 8, 9, 12)])
 
+    def testAcceleratedDiff(self):
+        """Testing myers differ with the C implementation"""
+        if not myersdiff._myersdiff:
+            raise nose.SkipTest('The C implementation of MyersDiffer '
+                                'is not built')
+
+        testdata = os.path.join(os.path.dirname(__file__), 'testdata')
+
+        for filename in os.listdir(os.path.join(testdata, 'orig_src')):
+            new_filename = os.path.join(testdata, 'new_src', filename)
+
+            if not os.path.exists(new_filename):
+                continue
+
+            a = open(os.path.join(testdata, 'orig_src', filename)).readlines()
+            b = open(new_filename).readlines()
+
+            for ignore_space in (False, True):
+                opcodes = []
+
+                for use_accelerated in (False, True):
+                    differ = diffutils.MyersDiffer(a, b, ignore_space)
+                    differ.use_accelerated = use_accelerated
+                    opcodes.append(list(differ.get_opcodes()))
+
+                self.assertEqual(opcodes[0], opcodes[1])
+
     def __test_diff(self, a, b, expected):
         opcodes = list(diffutils.MyersDiffer(a, b).get_opcodes())
         self.assertEquals(opcodes, expected)
@@ -164,9 +215,109 @@ class InterestingLinesTest(TestCase):
         return result
 
 
-class DiffParserTest(unittest.TestCase):
+class TestDataMixin(object):
+    """Reads files from the testdata directory."""
     PREFIX = os.path.join(os.path.dirname(__file__), 'testdata')
 
+    def _get_file(self, *relative):
+        f = open(os.path.join(*tuple([self.PREFIX] + list(relative))))
+        data = f.read()
+        f.close()
+        return data
+
+
+def get_reference_moves(differ):
+    """
+    Returns the moved lines for each opcode, the way Review Board 1.6 did.
+
+    This is a frozen copy of the original move detection from
+    opcodes_with_metadata, which compared each inserted line against every
+    matching removed line. opcodes_with_metadata finds moves much faster,
+    and is tested against this to make sure it still finds the same ones.
+    """
+    groups = []
+    removes = {}
+    inserts = []
+
+    for tag, i1, i2, j1, j2 in differ.get_opcodes():
+        meta = {}
+        group = (tag, i1, i2, j1, j2, meta)
+        groups.append(group)
+
+        if tag == 'delete':
+            for i in xrange(i1, i2):
+                line = differ.a[i].strip()
+
+                if line:
+                    removes.setdefault(line, []).append((i, group))
+        elif tag == 'insert':
+            inserts.append(group)
+
+    for itag, ii1, ii2, ij1, ij2, imeta in inserts:
+        i_move_cur = ij1
+        i_move_range = (i_move_cur, i_move_cur)
+        r_move_ranges = {}
+
+        while i_move_cur <= ij2:
+            try:
+                iline = differ.b[i_move_cur].strip()
+            except IndexError:
+                iline = None
+
+            if iline is not None and iline in removes:
+                for ri, rgroup in removes.get(iline, []):
+                    key = "%s-%s-%s-%s" % rgroup[1:5]
+
+                    if r_move_ranges:
+                        for i, r_move_range in \
+                            enumerate(r_move_ranges.get(key, [])):
+                            if ri == r_move_range[1] + 1:
+                                r_move_ranges[key][i] = (r_move_range[0], ri,
+                                                         rgroup)
+                                break
+                    else:
+                        r_move_ranges[key] = [(ri, ri, rgroup)]
+
+                i_move_cur += 1
+            else:
+                if r_move_ranges:
+                    r_move_range = None
+
+                    for ranges in r_move_ranges.itervalues():
+                        for r1, r2, rgroup in ranges:
+                            if not r_move_range:
+                                r_move_range = (r1, r2, rgroup)
+                            else:
+                                len1 = r_move_range[2] - r_move_range[1]
+                                len2 = r2 - r1
+
+                                if len1 < len2:
+                                    r_move_range = (r1, r2, rgroup)
+                                elif len1 == len2:
+                                    r_move_range = None
+
+                    if (r_move_range and
+                        diffutils.is_valid_move_range(
+                            differ.a[r_move_range[0]:r_move_range[1]])):
+                        i_move_range = range(i_move_range[0] + 1,
+                                             i_move_cur + 1)
+                        r_move_range = range(r_move_range[0] + 1,
+                                             r_move_range[1] + 2)
+
+                        rmeta = rgroup[-1]
+                        rmeta.setdefault('moved', {}).update(
+                            dict(zip(r_move_range, i_move_range)))
+                        imeta.setdefault('moved', {}).update(
+                            dict(zip(i_move_range, r_move_range)))
+
+                i_move_cur += 1
+                i_move_range = (i_move_cur, i_move_cur)
+                r_move_ranges = {}
+
+    return [opcode[-1].get('moved', {}) for opcode in groups]
+
+
+class DiffParserTest(TestDataMixin, unittest.TestCase):
     def diff(self, options=''):
         f = os.popen('diff -rN -x .svn %s %s/orig_src %s/new_src' %
                      (options, self.PREFIX, self.PREFIX))
@@ -207,6 +358,39 @@ class DiffParserTest(unittest.TestCase):
         files = diffparser.DiffParser(data).parse()
         self.compareDiffs(files, "context")
 
+    def testParseFile(self):
+        """Testing parse on a diff read incrementally from a file"""
+        data = self.diff('-u')
+
+        # A small block size makes sure lines that are split across reads
+        # are handled.
+        block_size = diffparser.DiffLines.BLOCK_SIZE
+        diffparser.DiffLines.BLOCK_SIZE = 100
+
+        try:
+            files = diffparser.DiffParser(StringIO(data)).parse()
+        finally:
+            diffparser.DiffLines.BLOCK_SIZE = block_size
+
+        self.compareDiffs(files, "unified")
+
+        expected = diffparser.DiffParser(data).parse()
+
+        for file, expected_file in zip(files, expected):
+            self.assertEqual(file.origFile, expected_file.origFile)
+            self.assertEqual(file.newFile, expected_file.newFile)
+            self.assertEqual(file.data, expected_file.data)
+
+    def testDiffStats(self):
+        """Testing get_diff_stats on unified and context diffs"""
+        for testdir in ('unified', 'context'):
+            data = self._get_file('diffs', testdir, 'foo.c.diff')
+            self.assertEqual(diffparser.get_diff_stats(data), {
+                'lines_added': 4,
+                'lines_removed': 1,
+                'hunk_count': 1,
+            })
+
     def testPatch(self):
         """Testing patching"""
 
@@ -229,6 +413,42 @@ class DiffParserTest(unittest.TestCase):
         patched = diffutils.patch(diff, old, 'test.c')
         self.assertEqual(patched, old)
 
+    def testInProcessPatch(self):
+        """Testing patching in-process"""
+        old = self._get_file('orig_src', 'foo.c')
+        new = self._get_file('new_src', 'foo.c')
+        diff = self._get_file('diffs', 'unified', 'foo.c.diff')
+
+        self.assertEqual(patcher.apply_patch(diff, old), new)
+
+        diff = self._get_file('diffs', 'unified', 'README.diff')
+        self.assertRaises(patcher.PatchError,
+                          lambda: patcher.apply_patch(diff, old))
+
+    def testInProcessPatchWithOffset(self):
+        """Testing patching in-process with hunks at an offset"""
+        diff = '--- a\n+++ b\n@@ -2,3 +2,3 @@\n b\n-c\n+C\n d\n'
+
+        self.assertEqual(patcher.apply_patch(diff, 'x\ny\na\nb\nc\nd\ne\n'),
+                         'x\ny\na\nb\nC\nd\ne\n')
+
+    def testInProcessPatchNoNewline(self):
+        """Testing patching in-process with no newline at end of file"""
+        old = diffutils.convert_line_endings(
+            self._get_file('orig_src', 'README.nonewline'))
+        new = self._get_file('new_src', 'README.nonewline')
+        diff = self._get_file('diffs', 'unified', 'README.nonewline.diff')
+
+        self.assertEqual(patcher.apply_patch(diff, old), new)
+
+    def testInProcessPatchContextDiff(self):
+        """Testing patching in-process with a context diff"""
+        old = self._get_file('orig_src', 'foo.c')
+        diff = self._get_file('diffs', 'context', 'foo.c.diff')
+
+        self.assertRaises(patcher.PatchError,
+                          lambda: patcher.apply_patch(diff, old))
+
     def testPatchCRLFFileCRLFDiff(self):
         """Testing patching a CRLF file with a CRLF diff"""
         old = self._get_file('orig_src', 'README.crlf')
@@ -294,6 +514,45 @@ class DiffParserTest(unittest.TestCase):
         regions = diffutils.get_line_changed_regions(old, new)
         deepEqual(regions, (None, None))
 
+    def testInterlineLongLines(self):
+        """Testing inter-line diffs of long lines"""
+        old = 'var a=[%s];' % ','.join([str(i) for i in xrange(2000)])
+        new = old.replace(',1000,', ',1000.5,')
+        regions = diffutils.get_line_changed_regions(old, new)
+        self.assertEqual(regions, ([(3901, 3901)], [(3901, 3903)]))
+        self.assertEqual(new[3901:3903], '.5')
+
+        # The results are remembered for the same lines.
+        self.assertTrue(diffutils.get_line_changed_regions(old, new)
+                        is regions)
+
+    def testCharDiffer(self):
+        """Testing CharDiffer"""
+        differ = CharDiffer('abcabc', 'abxabcab')
+        self.assertEqual(differ.ratio(), 2.0 * 5 / 14)
+        self.assertTrue(differ.quick_ratio() >= differ.ratio())
+        self.assertTrue(differ.real_quick_ratio() >= differ.quick_ratio())
+        self.assertEqual(differ.get_opcodes(), [
+            ('equal', 0, 2, 0, 2),
+            ('replace', 2, 3, 2, 3),
+            ('equal', 3, 6, 3, 6),
+            ('insert', 6, 6, 6, 8),
+        ])
+
+    def testCharDifferLongLines(self):
+        """Testing CharDiffer.ratio with lines longer than max_lcs_len"""
+        old = 'x = [%s];' % ', '.join([str(i) for i in range(100)])
+        new = old.replace('50', 'fifty')
+
+        differ = CharDiffer(old, new)
+        differ.max_lcs_len = 10
+        self.assertTrue(0.9 < differ.ratio() <= differ.quick_ratio())
+
+        differ = CharDiffer(old, old[::-1])
+        differ.max_lcs_len = 10
+        self.assertTrue(differ.quick_ratio() > 0.9)
+        self.assertEqual(differ.ratio(), 0.0)
+
     def testMoveDetection(self):
         """Testing move detection"""
         # movetest1 has two blocks of code that would appear to be moves:
@@ -335,11 +594,187 @@ class DiffParserTest(unittest.TestCase):
             self.assertEqual(i_moves[0][j], i)
             self.assertEqual(r_moves[0][i], j)
 
-    def _get_file(self, *relative):
-        f = open(os.path.join(*tuple([self.PREFIX] + list(relative))))
-        data = f.read()
-        f.close()
-        return data
+    def testMoveDetectionRepeatedLines(self):
+        """Testing move detection with repeated lines"""
+        old = ['def foo():', '    pass', '    pass', '    pass', '',
+               'one', 'two', 'three', 'four', 'five', 'six']
+        new = ['one', 'two', 'three', 'four', 'five', 'six',
+               'def foo():', '    pass', '    pass', '    pass', '']
+        differ = diffutils.Differ(old, new)
+
+        opcodes = [opcode
+                   for opcode in diffutils.opcodes_with_metadata(differ)
+                   if opcode[0] != 'equal']
+
+        self.assertEqual(len(opcodes), 2)
+        self.assertEqual(opcodes[0][:5], ('delete', 0, 5, 0, 0))
+        self.assertEqual(opcodes[0][-1]['moved'],
+                         {1: 7, 2: 8, 3: 9, 4: 10})
+        self.assertEqual(opcodes[1][:5], ('insert', 11, 11, 6, 11))
+        self.assertEqual(opcodes[1][-1]['moved'],
+                         {7: 1, 8: 2, 9: 3, 10: 4})
+
+    def testMoveDetectionMatchesReference(self):
+        """Testing move detection against the original algorithm"""
+        # The same seed is used every time, so that any difference can be
+        # reproduced.
+        rand = random.Random(1)
+        lines = ['def foo():', '    pass', '', '}', 'return x;', 'x', '  ',
+                 '# A comment', 'int y = 1;', 'foo(bar);', u'caf\xe9 = 1;']
+        num_moves = 0
+
+        for i in xrange(1000):
+            old = [rand.choice(lines) for j in xrange(rand.randint(0, 30))]
+            new = list(old)
+
+            for j in xrange(rand.randint(1, 6)):
+                k = rand.randint(0, len(new))
+                change = rand.random()
+
+                if change < 0.6 and k < len(new):
+                    # Move a block of lines somewhere else.
+                    block = new[k:k + rand.randint(1, 5)]
+                    del new[k:k + len(block)]
+                    k = rand.randint(0, len(new))
+                    new[k:k] = block
+                elif change < 0.8:
+                    new[k:k] = [rand.choice(lines)
+                                for n in xrange(rand.randint(1, 4))]
+                elif k < len(new):
+                    new[k] = rand.choice(lines)
+
+            moves = [opcode[-1].get('moved', {})
+                     for opcode in diffutils.opcodes_with_metadata(
+                         diffutils.Differ(old, new))]
+            self.assertEqual(moves,
+                             get_reference_moves(diffutils.Differ(old, new)),
+                             'Different moves for %r and %r' % (old, new))
+
+            if [moved for moved in moves if moved]:
+                num_moves += 1
+
+        # Make sure enough of the diffs had moves to be a useful test.
+        self.assertTrue(num_moves > 100)
+
+    def testWhitespaceOnlyLines(self):
+        """Testing whitespace-only line detection"""
+        old = ['if (x) {', '    return  1;', '    return 2;', '}']
+        new = ['if (x) {', '\treturn 1;', '\treturn 3;', '}']
+        differ = diffutils.Differ(old, new)
+
+        opcodes = list(diffutils.opcodes_with_metadata(differ))
+        self.assertEqual(opcodes[1][:5], ('replace', 1, 3, 1, 3))
+        self.assertEqual(opcodes[1][-1]['whitespace_lines'], [(2, 2)])
+        self.assertFalse(opcodes[1][-1]['whitespace_chunk'])
+
+    def testGenerateChunksInWorkerProcess(self):
+        """Testing generating chunks in a worker process"""
+        old = self._get_file('orig_src', 'helloworld.js')
+        new = self._get_file('new_src', 'helloworld.js')
+        options = {
+            'filename': 'helloworld.js',
+            'source_display_name': 'helloworld.js',
+            'dest_display_name': 'helloworld.js',
+            'encoding': 'iso-8859-15',
+            'compat_version': diffutils.DEFAULT_DIFF_COMPAT_VERSION,
+            'enable_syntax_highlighting': True,
+            'syntax_highlighting_threshold': 0,
+            'ignore_space': True,
+            'context_num_lines': 5,
+            'description': 'helloworld.js',
+        }
+
+        layout = diffutils.generate_chunk_layout(old, new, **options)
+        lines = diffutils.generate_chunk_lines(old, new, layout['chunks'],
+                                               layout['ranges'], 1,
+                                               layout['num_lines'] + 1,
+                                               **options)
+
+        try:
+            pool = diffutils._make_chunk_process_pool(1)
+        except ImportError:
+            raise nose.SkipTest('multiprocessing is not available')
+
+        try:
+            self.assertEqual(
+                pool.apply(diffutils.generate_chunk_layout, (old, new),
+                           options),
+                layout)
+            self.assertEqual(
+                pool.apply(diffutils.generate_chunk_lines,
+                           (old, new, layout['chunks'], layout['ranges'], 1,
+                            layout['num_lines'] + 1),
+                           options),
+                lines)
+        finally:
+            pool.close()
+
+    def testGenerateChunkLinesInWindows(self):
+        """Testing generating chunk lines a window at a time"""
+        old = self._get_file('orig_src', 'movetest1.c')
+        new = self._get_file('new_src', 'movetest1.c')
+        options = {
+            'filename': 'movetest1.c',
+            'source_display_name': 'movetest1.c',
+            'dest_display_name': 'movetest1.c',
+            'encoding': 'iso-8859-15',
+            'compat_version': diffutils.DEFAULT_DIFF_COMPAT_VERSION,
+            'enable_syntax_highlighting': False,
+            'syntax_highlighting_threshold': 0,
+            'ignore_space': True,
+            'context_num_lines': 2,
+            'description': 'movetest1.c',
+        }
+
+        chunks = list(diffutils.generate_chunks(old, new, **options))
+        layout = diffutils.generate_chunk_layout(old, new, **options)
+        window_size = 7
+        chunk_lines = {}
+
+        for first_line in xrange(1, layout['num_lines'] + 1, window_size):
+            for i, lines in diffutils.generate_chunk_lines(
+                old, new, layout['chunks'], layout['ranges'], first_line,
+                first_line + window_size, **options):
+                self.assertTrue(lines)
+                self.assertTrue(first_line <= lines[0][0])
+                self.assertTrue(lines[-1][0] < first_line + window_size)
+                chunk_lines.setdefault(i, []).extend(lines)
+
+        self.assertEqual(len(layout['chunks']), len(chunks))
+
+        for i, chunk in enumerate(layout['chunks']):
+            self.assertEqual(chunk_lines[i], chunks[i]['lines'])
+            self.assertEqual(chunk['numlines'], chunks[i]['numlines'])
+            self.assertEqual(chunk['meta'], chunks[i]['meta'])
+
+    def testChunkLinesHighlightRegions(self):
+        """Testing chunk lines highlighting changed regions"""
+        chunks = list(diffutils.generate_chunks(
+            'int a = 1;\n', 'int b = 2;\n',
+            filename='test.c',
+            source_display_name='test.c',
+            dest_display_name='test.c',
+            encoding='iso-8859-15',
+            compat_version=diffutils.DEFAULT_DIFF_COMPAT_VERSION,
+            enable_syntax_highlighting=False,
+            syntax_highlighting_threshold=0,
+            ignore_space=True,
+            context_num_lines=2,
+            description='test.c'))
+
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0]['change'], 'replace')
+
+        line = chunks[0]['lines'][0]
+        self.assertEqual(line[2],
+                         'int <span class="hl">a</span> = '
+                         '<span class="hl">1</span>;')
+        self.assertEqual(line[5],
+                         'int <span class="hl">b</span> = '
+                         '<span class="hl">2</span>;')
+        self.assertEqual(line[3], [(4, 5), (8, 9)])
+        self.assertEqual(line[6], [(4, 5), (8, 9)])
+        self.assertEqual(len(line), 8)
 
 
 class HighlightRegionTest(TestCase):
@@ -404,11 +839,28 @@ class HighlightRegionTest(TestCase):
             'foo=<span class="ab"><span class="hl">&quot;foo&quot;' +
             '</span></span>)')
 
+    def testHighlightRegions(self):
+        """Testing highlight_regions with regions past the end of the text"""
+        self.assertEqual(diffutils.highlight_regions('abc', [(1, 5)]),
+                         'a<span class="hl">bc</span>')
+
+        self.assertEqual(
+            diffutils.highlight_regions('abcdef', [(0, 4), (1, 3), (5, 6)]),
+            '<span class="hl">abcd</span>e<span class="hl">f</span>')
+
+    def testUnhighlightRegions(self):
+        """Testing unhighlight_regions"""
+        markup = 'foo=<span class="ab">&quot;foo&quot;</span>)'
+        self.assertEqual(
+            diffutils.unhighlight_regions(
+                diffutils.highlight_regions(markup, [(2, 9)])),
+            markup)
+        self.assertEqual(diffutils.unhighlight_regions(markup), markup)
 
-class DbTests(TestCase):
+
+class DbTests(TestDataMixin, TestCase):
     """Unit tests for database operations."""
     fixtures = ['test_scmtools.json']
-    PREFIX = os.path.join(os.path.dirname(__file__), 'testdata')
 
     def testLongFilenames(self):
         """Testing using long filenames (1024 characters) in FileDiff."""
@@ -448,3 +900,341 @@ class DbTests(TestCase):
         filediff2.save()
 
         self.assertEquals(filediff1.diff_hash, filediff2.diff_hash)
+
+    def testDiffDataCompressed(self):
+        """Testing that diffs and parent diffs are stored compressed"""
+        repository = Repository.objects.get(pk=1)
+        diffset = DiffSet.objects.create(name='test',
+                                         revision=1,
+                                         repository=repository)
+        data = self._get_file('diffs', 'context', 'foo.c.diff')
+        parent_data = self._get_file('diffs', 'context', 'README.diff')
+
+        filediff = FileDiff(diff=data, parent_diff=parent_data,
+                            diffset=diffset)
+        filediff.save()
+
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertEqual(filediff.diff, data)
+        self.assertEqual(filediff.parent_diff, parent_data)
+
+        diff_data = filediff.diff_hash
+        self.assertEqual(diff_data.binary, "")
+        self.assertEqual(diff_data.compressed_binary[0],
+                         FileDiffData.COMPRESSED_ZLIB)
+        self.assertTrue(len(diff_data.compressed_binary) < len(data))
+
+    def testIterRawDiff(self):
+        """Testing DiffParser.iter_raw_diff"""
+        repository = Repository.objects.get(pk=1)
+        diffset = DiffSet.objects.create(name='test',
+                                         revision=1,
+                                         repository=repository)
+        diffs = [
+            self._get_file('diffs', 'unified', 'foo.c.diff'),
+            self._get_file('diffs', 'unified', 'README.diff'),
+        ]
+
+        for diff in diffs:
+            FileDiff.objects.create(diff=diff, diffset=diffset)
+
+        parser = diffparser.DiffParser('')
+        self.assertEqual(list(parser.iter_raw_diff(diffset)), diffs)
+        self.assertEqual(parser.raw_diff(diffset), ''.join(diffs))
+
+    def testDiffStats(self):
+        """Testing computing statistics for diffs uploaded without them"""
+        repository = Repository.objects.get(pk=1)
+        diffset = DiffSet.objects.create(name='test',
+                                         revision=1,
+                                         repository=repository)
+        FileDiff.objects.create(
+            diff=self._get_file('diffs', 'unified', 'foo.c.diff'),
+            diffset=diffset)
+        FileDiff.objects.create(
+            diff=self._get_file('diffs', 'unified', 'README.diff'),
+            diffset=diffset)
+
+        diffset = DiffSet.objects.get(pk=diffset.pk)
+        self.assertEqual(diffset.lines_added, None)
+        self.assertEqual(diffset.get_stats(), {
+            'lines_added': 7,
+            'lines_removed': 3,
+            'hunk_count': 2,
+        })
+
+        # The statistics are stored once they've been computed.
+        diffset = DiffSet.objects.get(pk=diffset.pk)
+        self.assertEqual(diffset.lines_added, 7)
+
+        for filediff in diffset.files.all():
+            self.assertNotEqual(filediff.lines_added, None)
+
+    def testDiffDataBase64(self):
+        """Testing reading and migrating diffs stored in base64"""
+        repository = Repository.objects.get(pk=1)
+        diffset = DiffSet.objects.create(name='test',
+                                         revision=1,
+                                         repository=repository)
+        data = self._get_file('diffs', 'context', 'foo.c.diff')
+        hashkey = hashlib.sha1(data).hexdigest()
+
+        FileDiffData.objects.get_or_create(binary_hash=hashkey,
+                                           defaults={'binary': data})
+        filediff = FileDiff.objects.create(
+            diffset=diffset,
+            diff_hash=FileDiffData.objects.get(pk=hashkey))
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertEqual(filediff.diff_hash.compressed_binary, None)
+        self.assertEqual(filediff.diff, data)
+
+        call_command('compressdiffs', verbosity=0)
+
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertNotEqual(filediff.diff_hash.compressed_binary, None)
+        self.assertEqual(filediff.diff, data)
+
+
+class PatchedFileCacheTests(TestDataMixin, TestCase):
+    """Unit tests for the patched file cache."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='reviewboard-tests.')
+
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_patched_file_cache_dir', self.cache_dir)
+        siteconfig.set('diffviewer_patched_file_cache_max_size', 1024)
+        siteconfig.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_patched_file_cache_dir', '')
+        siteconfig.save()
+
+    def testDiskCache(self):
+        """Testing the on-disk patched file cache"""
+        old = self._get_file('orig_src', 'foo.c')
+        new = self._get_file('new_src', 'foo.c')
+        diff = self._get_file('diffs', 'unified', 'foo.c.diff')
+
+        patched = diffutils.get_cached_patched_file(old, None,
+                                                    lambda: diff, 'foo.c')
+        self.assertEqual(patched, new)
+
+        old_hash = hashlib.sha1(old).hexdigest()
+        diff_hash = hashlib.sha1(diff).hexdigest()
+        store = diffutils._get_patched_file_store()
+        self.assertEqual(
+            store.get_by_key('patched-file-%s-%s' % (old_hash, diff_hash)),
+            new)
+
+        # A hit in the disk cache shouldn't need the diff at all.
+        cache.clear()
+        patched = diffutils.get_cached_patched_file(old, diff_hash,
+                                                    lambda: None, 'foo.c')
+        self.assertEqual(patched, new)
+
+        # The next lookup comes from the main cache.
+        diffutils.get_cached_patched_file(old, diff_hash, lambda: None,
+                                          'foo.c')
+
+        stats = diffutils.get_patched_file_cache_stats()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['disk_hits'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 0)
+
+
+class HighlightCacheTests(TestCase):
+    """Unit tests for the syntax highlighting cache."""
+    def setUp(self):
+        cache.clear()
+
+    def testSharedBetweenFiles(self):
+        """Testing sharing highlighted lines between diffs of the same file"""
+        lines, content_hash = diffutils._prepare_chunk_file(
+            'int main()\n{\n    return 0;\n}\n', 'iso-8859-15')
+
+        markup = diffutils.get_highlighted_lines(lines, content_hash, 0,
+                                                 len(lines), 'main.c')
+        self.assertEqual(len(markup), len(lines))
+        self.assertTrue('<span' in markup[0])
+
+        # The same content under another filename with the same lexer
+        # should come straight from the cache.
+        highlight = diffutils.pygments.highlight
+
+        def fail_highlight(*args, **kwargs):
+            self.fail('The file was highlighted again')
+
+        diffutils.pygments.highlight = fail_highlight
+
+        try:
+            self.assertEqual(
+                diffutils.get_highlighted_lines(lines, content_hash, 1, 3,
+                                                'other.c'),
+                markup[1:3])
+        finally:
+            diffutils.pygments.highlight = highlight
+
+    def testMarkupCache(self):
+        """Testing loading highlighted lines once for several windows"""
+        lines, content_hash = diffutils._prepare_chunk_file(
+            'int main()\n{\n    return 0;\n}\n', 'iso-8859-15')
+        markup_cache = {}
+
+        markup = diffutils.get_highlighted_lines(lines, content_hash, 0, 2,
+                                                 'main.c', markup_cache)
+        self.assertEqual(len(markup_cache), 1)
+
+        # Later windows are sliced from the loaded markup, without going
+        # to the cache.
+        cache_memoize = diffutils.cache_memoize
+
+        def fail_cache_memoize(*args, **kwargs):
+            self.fail('The markup was loaded from the cache again')
+
+        diffutils.cache_memoize = fail_cache_memoize
+
+        try:
+            self.assertEqual(
+                markup + diffutils.get_highlighted_lines(
+                    lines, content_hash, 2, 4, 'main.c', markup_cache),
+                markup_cache.values()[0])
+        finally:
+            diffutils.cache_memoize = cache_memoize
+
+    def testMultiLineConstructs(self):
+        """Testing highlighting constructs that span many lines"""
+        data = 'int i;\n' * 498 + '/*\n * A comment\n * more\n */\nint j;\n'
+        lines, content_hash = diffutils._prepare_chunk_file(data,
+                                                            'iso-8859-15')
+
+        markup = diffutils.get_highlighted_lines(lines, content_hash, 499,
+                                                 502, 'main.c')
+        self.assertEqual(len(markup), 3)
+
+        for line in markup:
+            self.assertTrue('class="cm"' in line)
+
+
+class PrerenderQueueTests(TestCase):
+    """Unit tests for the diff pre-rendering queue."""
+    def testPriorityAndDuplicates(self):
+        """Testing LocalPrerenderQueue job order and duplicate jobs"""
+        gate = threading.Event()
+        run_ids = []
+
+        class TestJob(PrerenderJob):
+            def run(self):
+                if self.diffset_id == 1:
+                    gate.wait(10)
+
+                run_ids.append(self.diffset_id)
+
+        queue = LocalPrerenderQueue(1)
+
+        try:
+            blocker = TestJob(1)
+            self.assertTrue(queue.add(blocker))
+            self._wait_for(lambda: blocker.status == PrerenderJob.RUNNING)
+
+            self.assertTrue(queue.add(TestJob(2, priority=PRIORITY_LOW)))
+            self.assertTrue(queue.add(TestJob(3, priority=PRIORITY_NORMAL)))
+
+            # A duplicate isn't queued again, but raises the priority of the
+            # queued job.
+            self.assertFalse(queue.add(TestJob(2, priority=PRIORITY_HIGH)))
+            self.assertEqual(len(queue.get_jobs()), 3)
+
+            gate.set()
+            self._wait_for(lambda: len(run_ids) == 3 and
+                                   not queue._jobs)
+
+            self.assertEqual(run_ids, [1, 2, 3])
+            self.assertEqual([job.status for job in queue.get_jobs()],
+                             [PrerenderJob.DONE] * 3)
+        finally:
+            gate.set()
+            queue.shutdown()
+
+    def _wait_for(self, func):
+        for i in xrange(1000):
+            if func():
+                return
+
+            time.sleep(0.01)
+
+        self.fail('Timed out waiting for the pre-render queue')
+
+
+class PrerenderTests(TestCase):
+    """Unit tests for pre-rendering diffs."""
+    fixtures = ['test_scmtools.json']
+
+    def setUp(self):
+        cache.clear()
+
+        svn_repo_path = os.path.join(os.path.dirname(__file__),
+                                     '..', 'scmtools', 'testdata', 'svn_repo')
+        self.repository = Repository.objects.create(
+            name='Subversion SVN',
+            path='file://' + svn_repo_path,
+            tool=Tool.objects.get(name='Subversion'))
+
+    def testFillsViewCaches(self):
+        """Testing prerender_diff filling the caches the diff viewer reads"""
+        diffset = self._create_diffset()
+        filediff = diffset.files.get()
+
+        prerender_diff(diffset, base_url='/r/1/')
+
+        # The chunks are cached under the key get_diff_files uses.
+        key = 'diff-sidebyside-'
+
+        if diffutils.get_enable_highlighting(AnonymousUser()):
+            key += 'hl-'
+
+        self.assertTrue(cache.has_key(
+            make_cache_key('%s%s-layout' % (key, filediff.pk))))
+
+        # The diff viewer should find the rendered file in the cache, as
+        # it's first shown, without loading or rendering anything.
+        calls = []
+        load_chunk_lines = diffviews.load_chunk_lines
+        render_to_string = diffviews.render_to_string
+        diffviews.load_chunk_lines = \
+            lambda *args, **kwargs: calls.append('load_chunk_lines')
+        diffviews.render_to_string = \
+            lambda *args, **kwargs: calls.append('render_to_string')
+
+        try:
+            request = HttpRequest()
+            request.user = AnonymousUser()
+            request.GET['index'] = '0'
+
+            response = diffviews.view_diff_fragment(request, diffset.pk,
+                                                    filediff.pk, '/r/1/')
+        finally:
+            diffviews.load_chunk_lines = load_chunk_lines
+            diffviews.render_to_string = render_to_string
+
+        self.assertEqual(calls, [])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('Makefile' in response.content)
+
+    def _create_diffset(self):
+        f = open(os.path.join(os.path.dirname(__file__), '..', 'scmtools',
+                              'testdata', 'svn_makefile.diff'), 'r')
+        data = f.read()
+        f.close()
+
+        diff_file = SimpleUploadedFile('svn_makefile.diff', data)
+        form = UploadDiffForm(self.repository,
+                              data={'basedir': '/trunk'},
+                              files={'path': diff_file})
+        self.assertTrue(form.is_valid())
+
+        return form.create(diff_file)
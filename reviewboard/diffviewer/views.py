@@ -15,7 +15,8 @@ from djblets.util.misc import cache_memoize, get_object_or_none
 from reviewboard.diffviewer.models import DiffSet, FileDiff
 from reviewboard.diffviewer.diffutils import UserVisibleError, \
                                              get_diff_files, \
-                                             get_enable_highlighting
+                                             get_enable_highlighting, \
+                                             load_chunk_lines
 
 
 def build_diff_fragment(request, file, chunkindex, highlighting, collapseall,
@@ -53,9 +54,21 @@ def build_diff_fragment(request, file, chunkindex, highlighting, collapseall,
 
     context['file'] = file
 
-    return cache_memoize(key,
-        lambda: render_to_string(template_name,
-                                 RequestContext(request, context)))
+    def render_fragment():
+        # Collapsed chunks are rendered without their lines, so there's no
+        # need to load them.
+        if collapseall:
+            chunks = [chunk for chunk in file['chunks']
+                      if not chunk['collapsable']]
+        else:
+            chunks = file['chunks']
+
+        load_chunk_lines(file, chunks)
+
+        return render_to_string(template_name,
+                                RequestContext(request, context))
+
+    return cache_memoize(key, render_fragment)
 
 
 def get_collapse_diff(request):
@@ -145,10 +158,12 @@ def view_diff(request, diffset, interdiffset=None, extra_context={},
 
             if filediff.diffset == interdiffset:
                 temp_files = get_diff_files(interdiffset, filediff,
-                                            None, highlighting, True)
+                                            None, highlighting, True,
+                                            load_lines=False)
             else:
                 temp_files = get_diff_files(diffset, filediff,
-                                            interdiffset, highlighting, True)
+                                            interdiffset, highlighting, True,
+                                            load_lines=False)
 
             if temp_files:
                 file_temp = temp_files[0]
@@ -190,7 +205,7 @@ def view_diff_fragment(
 
     def get_requested_diff_file(get_chunks=True):
         files = get_diff_files(diffset, filediff, interdiffset, highlighting,
-                               get_chunks)
+                               get_chunks, load_lines=False)
 
         if files:
             assert len(files) == 1
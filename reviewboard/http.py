@@ -0,0 +1,59 @@
+from django.db import close_connection
+from django.http import HttpResponse
+
+
+class StreamingHttpResponse(HttpResponse):
+    """
+    An HTTP response whose content is generated as it's sent.
+
+    The content is an iterable of strings that's only consumed when the
+    response is written out, so that large responses never have to be held
+    in memory all at once. The GZip and conditional GET middleware in
+    reviewboard.middleware know not to read the whole response in.
+
+    Accessing ``content`` still works, but reads in the rest of the stream.
+
+    Django closes the database connections once the view returns, which is
+    before the stream is read. Any queries made by the stream open new
+    connections, so those are closed in close(), which the server calls
+    once the response has been sent.
+    """
+    streaming = True
+
+    def __init__(self, stream, *args, **kwargs):
+        HttpResponse.__init__(self, '', *args, **kwargs)
+        self.stream = stream
+
+        # Django 1.4 fills in _container through the content property,
+        # which is replaced here, but HttpResponse.close still reads it.
+        self._container = []
+
+    def _get_content(self):
+        content = ''.join(self)
+        self.stream = [content]
+
+        return content
+
+    def _set_content(self, value):
+        self.stream = [value]
+
+    content = property(_get_content, _set_content)
+
+    def __iter__(self):
+        # The stream is looked up now, rather than when iteration starts,
+        # so that middleware can replace it with a wrapper around this
+        # iterator.
+        return self._iter_stream(self.stream)
+
+    def _iter_stream(self, stream):
+        for chunk in stream:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode(self._charset)
+
+            yield chunk
+
+    def close(self):
+        try:
+            HttpResponse.close(self)
+        finally:
+            close_connection()
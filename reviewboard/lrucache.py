@@ -0,0 +1,130 @@
+from collections import deque
+
+
+class LRUCache(object):
+    """
+    A dictionary-like cache that forgets the least recently used entries.
+
+    Entries are marked as recently used when they're set or looked up with
+    get(). If max_entries is set, the least recently used entries are
+    removed once there are more than that. Otherwise, callers can remove
+    them with popitem().
+
+    The order of the entries is kept as a queue of (stamp, key) pairs,
+    oldest first. Using an entry gives it a new stamp and adds it to the
+    end of the queue, rather than moving it, so that every operation
+    takes constant time. Pairs whose stamp no longer matches their entry
+    are skipped, and cleared out once they make up most of the queue.
+
+    This doesn't do any locking. Caches shared between threads must be
+    locked by the caller.
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._order = deque()
+        self._stamp = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Returns the value for a key, marking it as the most recently used.
+
+        If the key isn't in the cache, default is returned.
+        """
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return default
+
+        self._touch(key, entry)
+
+        return entry[0]
+
+    def set(self, key, value):
+        """
+        Sets the value for a key, marking it as the most recently used.
+
+        If this puts the cache over max_entries, the least recently used
+        entries are removed.
+        """
+        entry = self._entries.get(key)
+
+        if entry is None:
+            entry = [value, None]
+            self._entries[key] = entry
+        else:
+            entry[0] = value
+
+        self._touch(key, entry)
+
+        if self.max_entries is not None:
+            while len(self._entries) > self.max_entries:
+                self.popitem()
+
+    def pop(self, key, default=None):
+        """
+        Removes a key from the cache and returns its value.
+
+        If the key isn't in the cache, default is returned.
+        """
+        entry = self._entries.pop(key, None)
+
+        if entry is None:
+            return default
+
+        self._compact()
+
+        return entry[0]
+
+    def popitem(self):
+        """
+        Removes the least recently used entry and returns it.
+
+        The entry is returned as a (key, value) tuple. KeyError is raised
+        if the cache is empty.
+        """
+        while self._order:
+            stamp, key = self._order.popleft()
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[1] == stamp:
+                del self._entries[key]
+                return key, entry[0]
+
+        raise KeyError('popitem(): cache is empty')
+
+    def keys(self):
+        """Returns the keys in the cache, least recently used first."""
+        return [key
+                for stamp, key in self._order
+                if self._is_current(stamp, key)]
+
+    def clear(self):
+        """Removes all entries from the cache."""
+        self._entries.clear()
+        self._order.clear()
+
+    def _touch(self, key, entry):
+        self._stamp += 1
+        entry[1] = self._stamp
+        self._order.append((self._stamp, key))
+        self._compact()
+
+    def _compact(self):
+        if len(self._order) > 2 * len(self._entries) + 16:
+            self._order = deque([
+                (stamp, key)
+                for stamp, key in self._order
+                if self._is_current(stamp, key)
+            ])
+
+    def _is_current(self, stamp, key):
+        entry = self._entries.get(key)
+
+        return entry is not None and entry[1] == stamp
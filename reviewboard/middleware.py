@@ -0,0 +1,89 @@
+import re
+import zlib
+
+from django.middleware import gzip, http
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+
+
+re_accepts_gzip = re.compile(r'\bgzip\b')
+
+
+class GZipMiddleware(gzip.GZipMiddleware):
+    """
+    Compresses responses for browsers that accept gzip.
+
+    Streaming responses are compressed a chunk at a time as they're sent,
+    rather than being read into memory first.
+    """
+    def process_response(self, request, response):
+        if not getattr(response, 'streaming', False):
+            return super(GZipMiddleware, self).process_response(request,
+                                                                response)
+
+        if response.status_code != 200:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        if (response.has_header('Content-Encoding') or
+            not re_accepts_gzip.search(
+                request.META.get('HTTP_ACCEPT_ENCODING', ''))):
+            return response
+
+        # MSIE has issues with gzipped responses of various content types,
+        # so these are left alone, as Django's middleware does.
+        if 'msie' in request.META.get('HTTP_USER_AGENT', '').lower():
+            ctype = response.get('Content-Type', '').lower()
+
+            if not ctype.startswith('text/') or 'javascript' in ctype:
+                return response
+
+        response.stream = self._compress_stream(iter(response))
+        response['Content-Encoding'] = 'gzip'
+
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
+
+        return response
+
+    def _compress_stream(self, stream):
+        # A window size of 16 + MAX_WBITS tells zlib to write a gzip header
+        # and trailer.
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        for chunk in stream:
+            data = compressor.compress(chunk)
+
+            if data:
+                yield data
+
+        yield compressor.flush()
+
+
+class ConditionalGetMiddleware(http.ConditionalGetMiddleware):
+    """
+    Handles conditional GET requests.
+
+    Streaming responses don't know their length up front, so unlike other
+    responses, they aren't given a Content-Length. Their ETag and
+    Last-Modified headers are checked the same way, and if either matches,
+    the content is dropped without being read.
+    """
+    def process_response(self, request, response):
+        if not getattr(response, 'streaming', False):
+            return super(ConditionalGetMiddleware, self).process_response(
+                request, response)
+
+        response['Date'] = http_date()
+
+        if ((response.has_header('ETag') and
+             request.META.get('HTTP_IF_NONE_MATCH') == response['ETag']) or
+            (response.has_header('Last-Modified') and
+             request.META.get('HTTP_IF_MODIFIED_SINCE') ==
+             response['Last-Modified'])):
+            response.status_code = 304
+            response.content = ''
+            response['Content-Length'] = '0'
+
+        return response
@@ -0,0 +1,38 @@
+from reviewboard.signals import initializing
+
+
+def _review_request_published_cb(sender, user, review_request, changedesc,
+                                 **kwargs):
+    """
+    Listens to the ``review_request_published`` signal and pre-renders the
+    newly published diff, which reviewers are about to look at.
+    """
+    from reviewboard.diffviewer.models import DiffSet
+    from reviewboard.diffviewer.prerender import PRIORITY_HIGH, \
+                                                 queue_prerender
+
+    if changedesc and 'diff' not in changedesc.fields_changed:
+        return
+
+    try:
+        diffset = review_request.diffset_history.diffsets.latest()
+    except DiffSet.DoesNotExist:
+        return
+
+    queue_prerender(diffset, base_url=review_request.get_absolute_url(),
+                    priority=PRIORITY_HIGH)
+
+
+def connect_signals(**kwargs):
+    """
+    Listens to the ``initializing`` signal and connects the review request
+    signal handlers, once django is loaded.
+    """
+    from reviewboard.reviews.models import ReviewRequest
+    from reviewboard.reviews.signals import review_request_published
+
+    review_request_published.connect(_review_request_published_cb,
+                                     sender=ReviewRequest)
+
+
+initializing.connect(connect_signals)
@@ -410,6 +410,46 @@ class ReviewCountColumn(Column):
         return "%s#last-review" % review_request.get_absolute_url()
 
 
+class DiffSizeColumn(Column):
+    """
+    A column showing the number of lines added and removed in the latest
+    diff on a review request.
+
+    This uses the statistics stored when the diff was uploaded. Diffs
+    uploaded before those were stored show nothing until they're viewed.
+    """
+    def __init__(self, label=_("Diff Size"),
+                 detailed_label=_("Diff Size (Lines Added/Removed)"),
+                 *args, **kwargs):
+        Column.__init__(self, label=label, detailed_label=detailed_label,
+                        *args, **kwargs)
+        self.shrink = True
+
+    def render_data(self, review_request):
+        if review_request.diff_lines_added is None:
+            return ""
+
+        return '<span class="diff-size-added">+%d</span> ' \
+               '<span class="diff-size-removed">-%d</span>' % \
+            (review_request.diff_lines_added,
+             review_request.diff_lines_removed)
+
+    def augment_queryset(self, queryset):
+        latest_diffset_sql = """
+            SELECT diffviewer_diffset.%s
+              FROM diffviewer_diffset
+              WHERE diffviewer_diffset.history_id =
+                    reviews_reviewrequest.diffset_history_id
+              ORDER BY diffviewer_diffset.revision DESC
+              LIMIT 1
+        """
+
+        return queryset.extra(select={
+            'diff_lines_added': latest_diffset_sql % 'lines_added',
+            'diff_lines_removed': latest_diffset_sql % 'lines_removed',
+        })
+
+
 class ReviewRequestDataGrid(DataGrid):
     """
     A datagrid that displays a list of review requests.
@@ -456,6 +496,7 @@ class ReviewRequestDataGrid(DataGrid):
         css_class=lambda r: ageid(r.last_updated))
 
     review_count = ReviewCountColumn()
+    diff_size = DiffSizeColumn()
 
     target_groups = GroupsColumn()
     target_people = PeopleColumn()
@@ -7,6 +7,7 @@ from django.utils.translation import ugettext as _
 
 from reviewboard.diffviewer import forms as diffviewer_forms
 from reviewboard.diffviewer.models import DiffSet
+from reviewboard.diffviewer.prerender import PRIORITY_LOW, queue_prerender
 from reviewboard.reviews.errors import OwnershipError
 from reviewboard.reviews.models import DefaultReviewer, Group, ReviewRequest, \
                                        ReviewRequestDraft, Screenshot
@@ -301,6 +302,21 @@ class UploadDiffForm(diffviewer_forms.UploadDiffForm):
 
             diffset.save()
 
+        # Render the new diff ahead of time, along with the interdiff
+        # against the last public diff, which is viewed less often.
+        base_url = self.review_request.get_absolute_url()
+        queue_prerender(diffset, base_url=base_url)
+
+        try:
+            latest_diffset = \
+                self.review_request.diffset_history.diffsets.latest()
+
+            if latest_diffset != diffset:
+                queue_prerender(latest_diffset, diffset, base_url=base_url,
+                                priority=PRIORITY_LOW)
+        except DiffSet.DoesNotExist:
+            pass
+
         return diffset
 
 
@@ -2,6 +2,7 @@ import logging
 import os
 
 from django.contrib.auth.models import AnonymousUser, User
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse
 from django.template import Context, Template
 from django.test import TestCase
@@ -9,7 +10,13 @@ from django.test import TestCase
 from djblets.siteconfig.models import SiteConfiguration
 
 from reviewboard.accounts.models import Profile, LocalSiteProfile
-from reviewboard.reviews.forms import DefaultReviewerForm, GroupForm
+from reviewboard.changedescs.models import ChangeDescription
+from reviewboard.diffviewer import prerender
+from reviewboard.diffviewer.models import DiffSet
+from reviewboard.reviews import _review_request_published_cb
+from reviewboard.reviews import forms as reviews_forms
+from reviewboard.reviews.forms import DefaultReviewerForm, GroupForm, \
+                                      UploadDiffForm
 from reviewboard.reviews.models import DefaultReviewer, \
                                        Group, \
                                        ReviewRequest, \
@@ -1631,3 +1638,87 @@ class UserInfoboxTests(TestCase):
         user.save()
 
         self.client.get(local_site_reverse('user-infobox', args=['test']))
+
+
+class PrerenderTests(TestCase):
+    """Tests for queueing diffs to be pre-rendered."""
+    fixtures = ['test_users', 'test_reviewrequests', 'test_scmtools']
+
+    def setUp(self):
+        self.queued = []
+
+        def queue_prerender(diffset, interdiffset=None, base_url=None,
+                            priority=prerender.PRIORITY_NORMAL):
+            self.queued.append((diffset, interdiffset, base_url, priority))
+
+        self.orig_queue_prerender = prerender.queue_prerender
+        prerender.queue_prerender = queue_prerender
+        reviews_forms.queue_prerender = queue_prerender
+
+    def tearDown(self):
+        prerender.queue_prerender = self.orig_queue_prerender
+        reviews_forms.queue_prerender = self.orig_queue_prerender
+
+    def testUploadDiff(self):
+        """Testing UploadDiffForm queueing the diff and interdiff"""
+        svn_repo_path = os.path.join(os.path.dirname(__file__),
+                                     '..', 'scmtools', 'testdata', 'svn_repo')
+        repository = Repository.objects.create(
+            name='Subversion SVN',
+            path='file://' + svn_repo_path,
+            tool=Tool.objects.get(name='Subversion'))
+        review_request = ReviewRequest.objects.create(
+            User.objects.get(username='doc'), repository)
+        base_url = review_request.get_absolute_url()
+
+        first_diffset = self._upload_diff(review_request, True)
+        self.assertEqual(self.queued, [
+            (first_diffset, None, base_url, prerender.PRIORITY_NORMAL),
+        ])
+
+        self.queued = []
+        diffset = self._upload_diff(review_request, False)
+        self.assertEqual(self.queued, [
+            (diffset, None, base_url, prerender.PRIORITY_NORMAL),
+            (first_diffset, diffset, base_url, prerender.PRIORITY_LOW),
+        ])
+
+    def testPublished(self):
+        """Testing pre-rendering diffs when review requests are published"""
+        diffset = DiffSet.objects.get(pk=1)
+        review_request = ReviewRequest.objects.get(
+            diffset_history=diffset.history)
+        user = review_request.submitter
+
+        # A change that doesn't include the diff doesn't queue anything.
+        changedesc = ChangeDescription(fields_changed={
+            'summary': {'old': [('Old',)], 'new': [('New',)]},
+        })
+        _review_request_published_cb(ReviewRequest, user, review_request,
+                                     changedesc)
+        self.assertEqual(self.queued, [])
+
+        changedesc.fields_changed['diff'] = {'added': [(diffset.pk,)]}
+        _review_request_published_cb(ReviewRequest, user, review_request,
+                                     changedesc)
+
+        # The first publish of a review request has no change description.
+        _review_request_published_cb(ReviewRequest, user, review_request,
+                                     None)
+
+        item = (diffset, None, review_request.get_absolute_url(),
+                prerender.PRIORITY_HIGH)
+        self.assertEqual(self.queued, [item, item])
+
+    def _upload_diff(self, review_request, attach_to_history):
+        f = open(os.path.join(os.path.dirname(__file__), '..', 'scmtools',
+                              'testdata', 'svn_makefile.diff'), 'r')
+        diff_file = SimpleUploadedFile('svn_makefile.diff', f.read())
+        f.close()
+
+        form = UploadDiffForm(review_request,
+                              data={'basedir': '/trunk'},
+                              files={'path': diff_file})
+        self.assertTrue(form.is_valid())
+
+        return form.create(diff_file, attach_to_history=attach_to_history)
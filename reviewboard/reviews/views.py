@@ -38,6 +38,7 @@ from reviewboard.diffviewer.views import view_diff, view_diff_fragment, \
                                          exception_traceback_string
 from reviewboard.extensions.hooks import DashboardHook, \
                                          ReviewRequestDetailHook
+from reviewboard.http import StreamingHttpResponse
 from reviewboard.reviews.datagrids import DashboardDataGrid, \
                                           GroupDataGrid, \
                                           ReviewRequestDataGrid, \
@@ -786,9 +787,8 @@ def raw_diff(request,
     diffset = _query_for_diff(review_request, request.user, revision)
 
     tool = review_request.repository.get_scmtool()
-    data = tool.get_parser('').raw_diff(diffset)
-
-    resp = HttpResponse(data, mimetype='text/x-patch')
+    resp = StreamingHttpResponse(tool.get_parser('').iter_raw_diff(diffset),
+                                 mimetype='text/x-patch')
 
     if diffset.name == 'diff':
         filename = "bug%s.patch" % review_request.bugs_closed.replace(',', '_')
@@ -50,6 +50,17 @@ class SCMTool(object):
     supports_authentication = False
     supports_raw_file_urls = False
 
+    # Whether checking for a file's existence means fetching its contents.
+    # Tools that can check for files without fetching them should set
+    # this to False and override files_exist.
+    files_exist_fetches_contents = True
+
+    # Whether an instance of this tool can be cached and used by several
+    # threads at once. Tools whose clients or connections aren't
+    # thread-safe, or which keep state that goes stale, should leave this
+    # False, in which case a new instance is created each time.
+    shareable = False
+
     # A list of dependencies for this SCMTool. This should be overridden
     # by subclasses. Python module names go in dependencies['modules'] and
     # binary executables go in dependencies['executables'] (but without
@@ -65,6 +76,19 @@ class SCMTool(object):
     def get_file(self, path, revision=None):
         raise NotImplementedError
 
+    def get_files(self, files):
+        """Returns the contents of several files at once.
+
+        ``files`` is a list of (path, revision) tuples. The contents are
+        returned as a list in the same order. A FileNotFoundError is raised
+        if any of the files can't be found.
+
+        By default, this just calls get_file for each file. Tools that can
+        fetch several files in one command or round trip should override
+        this.
+        """
+        return [self.get_file(path, revision) for path, revision in files]
+
     def file_exists(self, path, revision=HEAD):
         try:
             self.get_file(path, revision)
@@ -72,6 +96,16 @@ class SCMTool(object):
         except FileNotFoundError:
             return False
 
+    def files_exist(self, files):
+        """Returns whether each of several files exists.
+
+        ``files`` is a list of (path, revision) tuples. A list of booleans
+        is returned in the same order.
+
+        By default, this just calls file_exists for each file.
+        """
+        return [self.file_exists(path, revision) for path, revision in files]
+
     def parse_diff_revision(self, file_str, revision_str):
         raise NotImplementedError
 
@@ -103,21 +137,34 @@ class SCMTool(object):
         return filename
 
     @classmethod
-    def popen(cls, command, local_site_name=None):
+    def popen(cls, command, local_site_name=None, stdin=None, cwd=None,
+              stderr=subprocess.PIPE, env=None):
         """Launches an application, capturing output.
 
         This wraps subprocess.Popen to provide some common parameters and
         to pass environment variables that may be needed by rbssh, if
         indirectly invoked.
+
+        Long-running processes whose error output isn't read as they go
+        should pass a file for ``stderr``, rather than a pipe, so they
+        don't block once the pipe fills up.
+
+        Any other environment variables the application needs can be passed
+        in ``env``, which is added to the current environment.
         """
-        env = os.environ.copy()
+        popen_env = os.environ.copy()
+
+        if env:
+            popen_env.update(env)
 
         if local_site_name:
-            env['RB_LOCAL_SITE'] = local_site_name
+            popen_env['RB_LOCAL_SITE'] = local_site_name
 
         return subprocess.Popen(command,
-                                env=env,
-                                stderr=subprocess.PIPE,
+                                env=popen_env,
+                                cwd=cwd,
+                                stdin=stdin,
+                                stderr=stderr,
                                 stdout=subprocess.PIPE,
                                 close_fds=(os.name != 'nt'))
 
@@ -1,5 +1,10 @@
+import getpass
+import logging
 import os
 import re
+import shutil
+import socket
+import subprocess
 import tempfile
 import urlparse
 
@@ -7,17 +12,59 @@ from djblets.util.filesystem import is_exe_in_path
 
 from reviewboard.scmtools import sshutils
 from reviewboard.scmtools.core import SCMTool, HEAD, PRE_CREATION
-from reviewboard.scmtools.errors import SCMError, FileNotFoundError, \
+from reviewboard.scmtools.errors import AuthenticationError, SCMError, \
+                                        FileNotFoundError, \
                                         RepositoryNotFoundError
+from reviewboard.scmtools.pools import IdleResourcePool
 from reviewboard.diffviewer.parser import DiffParser, DiffParserError
 
 
 sshutils.register_rbssh('CVS_RSH')
 
 
+# The table used by CVS to scramble pserver passwords. See scramble.c in
+# the CVS source.
+PSERVER_SCRAMBLE_SHIFTS = (
+      0,   1,   2,   3,   4,   5,   6,   7,   8,   9,  10,  11,  12,  13,
+     14,  15,  16,  17,  18,  19,  20,  21,  22,  23,  24,  25,  26,  27,
+     28,  29,  30,  31, 114, 120,  53,  79,  96, 109,  72, 108,  70,  64,
+     76,  67, 116,  74,  68,  87, 111,  52,  75, 119,  49,  34,  82,  81,
+     95,  65, 112,  86, 118, 110, 122, 105,  41,  57,  83,  43,  46, 102,
+     40,  89,  38, 103,  45,  50,  42, 123,  91,  35, 125,  55,  54,  66,
+    124, 126,  59,  47,  92,  71, 115,  78,  88, 107, 106,  56,  36, 121,
+    117, 104, 101, 100,  69,  73,  99,  63,  94,  93,  39,  37,  61,  48,
+     58, 113,  32,  90,  44,  98,  60,  51,  33,  97,  62,  77,  84,  80,
+     85, 223, 225, 216, 187, 166, 229, 189, 222, 188, 141, 249, 148, 200,
+    184, 136, 248, 190, 199, 170, 181, 204, 138, 232, 218, 183, 255, 234,
+    220, 247, 213, 203, 226, 193, 174, 172, 228, 252, 217, 201, 131, 230,
+    197, 211, 145, 238, 161, 179, 160, 212, 207, 221, 254, 173, 202, 146,
+    224, 151, 140, 196, 205, 130, 135, 133, 143, 246, 192, 159, 244, 239,
+    185, 168, 215, 144, 139, 165, 180, 157, 147, 186, 214, 176, 227, 231,
+    219, 169, 175, 156, 206, 198, 129, 164, 150, 210, 154, 177, 134, 127,
+    182, 128, 158, 208, 162, 132, 167, 209, 149, 241, 153, 251, 237, 236,
+    171, 195, 243, 233, 253, 240, 194, 250, 191, 155, 142, 137, 245, 235,
+    163, 152, 242, 243,
+)
+
+
+class CVSProtocolError(SCMError):
+    """Indicates that a CVS server session stopped responding properly."""
+    pass
+
+
+def scramble_pserver_password(password):
+    """Scrambles a password the way CVS does for pserver and .cvspass."""
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+
+    return 'A' + ''.join([chr(PSERVER_SCRAMBLE_SHIFTS[ord(c)])
+                          for c in password])
+
+
 class CVSTool(SCMTool):
     name = "CVS"
     supports_authentication = True
+    shareable = True
     dependencies = {
         'executables': ['cvs'],
     }
@@ -186,27 +233,460 @@ class CVSDiffParser(DiffParser):
         return linenum
 
 
+class CVSServerSession(object):
+    """A session with a CVS server, using the CVS client/server protocol.
+
+    Running ``cvs checkout`` for each file means starting a new process
+    and connection every time. A session is opened once instead, and
+    files are requested over it one after another.
+
+    pserver repositories are connected to directly. :ext: repositories
+    run ``cvs server`` on the remote host through CVS_RSH (rbssh), and
+    local repositories run ``cvs server`` locally.
+    """
+    PSERVER_PORT = 2401
+
+    VALID_RESPONSES = [
+        'ok', 'error', 'Valid-requests', 'Checked-in', 'New-entry',
+        'Checksum', 'Copy-file', 'Updated', 'Created', 'Update-existing',
+        'Merged', 'Patched', 'Rcs-diff', 'Mode', 'Mod-time', 'Removed',
+        'Remove-entry', 'Set-static-directory', 'Clear-static-directory',
+        'Set-sticky', 'Clear-sticky', 'Template', 'Notified',
+        'Module-expansion', 'Wrapper-rcsOption', 'M', 'Mbinary', 'E', 'F',
+        'MT',
+    ]
+
+    cvsroot_re = re.compile(
+        r'^:(?P<method>pserver|ext|server):'
+        r'(?:(?P<username>[^@/]*?)(?::(?P<password>[^@/]*))?@)?'
+        r'(?P<hostname>[^:/@]+):?(?P<port>\d*)(?P<path>/.*)$')
+    local_cvsroot_re = re.compile(r'^(:(local|fork):)?(?P<path>[^:].*)$')
+    not_found_re = re.compile(r'^cvs \S+: (cannot find module|'
+                              r'could not read RCS file)')
+
+    def __init__(self, cvsroot, local_site_name=None):
+        info = self.parse_cvsroot(cvsroot)
+
+        if not info:
+            raise SCMError('Unsupported CVSROOT for a CVS server session: %s'
+                           % cvsroot)
+
+        (self.method, self.username, self.password, self.hostname,
+         self.port, self.path) = info
+        self.local_site_name = local_site_name
+        self.process = None
+        self.socket = None
+        self.stderr = None
+
+        try:
+            self._connect()
+            self._start()
+        except:
+            self.close()
+            raise
+
+    @classmethod
+    def parse_cvsroot(cls, cvsroot):
+        """Parses a CVSROOT for use in a session.
+
+        This returns a tuple of (method, username, password, hostname, port,
+        path), where the method is one of 'pserver', 'ext' or 'local'.
+        Parts that aren't in the CVSROOT are None. If sessions can't be
+        used with the CVSROOT (for instance, a gserver or kserver CVSROOT),
+        this returns None.
+        """
+        m = cls.cvsroot_re.match(cvsroot)
+
+        if m:
+            method = m.group('method')
+
+            if method == 'server':
+                method = 'ext'
+
+            port = None
+
+            if m.group('port'):
+                port = int(m.group('port'))
+
+            return (method, m.group('username') or None,
+                    m.group('password'), m.group('hostname'), port,
+                    m.group('path'))
+
+        m = cls.local_cvsroot_re.match(cvsroot)
+
+        if m and os.path.isabs(m.group('path')):
+            return ('local', None, None, None, None, m.group('path'))
+
+        return None
+
+    def is_alive(self):
+        if self.process:
+            return self.process.poll() is None
+        else:
+            # A closed connection will be noticed the next time the
+            # session is used.
+            return self.socket is not None
+
+    def checkout(self, filename, revision):
+        """Returns the contents of a file at a revision.
+
+        This is the same as ``cvs checkout -p -r <revision> <filename>``.
+        """
+        self._write_lines([
+            'Argument -p',
+            'Argument -r',
+            'Argument %s' % revision,
+            'Argument %s' % filename,
+            'Directory .',
+            self.path,
+            'co',
+        ])
+
+        success, contents, errmsg = self._read_response()
+
+        # CVS doesn't report an error if the file exists but the revision
+        # doesn't. Nothing is printed at all in that case. When a file is
+        # checked out, a header like this is printed to stderr:
+        #
+        # ===================================================================
+        # Checking out foobar
+        # RCS: /path/to/repo/foobar,v
+        # VERS: 1.1
+        # ***************
+        #
+        # So, if there's no header, or there's a specific recognized
+        # message, call it FileNotFound.
+        if not errmsg or self.not_found_re.match(errmsg):
+            raise FileNotFoundError(filename, revision)
+
+        if not success and not errmsg.startswith('=========='):
+            raise SCMError(errmsg)
+
+        return contents
+
+    def close(self):
+        """Closes the session."""
+        try:
+            if self.process:
+                # cvs server exits as soon as there's nothing more to read.
+                self.process.stdin.close()
+                self.process.wait()
+            elif self.socket:
+                self._rfile.close()
+                self._wfile.close()
+                self.socket.close()
+        except (IOError, OSError):
+            pass
+
+        if self.stderr:
+            self.stderr.close()
+
+        self.process = None
+        self.socket = None
+        self.stderr = None
+
+    def _connect(self):
+        try:
+            if self.method == 'pserver':
+                self.socket = self._open_socket(
+                    self.hostname, self.port or self.PSERVER_PORT)
+                self._rfile = self.socket.makefile('rb')
+                self._wfile = self.socket.makefile('wb')
+            else:
+                if self.method == 'ext':
+                    command = [os.environ.get('CVS_RSH', 'ssh')]
+
+                    if self.username:
+                        command += ['-l', self.username]
+
+                    command += [self.hostname,
+                                os.environ.get('CVS_SERVER', 'cvs'), 'server']
+                else:
+                    command = ['cvs', '-f', 'server']
+
+                # The process's error output goes to a file, so that it
+                # can't fill up a pipe and block the server.
+                self.stderr = tempfile.TemporaryFile()
+                self.process = SCMTool.popen(command, self.local_site_name,
+                                             stdin=subprocess.PIPE,
+                                             stderr=self.stderr)
+                self._rfile = self.process.stdout
+                self._wfile = self.process.stdin
+        except (IOError, OSError, socket.error), e:
+            # socket.error is only a subclass of IOError on Python 2.6 and
+            # newer.
+            raise CVSProtocolError('Unable to connect to the CVS server: %s'
+                                   % e)
+
+        if self.method == 'pserver':
+            self._authenticate()
+
+    def _open_socket(self, hostname, port):
+        """Opens a connection to a pserver.
+
+        Each address the hostname resolves to is tried in turn, so that
+        both IPv4 and IPv6 servers work. This is what
+        socket.create_connection does on Python 2.6 and newer.
+        """
+        error = socket.error('Unable to resolve %s' % hostname)
+
+        for family, socktype, proto, canonname, sockaddr in \
+            socket.getaddrinfo(hostname, port, 0, socket.SOCK_STREAM):
+            sock = None
+
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.connect(sockaddr)
+
+                return sock
+            except socket.error, e:
+                error = e
+
+                if sock is not None:
+                    sock.close()
+
+        raise error
+
+    def _authenticate(self):
+        username = self.username or getpass.getuser()
+
+        if self.password is not None:
+            scrambled_password = scramble_pserver_password(self.password)
+        else:
+            scrambled_password = self._get_cvspass_password(username) or 'A'
+
+        self._write_lines([
+            'BEGIN AUTH REQUEST',
+            self.path,
+            username,
+            scrambled_password,
+            'END AUTH REQUEST',
+        ])
+
+        line = self._read_line()
+
+        if line == 'I HATE YOU':
+            raise AuthenticationError(['password'])
+        elif line != 'I LOVE YOU':
+            # The server sends E and error responses if something else
+            # went wrong.
+            errors = []
+
+            while line.startswith('E '):
+                errors.append(line[2:])
+                line = self._read_line()
+
+            if line.startswith('error'):
+                errors.append(line.split(' ', 2)[-1])
+
+            raise SCMError('\n'.join([error for error in errors if error]) or
+                           'Unexpected response from the CVS server: %s'
+                           % line)
+
+    def _get_cvspass_password(self, username):
+        # If the password isn't in the CVSROOT, cvs checks .cvspass for a
+        # password stored by "cvs login". The passwords there are already
+        # scrambled.
+        try:
+            f = open(os.path.expanduser('~/.cvspass'), 'r')
+        except IOError:
+            return None
+
+        try:
+            for line in f:
+                parts = line.split(' ', 2)
+
+                if parts[0] == '/1':
+                    parts = parts[1:]
+
+                if len(parts) != 2:
+                    continue
+
+                info = self.parse_cvsroot(parts[0])
+
+                if (info and info[0] == 'pserver' and
+                    (info[1] or getpass.getuser()) == username and
+                    info[3] == self.hostname and
+                    (info[4] or self.PSERVER_PORT) ==
+                    (self.port or self.PSERVER_PORT) and
+                    info[5] == self.path):
+                    return parts[1].rstrip('\r\n')
+        finally:
+            f.close()
+
+        return None
+
+    def _start(self):
+        self._write_lines([
+            'Root %s' % self.path,
+            'Valid-responses %s' % ' '.join(self.VALID_RESPONSES),
+            'valid-requests',
+        ])
+
+        success, contents, errmsg = self._read_response()
+
+        if not success:
+            raise SCMError(errmsg or 'Unable to start a CVS server session')
+
+    def _read_response(self):
+        """Reads the responses to a request.
+
+        This returns a tuple of (success, output, error output), once
+        the server has sent "ok" or "error".
+        """
+        output = []
+        errors = []
+
+        while True:
+            line = self._read_line()
+
+            if line == 'ok':
+                return True, ''.join(output), '\n'.join(errors)
+            elif line == 'error' or line.startswith('error '):
+                # This is "error <errno code> <message>", where both are
+                # optional.
+                message = line.split(' ', 2)[2:]
+
+                if message and message[0]:
+                    errors.append(message[0])
+
+                return False, ''.join(output), '\n'.join(errors)
+            elif line[:2] == 'M ':
+                output.append(line[2:] + '\n')
+            elif line == 'Mbinary':
+                size = self._read_line()
+
+                try:
+                    size = int(size)
+                except ValueError:
+                    raise CVSProtocolError('Invalid Mbinary size from the '
+                                           'CVS server: %s' % size)
+
+                data = self._read(size)
+                output.append(data)
+            elif line[:2] == 'E ':
+                errors.append(line[2:])
+            elif (line == 'F' or line.startswith('MT ') or
+                  line.startswith('Valid-requests ')):
+                pass
+            else:
+                raise CVSProtocolError('Unexpected response from the CVS '
+                                       'server: %s' % line)
+
+    def _read(self, size):
+        try:
+            data = self._rfile.read(size)
+        except (IOError, OSError), e:
+            raise CVSProtocolError('Unable to talk to the CVS server: %s' % e)
+
+        if len(data) != size:
+            raise CVSProtocolError('The CVS server closed the connection')
+
+        return data
+
+    def _read_line(self):
+        try:
+            line = self._rfile.readline()
+        except (IOError, OSError), e:
+            raise CVSProtocolError('Unable to talk to the CVS server: %s' % e)
+
+        if not line.endswith('\n'):
+            raise CVSProtocolError('The CVS server closed the connection')
+
+        return line[:-1]
+
+    def _write_lines(self, lines):
+        for line in lines:
+            if '\n' in line:
+                raise SCMError('Invalid value for a CVS request: %r' % line)
+
+        try:
+            self._wfile.write(''.join([line + '\n' for line in lines]))
+            self._wfile.flush()
+        except (IOError, OSError), e:
+            raise CVSProtocolError('Unable to talk to the CVS server: %s' % e)
+
+
+class CVSSessionPool(IdleResourcePool):
+    """A pool of CVS server sessions.
+
+    Sessions are kept per CVSROOT, and are reused across requests. A
+    session whose connection has dropped is replaced with a new one.
+    """
+    def cat_file(self, cvsroot, filenames, revision, local_site_name=None):
+        """Returns the contents of a file at a revision.
+
+        ``filenames`` is a list of names the file may have. They're tried
+        in order, and the contents of the first that exists are returned.
+        If the session's connection drops partway through, this is retried
+        once on a new session.
+        """
+        key = (cvsroot, local_site_name)
+
+        for attempt in (1, 2):
+            session = self.acquire(key)
+
+            try:
+                contents = self._cat_file(session, filenames, revision)
+            except CVSProtocolError, e:
+                session.close()
+
+                if attempt == 2:
+                    raise
+
+                logging.warning('Reconnecting to the CVS server for %s: %s'
+                                % (session.path, e))
+                continue
+            except SCMError:
+                # The server reported an error, but the session can still
+                # be used.
+                self.release(key, session)
+                raise
+            except:
+                session.close()
+                raise
+
+            self.release(key, session)
+
+            return contents
+
+    def _cat_file(self, session, filenames, revision):
+        for filename in filenames[:-1]:
+            try:
+                return session.checkout(filename, revision)
+            except FileNotFoundError:
+                pass
+
+        return session.checkout(filenames[-1], revision)
+
+    def _create(self, key):
+        cvsroot, local_site_name = key
+
+        return CVSServerSession(cvsroot, local_site_name)
+
+    def _close(self, session):
+        session.close()
+
+    def _is_reusable(self, session, last_used):
+        return session.is_alive()
+
+
+_session_pool = CVSSessionPool()
+
+
 class CVSClient(object):
     def __init__(self, cvsroot, path, local_site_name):
-        self.tempdir = ""
-        self.currentdir = os.getcwd()
         self.cvsroot = cvsroot
         self.path = path
         self.local_site_name = local_site_name
+        self.use_session = \
+            CVSServerSession.parse_cvsroot(cvsroot) is not None
 
         if not is_exe_in_path('cvs'):
             # This is technically not the right kind of error, but it's the
             # pattern we use with all the other tools.
             raise ImportError
 
-    def cleanup(self):
-        if self.currentdir != os.getcwd():
-            # Restore current working directory
-            os.chdir(self.currentdir)
-            # Remove temporary directory
-            if self.tempdir != "":
-                os.rmdir(self.tempdir)
-
     def cat_file(self, filename, revision):
         # We strip the repo off of the fully qualified path as CVS does
         # not like to be given absolute paths.
@@ -244,26 +724,43 @@ class CVSClient(object):
             # Attic path that makes any kind of sense.
             filenameAttic = None
 
-        try:
-            return self._cat_specific_file(filename, revision)
-        except FileNotFoundError:
-            if filenameAttic:
-                return self._cat_specific_file(filenameAttic, revision)
-            else:
-                raise
+        filenames = [filename]
+
+        if filenameAttic:
+            filenames.append(filenameAttic)
+
+        if self.use_session:
+            # The server looks in the Attic itself when a file isn't found
+            # outside of it, so the first name is usually all that's needed.
+            # Trying the Attic name only costs another request on the same
+            # session.
+            return _session_pool.cat_file(self.cvsroot, filenames, revision,
+                                          self.local_site_name)
+
+        for filename in filenames[:-1]:
+            try:
+                return self._cat_specific_file(filename, revision)
+            except FileNotFoundError:
+                pass
+
+        return self._cat_specific_file(filenames[-1], revision)
 
     def _cat_specific_file(self, filename, revision):
         # Somehow CVS sometimes seems to write .cvsignore files to current
-        # working directory even though we force stdout with -p.
-        self.tempdir = tempfile.mkdtemp()
-        os.chdir(self.tempdir)
+        # working directory even though we force stdout with -p, so it's
+        # run in a temporary directory.
+        tempdir = tempfile.mkdtemp()
 
-        p = SCMTool.popen(['cvs', '-f', '-d', self.cvsroot, 'checkout',
-                           '-r', str(revision), '-p', filename],
-                          self.local_site_name)
-        contents = p.stdout.read()
-        errmsg = p.stderr.read()
-        failure = p.wait()
+        try:
+            p = SCMTool.popen(['cvs', '-f', '-d', self.cvsroot, 'checkout',
+                               '-r', str(revision), '-p', filename],
+                              self.local_site_name,
+                              cwd=tempdir)
+            contents = p.stdout.read()
+            errmsg = p.stderr.read()
+            failure = p.wait()
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
 
         # Unfortunately, CVS is not consistent about exiting non-zero on
         # errors.  If the file is not found at all, then CVS will print an
@@ -285,7 +782,6 @@ class CVSClient(object):
         if not errmsg or \
            errmsg.startswith('cvs checkout: cannot find module') or \
            errmsg.startswith('cvs checkout: could not read RCS file'):
-            self.cleanup()
             raise FileNotFoundError(filename, revision)
 
         # Otherwise, if there's an exit code, or errmsg doesn't look like
@@ -295,8 +791,6 @@ class CVSClient(object):
         # stating this. This is safe to ignore.
         if (failure and not errmsg.startswith('==========')) and \
            not ".cvspass does not exist - creating new file" in errmsg:
-            self.cleanup()
             raise SCMError(errmsg)
 
-        self.cleanup()
         return contents
@@ -0,0 +1,388 @@
+"""
+Stores the contents of files fetched from repositories on disk.
+
+A file's contents at a given revision never change, so once they've been
+fetched, they can be kept for as long as there's room for them. The main
+cache evicts large files quickly and is lost when it's restarted, so files
+are also stored in the directory set in diffviewer_file_store_dir, which
+is shared by every server process on the machine.
+
+Contents are stored once under the SHA1 of the data, so a file that's the
+same in several revisions or repositories takes up the space of one copy.
+An index maps each (repository, path, revision) to the SHA1 of its
+contents. Both are written atomically, so processes never see partially
+written files.
+
+The least recently used contents are removed when the store grows past
+diffviewer_file_store_max_size. This is done in a background thread, so
+that requests never wait on a scan of the store.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import zlib
+
+from djblets.siteconfig.models import SiteConfiguration
+
+from reviewboard.scmtools.core import HEAD, PRE_CREATION, UNKNOWN
+
+
+# Once this fraction of the maximum size has been written by a process,
+# it checks whether anything needs to be evicted.
+EVICTION_CHECK_FRACTION = 0.1
+
+# The fraction of the maximum size to evict down to, so that evictions
+# don't happen on every write once the store is full.
+EVICTION_TARGET_FRACTION = 0.9
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class FileStore(object):
+    """
+    An on-disk store for the contents of files in repositories.
+
+    Contents are written to blobs/<sha1[:2]>/<sha1>, or <sha1>.z if they're
+    compressed. Index entries are written to index/<key[:2]>/<key>, where
+    the key is the SHA1 of the repository ID, path and revision, and
+    contain the SHA1 of the contents.
+    """
+    COMPRESSED_EXT = '.z'
+
+    # Appended to the index entry of contents that were stored as unicode,
+    # so that they're returned as unicode again.
+    UNICODE_SUFFIX = ':u'
+
+    def __init__(self, path, max_size, compress=False):
+        self.path = path
+        self.max_size = max_size
+        self.compress = compress
+        self._bytes_written = 0
+        self._lock = threading.Lock()
+        self._evicting = False
+
+    def get(self, repository_id, path, revision):
+        """
+        Returns the stored contents of a file, or None if they're not in
+        the store.
+
+        The contents are returned as the same type they were stored as.
+        """
+        return self.get_by_key(self._make_key(repository_id, path, revision))
+
+    def set(self, repository_id, path, revision, data):
+        """
+        Stores the contents of a file.
+
+        Unicode contents are stored as UTF-8, and are decoded again when
+        they're read, so they round-trip regardless of the repository's
+        encoding.
+        """
+        self.set_by_key(self._make_key(repository_id, path, revision), data)
+
+    def get_by_key(self, key):
+        """
+        Returns the contents stored under an arbitrary key, or None if
+        they're not in the store.
+
+        This lets the store hold contents that aren't files in a
+        repository, such as patched files.
+        """
+        index_path = self._get_index_path(key)
+        entry = self._read_file(index_path)
+
+        if not entry:
+            return None
+
+        is_unicode = entry.endswith(self.UNICODE_SUFFIX)
+
+        if is_unicode:
+            data_hash = entry[:-len(self.UNICODE_SUFFIX)]
+        else:
+            data_hash = entry
+
+        data = self._read_blob(data_hash)
+
+        if data is None:
+            # The contents were evicted, so the index entry is no longer
+            # useful.
+            self._remove_file(index_path)
+        elif is_unicode:
+            data = data.decode('utf-8')
+
+        return data
+
+    def set_by_key(self, key, data):
+        """Stores contents under an arbitrary key. See get_by_key."""
+        entry_suffix = ''
+
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+            entry_suffix = self.UNICODE_SUFFIX
+
+        data_hash = hashlib.sha1(data).hexdigest()
+
+        if not self._has_blob(data_hash):
+            if self.compress:
+                self._write_file(self._get_blob_path(data_hash, True),
+                                 zlib.compress(data))
+            else:
+                self._write_file(self._get_blob_path(data_hash, False),
+                                 data)
+
+            self._note_bytes_written(len(data))
+
+        self._write_file(self._get_index_path(key), data_hash + entry_suffix)
+
+    def evict(self):
+        """
+        Removes the least recently used contents until the store is under
+        its maximum size.
+
+        Contents are touched each time they're read, so their modification
+        times show when they were last used.
+        """
+        blobs_dir = os.path.join(self.path, 'blobs')
+        blobs = []
+        total_size = 0
+
+        for dirpath, dirnames, filenames in os.walk(blobs_dir):
+            for filename in filenames:
+                blob_path = os.path.join(dirpath, filename)
+
+                try:
+                    st = os.stat(blob_path)
+                except OSError:
+                    # Another process removed it.
+                    continue
+
+                blobs.append((st.st_mtime, st.st_size, blob_path))
+                total_size += st.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        target_size = self.max_size * EVICTION_TARGET_FRACTION
+        evicted_hashes = set()
+        blobs.sort()
+
+        for mtime, size, blob_path in blobs:
+            if total_size <= target_size:
+                break
+
+            self._remove_file(blob_path)
+            total_size -= size
+
+            filename = os.path.basename(blob_path)
+
+            if filename.endswith(self.COMPRESSED_EXT):
+                filename = filename[:-len(self.COMPRESSED_EXT)]
+
+            evicted_hashes.add(filename)
+
+        # Clear out the index entries for what was removed.
+        index_dir = os.path.join(self.path, 'index')
+
+        for dirpath, dirnames, filenames in os.walk(index_dir):
+            for filename in filenames:
+                index_path = os.path.join(dirpath, filename)
+
+                entry = self._read_file(index_path)
+
+                if entry and entry.split(':')[0] in evicted_hashes:
+                    self._remove_file(index_path)
+
+    def _make_key(self, repository_id, path, revision):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+
+        return '%s\0%s\0%s' % (repository_id, path, revision)
+
+    def _get_index_path(self, key):
+        key = hashlib.sha1(key).hexdigest()
+
+        return os.path.join(self.path, 'index', key[:2], key)
+
+    def _get_blob_path(self, data_hash, compressed):
+        filename = data_hash
+
+        if compressed:
+            filename += self.COMPRESSED_EXT
+
+        return os.path.join(self.path, 'blobs', data_hash[:2], filename)
+
+    def _has_blob(self, data_hash):
+        return (os.path.exists(self._get_blob_path(data_hash, False)) or
+                os.path.exists(self._get_blob_path(data_hash, True)))
+
+    def _read_blob(self, data_hash):
+        # The contents may have been stored before compression was turned
+        # on or off, so both are checked.
+        for compressed in (self.compress, not self.compress):
+            blob_path = self._get_blob_path(data_hash, compressed)
+            data = self._read_file(blob_path)
+
+            if data is not None:
+                try:
+                    # Mark the contents as recently used, for eviction.
+                    os.utime(blob_path, None)
+                except OSError:
+                    pass
+
+                if compressed:
+                    try:
+                        data = zlib.decompress(data)
+                    except zlib.error, e:
+                        logging.error("Unable to decompress file store "
+                                      "entry %s: %s", blob_path, e)
+                        return None
+
+                return data
+
+        return None
+
+    def _read_file(self, path):
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        try:
+            return f.read()
+        except IOError, e:
+            logging.error("Unable to read file store entry %s: %s", path, e)
+            return None
+        finally:
+            f.close()
+
+    def _write_file(self, path, data):
+        dirname = os.path.dirname(path)
+        temp_path = None
+
+        try:
+            if not os.path.exists(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # Another process may have just created it.
+                    if not os.path.isdir(dirname):
+                        raise
+
+            # Write to a temporary file and then move it into place, so that
+            # other processes never see a partially written file.
+            fd, temp_path = tempfile.mkstemp(dir=dirname)
+            f = os.fdopen(fd, 'wb')
+
+            try:
+                f.write(data)
+            finally:
+                f.close()
+
+            os.rename(temp_path, path)
+        except (IOError, OSError), e:
+            logging.error("Unable to write file store entry %s: %s", path, e)
+
+            if temp_path:
+                self._remove_file(temp_path)
+
+    def _remove_file(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _note_bytes_written(self, num_bytes):
+        self._lock.acquire()
+
+        try:
+            self._bytes_written += num_bytes
+            check_eviction = \
+                self._bytes_written >= self.max_size * EVICTION_CHECK_FRACTION
+
+            # Only one eviction runs at a time in a process.
+            check_eviction = check_eviction and not self._evicting
+
+            if check_eviction:
+                self._bytes_written = 0
+                self._evicting = True
+        finally:
+            self._lock.release()
+
+        if check_eviction:
+            # Evicting walks the whole store, so it's done in the background
+            # rather than in the request that happened to write the file.
+            thread = threading.Thread(target=self._evict_in_background)
+            thread.setDaemon(True)
+            thread.start()
+
+    def _evict_in_background(self):
+        try:
+            self.evict()
+        except (IOError, OSError), e:
+            logging.error("Unable to evict files from the file store "
+                          "in %s: %s", self.path, e)
+        finally:
+            self._lock.acquire()
+            self._evicting = False
+            self._lock.release()
+
+
+def get_file_store():
+    """
+    Returns the file store set up in the site configuration.
+
+    This returns None if the file store is disabled.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+    store_dir = siteconfig.get('diffviewer_file_store_dir')
+
+    if not store_dir:
+        return None
+
+    # The defaults are given here too, in case the site configuration's
+    # defaults haven't been registered.
+    return get_store(store_dir,
+                     siteconfig.get('diffviewer_file_store_max_size', 1024),
+                     siteconfig.get('diffviewer_file_store_compress', False))
+
+
+def get_store(path, max_size, compress=False):
+    """
+    Returns the FileStore for a directory.
+
+    ``max_size`` is in megabytes. The store is shared by everything in the
+    process using the directory with the same settings, so that they share
+    the bookkeeping for eviction.
+    """
+    store_settings = (path, max_size, compress)
+
+    _stores_lock.acquire()
+
+    try:
+        store = _stores.get(store_settings)
+
+        if store is None:
+            # Drop any store for the directory with older settings.
+            for key in _stores.keys():
+                if key[0] == path:
+                    del _stores[key]
+
+            store = FileStore(path, max_size * 1024 * 1024, compress)
+            _stores[store_settings] = store
+
+        return store
+    finally:
+        _stores_lock.release()
+
+
+def is_storable_revision(revision):
+    """
+    Returns whether the contents of a file at a revision can be stored.
+
+    Only concrete revisions can be, since HEAD and unknown revisions may
+    refer to different contents later on.
+    """
+    return revision not in (HEAD, UNKNOWN, PRE_CREATION)
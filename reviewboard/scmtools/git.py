@@ -1,10 +1,20 @@
+import hashlib
 import logging
 import os
 import re
 import requests
-import urllib2
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import urlparse
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # Python 2.5+ provides urllib2.quote, whereas Python 2.4 only
 # provides urllib.quote.
 try:
@@ -13,6 +23,7 @@ except ImportError:
     from urllib import quote as urllib_quote
 
 from django.utils.translation import ugettext_lazy as _
+from djblets.siteconfig.models import SiteConfiguration
 from djblets.util.filesystem import is_exe_in_path
 
 from reviewboard.diffviewer.parser import DiffParser, DiffParserError, File
@@ -22,6 +33,8 @@ from reviewboard.scmtools.errors import FileNotFoundError, \
                                         InvalidRevisionFormatError, \
                                         RepositoryNotFoundError, \
                                         SCMError
+from reviewboard.scmtools.pools import IdleResourcePool
+from reviewboard.scmtools.rawfiles import get_raw_file_client
 
 
 GIT_DIFF_EMPTY_CHANGESET_SIZE = 3
@@ -45,6 +58,466 @@ class ShortSHA1Error(InvalidRevisionFormatError):
             *args, **kwargs)
 
 
+class GitCatFileError(SCMError):
+    """Indicates that a git cat-file process stopped responding properly."""
+    pass
+
+
+class GitMirrorError(SCMError):
+    """Indicates that a local mirror couldn't be cloned or updated."""
+    pass
+
+
+class GitCatFileProcess(object):
+    """A long-running git-cat-file(1) process for a local repository.
+
+    This runs in either --batch mode, which returns the type and contents
+    of each requested object, or --batch-check mode, which only returns the
+    type. Object names are sent to the process one at a time, and the
+    process stays around to handle more requests.
+    """
+    def __init__(self, git_dir, batch_option, local_site_name=None):
+        self.batch_option = batch_option
+
+        # Nothing reads the error output while the process is running, so
+        # it goes to a file rather than a pipe, which would eventually fill
+        # up and block the process.
+        self.stderr = tempfile.TemporaryFile()
+        self.process = SCMTool.popen(['git', '--git-dir=%s' % git_dir,
+                                      'cat-file', batch_option],
+                                     local_site_name=local_site_name,
+                                     stdin=subprocess.PIPE,
+                                     stderr=self.stderr)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def lookup(self, name):
+        """Looks up an object, returning a tuple of (type, contents).
+
+        The contents are only returned in --batch mode, and are None
+        otherwise. If the object doesn't exist, (None, None) is returned.
+        """
+        if '\n' in name:
+            raise SCMError('Invalid object name: %r' % name)
+
+        try:
+            self.process.stdin.write(name + '\n')
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+        except (IOError, OSError), e:
+            raise GitCatFileError('Unable to talk to git cat-file: %s' % e)
+
+        if not header.endswith('\n'):
+            raise GitCatFileError('git cat-file exited unexpectedly: %s'
+                                  % self._get_error_output())
+
+        header = header[:-1]
+
+        if header.endswith(' missing') or header.endswith(' ambiguous'):
+            return None, None
+
+        sha1, obj_type, size = header.split()
+        contents = None
+
+        if self.batch_option == '--batch':
+            size = int(size)
+
+            # The contents are followed by a newline.
+            contents = self.process.stdout.read(size + 1)
+
+            if len(contents) != size + 1:
+                raise GitCatFileError('git cat-file exited unexpectedly')
+
+            contents = contents[:-1]
+
+        return obj_type, contents
+
+    def close(self):
+        """Shuts down the process."""
+        try:
+            # git cat-file exits as soon as there's nothing more to read.
+            self.process.stdin.close()
+            self.process.wait()
+            self.stderr.close()
+        except (IOError, OSError):
+            pass
+
+    def _get_error_output(self, max_size=1024):
+        """Returns the end of the process's error output."""
+        try:
+            self.stderr.seek(0, os.SEEK_END)
+            self.stderr.seek(max(0, self.stderr.tell() - max_size))
+
+            return self.stderr.read().strip()
+        except (IOError, OSError):
+            return ''
+
+
+class GitCatFilePool(IdleResourcePool):
+    """A pool of git cat-file processes for local repositories.
+
+    Processes are kept per repository and per mode, and are reused across
+    requests. A process that has crashed is replaced with a new one.
+    """
+    def lookup(self, git_dir, batch_option, names, local_site_name=None):
+        """Looks up a list of objects, returning a list of results.
+
+        Each result is a tuple of (type, contents), as returned by
+        GitCatFileProcess.lookup. If the process dies partway through, the
+        lookups are retried once on a new process.
+        """
+        key = (git_dir, batch_option, local_site_name)
+
+        for attempt in (1, 2):
+            process = self.acquire(key)
+
+            try:
+                results = [process.lookup(name) for name in names]
+            except GitCatFileError, e:
+                process.close()
+
+                if attempt == 2:
+                    raise
+
+                logging.warning('Restarting git cat-file for %s: %s' %
+                                (git_dir, e))
+                continue
+            except:
+                process.close()
+                raise
+
+            self.release(key, process)
+
+            return results
+
+    def close_git_dir(self, git_dir):
+        """Shuts down all idle processes for a repository."""
+        self.close_idle(lambda key: key[0] == git_dir)
+
+    def _create(self, key):
+        git_dir, batch_option, local_site_name = key
+
+        return GitCatFileProcess(git_dir, batch_option, local_site_name)
+
+    def _close(self, process):
+        process.close()
+
+    def _is_reusable(self, process, last_used):
+        return process.is_alive()
+
+
+_cat_file_pool = GitCatFilePool()
+
+
+class GitMirror(object):
+    """A local bare mirror of a remote Git repository.
+
+    The mirror is cloned with ``git clone --mirror`` the first time it's
+    needed, into the git-mirrors directory in the site's data directory.
+    It's shared by every server process on the machine, and is brought up
+    to date with ``git fetch`` when an object can't be found in it, or
+    when HEAD is looked up and it hasn't been fetched for a while.
+
+    Clones and fetches hold a lock file next to the mirror, so only one
+    process on the machine updates it at a time. Fetches are limited to
+    one every ``min_fetch_interval`` seconds, so that lookups of objects
+    that don't exist don't each go to the remote repository.
+
+    HTTP usernames and passwords are given to git by an askpass helper
+    script, which reads them from environment variables set for git. That
+    keeps them off git's command line, where other users on the machine
+    can see them, and out of the mirror's configuration.
+    """
+    min_fetch_interval = 30
+    head_fetch_interval = 300
+
+    ASKPASS_SCRIPT = (
+        '#!/bin/sh\n'
+        '# Answers git\'s prompts for the credentials of a Review Board\n'
+        '# mirror, which are passed in the environment.\n'
+        'case "$1" in\n'
+        '    Username*) printf \'%s\\n\' "$RB_GIT_USERNAME" ;;\n'
+        '    *) printf \'%s\\n\' "$RB_GIT_PASSWORD" ;;\n'
+        'esac\n'
+    )
+
+    _locks = {}
+    _locks_lock = threading.Lock()
+    _cloning = set()
+    _clone_failures = {}
+
+    def __init__(self, url, local_site_name=None, username=None,
+                 password=None):
+        self.url = url
+        self.local_site_name = local_site_name
+        self.username = username
+        self.password = password
+        self.git_dir = self.get_mirror_dir(url, local_site_name)
+        self.lock_path = os.path.splitext(self.git_dir)[0] + '.lock'
+
+        self._locks_lock.acquire()
+
+        try:
+            self._lock = self._locks.setdefault(self.git_dir,
+                                                threading.Lock())
+        finally:
+            self._locks_lock.release()
+
+    @classmethod
+    def get_mirror_dir(cls, url, local_site_name=None):
+        """Returns the directory that a repository is mirrored in."""
+        path = os.path.join(os.path.expanduser('~'), 'git-mirrors')
+
+        if local_site_name:
+            path = os.path.join(path, local_site_name)
+
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+
+        return os.path.join(path, '%s.git' % hashlib.sha1(url).hexdigest())
+
+    def is_cloned(self):
+        """Returns whether the mirror has been cloned."""
+        return os.path.exists(self.git_dir)
+
+    def ensure_cloned(self):
+        """Clones the mirror, if it hasn't been cloned yet."""
+        if self.is_cloned():
+            return
+
+        lock_file = self._acquire_lock()
+
+        try:
+            if self.is_cloned():
+                return
+
+            # Clone into a temporary directory and then move it into place,
+            # so that other processes never see a partial clone.
+            temp_dir = tempfile.mkdtemp(prefix='clone-',
+                                        dir=os.path.dirname(self.git_dir))
+
+            try:
+                logging.info('Git: Cloning a mirror of %s into %s' %
+                             (self.url, self.git_dir))
+                self._run_git(['clone', '--mirror', '--quiet', self.url,
+                               temp_dir],
+                              _('Unable to create a local mirror of %s') %
+                              self.url)
+
+                try:
+                    os.rename(temp_dir, self.git_dir)
+                except OSError:
+                    # Another process finished cloning first. This can
+                    # only happen where the lock file isn't supported.
+                    if not self.is_cloned():
+                        raise
+            finally:
+                if os.path.exists(temp_dir):
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+        finally:
+            self._release_lock(lock_file)
+
+    def start_clone(self):
+        """Starts cloning the mirror in a background thread.
+
+        This does nothing if the mirror has been cloned, or this process is
+        already cloning it. After a clone fails, another isn't started for
+        ``min_fetch_interval`` seconds.
+        """
+        if self.is_cloned():
+            return
+
+        self._locks_lock.acquire()
+
+        try:
+            if (self.git_dir in self._cloning or
+                (time.time() - self._clone_failures.get(self.git_dir, 0) <
+                 self.min_fetch_interval)):
+                return
+
+            self._cloning.add(self.git_dir)
+        finally:
+            self._locks_lock.release()
+
+        thread = threading.Thread(target=self._clone_in_background)
+        thread.setDaemon(True)
+        thread.start()
+
+    def fetch(self, max_age=None):
+        """Fetches from the remote repository, bringing the mirror up to date.
+
+        If the mirror has been fetched in the last ``max_age`` seconds
+        (which defaults to ``min_fetch_interval``), this does nothing.
+        This returns whether anything was fetched.
+        """
+        if max_age is None:
+            max_age = self.min_fetch_interval
+
+        lock_file = self._acquire_lock()
+
+        try:
+            if time.time() - self.get_last_fetch_time() < max_age:
+                return False
+
+            logging.info('Git: Fetching %s into %s' %
+                         (self.url, self.git_dir))
+            self._run_git(['--git-dir=%s' % self.git_dir, 'fetch',
+                           '--quiet', '--prune', self.url, '+refs/*:refs/*'],
+                          _('Unable to update the local mirror of %s') %
+                          self.url)
+
+            # Touch FETCH_HEAD, since git only writes it when something
+            # was fetched.
+            f = open(os.path.join(self.git_dir, 'FETCH_HEAD'), 'a')
+            f.close()
+            os.utime(os.path.join(self.git_dir, 'FETCH_HEAD'), None)
+        finally:
+            self._release_lock(lock_file)
+
+        # Start new git cat-file processes, so that they see the new
+        # objects.
+        _cat_file_pool.close_git_dir(self.git_dir)
+
+        return True
+
+    def get_last_fetch_time(self):
+        """Returns when the mirror was last cloned or fetched."""
+        for name in ('FETCH_HEAD', 'HEAD'):
+            try:
+                return os.path.getmtime(os.path.join(self.git_dir, name))
+            except OSError:
+                pass
+
+        return 0
+
+    def _clone_in_background(self):
+        failed = False
+
+        try:
+            self.ensure_cloned()
+        except Exception, e:
+            logging.error('Git: Unable to clone a mirror of %s: %s' %
+                          (self.url, e))
+            failed = True
+
+        self._locks_lock.acquire()
+
+        try:
+            self._cloning.discard(self.git_dir)
+
+            if failed:
+                self._clone_failures[self.git_dir] = time.time()
+        finally:
+            self._locks_lock.release()
+
+    def _acquire_lock(self):
+        """Locks the mirror against other threads and processes.
+
+        This returns the open lock file, which must be passed to
+        _release_lock.
+        """
+        parent_dir = os.path.dirname(self.git_dir)
+
+        if not os.path.exists(parent_dir):
+            try:
+                os.makedirs(parent_dir)
+            except OSError:
+                # Another process may have just created it.
+                if not os.path.isdir(parent_dir):
+                    raise
+
+        self._lock.acquire()
+
+        try:
+            lock_file = open(self.lock_path, 'w')
+
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        except:
+            self._lock.release()
+            raise
+
+        return lock_file
+
+    def _release_lock(self, lock_file):
+        try:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+            lock_file.close()
+        finally:
+            self._lock.release()
+
+    def _get_git_env(self):
+        """Returns the extra environment variables to run git with.
+
+        For HTTP URLs, these point git to the askpass helper and hold the
+        username and password for it to return.
+        """
+        scheme = urlparse.urlsplit(self.url)[0]
+
+        if not self.username or scheme not in ('http', 'https'):
+            return None
+
+        return {
+            'GIT_ASKPASS': self._ensure_askpass_script(),
+            'RB_GIT_USERNAME': self._encode_credential(self.username),
+            'RB_GIT_PASSWORD': self._encode_credential(self.password or ''),
+        }
+
+    def _ensure_askpass_script(self):
+        """Writes the askpass helper script, if needed, and returns its path.
+
+        The script is kept next to the mirror, and is only readable and
+        executable by this user.
+        """
+        path = os.path.join(os.path.dirname(self.git_dir), 'askpass.sh')
+
+        try:
+            f = open(path, 'r')
+
+            try:
+                content = f.read()
+            finally:
+                f.close()
+        except IOError:
+            content = None
+
+        if content != self.ASKPASS_SCRIPT:
+            # Write it to a temporary file and move that into place, so
+            # that other processes never run a partial script.
+            fd, temp_path = tempfile.mkstemp(prefix='askpass-',
+                                             dir=os.path.dirname(path))
+
+            try:
+                os.write(fd, self.ASKPASS_SCRIPT)
+            finally:
+                os.close(fd)
+
+            os.chmod(temp_path, 0700)
+            os.rename(temp_path, path)
+
+        return path
+
+    def _encode_credential(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        return value
+
+    def _run_git(self, args, error_message):
+        p = SCMTool.popen(['git'] + args,
+                          local_site_name=self.local_site_name,
+                          env=self._get_git_env())
+        errmsg = p.stderr.read()
+        failure = p.wait()
+
+        if failure:
+            logging.error('Git: %s: %s' % (error_message, errmsg))
+            raise GitMirrorError('%s: %s' % (error_message, errmsg.strip()))
+
+
 class GitTool(SCMTool):
     """
     You can only use this tool with a locally available git repository.
@@ -54,6 +527,7 @@ class GitTool(SCMTool):
     name = "Git"
     supports_raw_file_urls = True
     supports_authentication = True
+    shareable = True
     dependencies = {
         'executables': ['git']
     }
@@ -70,12 +544,34 @@ class GitTool(SCMTool):
                                 repository.username, repository.password,
                                 repository.encoding, local_site_name)
 
+    @property
+    def files_exist_fetches_contents(self):
+        # Local repositories and mirrors can check for files without
+        # reading them.
+        return self.client.uses_raw_files()
+
     def get_file(self, path, revision=HEAD):
         if revision == PRE_CREATION:
             return ""
 
         return self.client.get_file(path, revision)
 
+    def get_files(self, files):
+        results = [""] * len(files)
+        to_fetch = [(i, path, revision)
+                    for i, (path, revision) in enumerate(files)
+                    if revision != PRE_CREATION]
+
+        if to_fetch:
+            contents = self.client.get_files([(path, revision)
+                                              for i, path, revision
+                                              in to_fetch])
+
+            for (i, path, revision), data in zip(to_fetch, contents):
+                results[i] = data
+
+        return results
+
     def file_exists(self, path, revision=HEAD):
         if revision == PRE_CREATION:
             return False
@@ -85,6 +581,25 @@ class GitTool(SCMTool):
         except (FileNotFoundError, InvalidRevisionFormatError):
             return False
 
+    def files_exist(self, files):
+        if self.client.uses_raw_files():
+            return super(GitTool, self).files_exist(files)
+
+        results = [False] * len(files)
+        to_check = [(i, path, revision)
+                    for i, (path, revision) in enumerate(files)
+                    if revision != PRE_CREATION]
+
+        if to_check:
+            exists = self.client.get_files_exist([(path, revision)
+                                                  for i, path, revision
+                                                  in to_check])
+
+            for (i, path, revision), file_exists in zip(to_check, exists):
+                results[i] = file_exists
+
+        return results
+
     def parse_diff_revision(self, file_str, revision_str):
         revision = revision_str
 
@@ -143,6 +658,7 @@ class GitDiffParser(DiffParser):
         self.files = []
         i = 0
         while i < len(self.lines):
+            self.release_lines(i)
             i, file_info = self._parse_diff(i)
             if file_info:
                 self._ensure_file_has_required_fields(file_info)
@@ -213,22 +729,29 @@ class GitDiffParser(DiffParser):
             file_info.data += self.lines[linenum] + "\n"
             linenum += 1
 
-        # Get the changes
+        # Get the changes. These are joined together at the end, rather
+        # than appended a line at a time, which is quadratic.
+        data = []
+
         while linenum < len(self.lines):
             if self._is_git_diff(linenum):
-                return linenum, file_info
+                break
 
             if self._is_binary_patch(linenum):
                 file_info.binary = True
-                return linenum + 1, file_info
+                linenum += 1
+                break
 
             if self._is_diff_fromfile_line(linenum):
                 if self.lines[linenum].split()[1] == "/dev/null":
                     file_info.origInfo = PRE_CREATION
 
-            file_info.data += self.lines[linenum] + "\n"
+            data.append(self.lines[linenum])
+            data.append("\n")
             linenum += 1
 
+        file_info.data += ''.join(data)
+
         return linenum, file_info
 
     def _is_empty_change(self, linenum):
@@ -286,7 +809,7 @@ class GitClient(object):
         r'(?P<path>.*)')
 
     def __init__(self, path, raw_file_url=None, username=None, password=None,
-                 encoding='', local_site_name=None):
+                 encoding='', local_site_name=None, use_mirror=None):
         if not is_exe_in_path('git'):
             # This is technically not the right kind of error, but it's the
             # pattern we use with all the other tools.
@@ -298,11 +821,18 @@ class GitClient(object):
         self.password = password
         self.encoding = encoding
         self.local_site_name = local_site_name
+        self.use_mirror = use_mirror
         self.git_dir = None
+        self._mirror = None
 
         url_parts = urlparse.urlparse(self.path)
 
-        if url_parts[0] == 'file':
+        if url_parts[0] != 'file':
+            # Files may be read from a local mirror of the remote repository.
+            # See the mirror property.
+            self._mirror = GitMirror(self.path, local_site_name, username,
+                                     password)
+        else:
             self.git_dir = url_parts[2]
 
             p = self._run_git(['--git-dir=%s' % self.git_dir, 'config',
@@ -331,66 +861,227 @@ class GitClient(object):
 
         return True
 
-    def _get_file(self, url):
-        logging.info('Fetching file from %s' % url)
+    @property
+    def mirror(self):
+        """The local mirror that files are read from, if any.
 
-        auth = requests.auth.HTTPBasicAuth(self.username, self.password)
-        response = requests.get(url, auth=auth)
-        response.raise_for_status()
-        if self.encoding:
-            response.encoding = self.encoding
-        return response.text
+        Remote repositories are mirrored if ``use_mirror`` is set or, if
+        it's None, if the ``scmtools_git_use_mirrors`` setting is on. The
+        setting is checked each time, rather than when the client is
+        created, since clients are cached and reused. When mirrored, the
+        raw file URL is only used while the mirror is first cloned, or if
+        it can't be updated.
+        """
+        use_mirror = self.use_mirror
 
-    def get_file(self, path, revision):
-        if self.raw_file_url:
-            self.validate_sha1_format(path, revision)
+        if use_mirror is None:
+            siteconfig = SiteConfiguration.objects.get_current()
+            use_mirror = siteconfig.get('scmtools_git_use_mirrors')
 
-            # First, try to grab the file remotely.
-            try:
-                url = self._build_raw_url(path, revision)
-                return self._get_file(url)
-            except Exception, e:
-                logging.error("Git: Error fetching file from %s: %s" % (url, e))
-                raise SCMError("Error fetching file from %s: %s" % (url, e))
+        if use_mirror:
+            return self._mirror
         else:
+            return None
+
+    def uses_raw_files(self):
+        """Returns whether files are fetched from the raw file URL.
+
+        This is the case for remote repositories that aren't mirrored, or
+        whose mirror hasn't been cloned yet.
+        """
+        mirror = self.mirror
+
+        return bool(self.raw_file_url and
+                    (not mirror or not mirror.is_cloned()))
+
+    def get_file(self, path, revision):
+        if self._use_raw_files():
+            return self._get_raw_files([(path, revision)])[0]
+
+        try:
             return self._cat_file(path, revision, "blob")
+        except GitMirrorError, e:
+            self._fall_back_to_raw_files(e)
 
-    def get_file_exists(self, path, revision):
-        if self.raw_file_url:
-            self.validate_sha1_format(path, revision)
+            return self._get_raw_files([(path, revision)])[0]
 
-            # First, try to grab the file remotely.
-            try:
-                # We want to make sure we can access the file successfully,
-                # without any HTTP errors. A successful access means the file
-                # exists. The contents themselves are meaningless, so ignore
-                # them. If we do successfully get the file without triggering
-                # any sort of exception, then the file exists.
-                url = self._build_raw_url(path, revision)
-                self._get_file(url)
-
-                return True
-            except urllib2.HTTPError, e:
-                if e.code != 404:
-                    logging.error("Git: HTTP error code %d when fetching "
-                                  "file from %s: %s" % (e.code, url, e))
-            except Exception, e:
-                logging.error("Git: Error fetching file from %s: %s" % (url, e))
+    def get_files(self, files):
+        """Returns the contents of several files at once.
 
-            return False
-        else:
+        For local repositories, all the files are read from one
+        git-cat-file(1) process, rather than one process per file. Remote
+        files are fetched several at a time over the same connections.
+        """
+        if self._use_raw_files():
+            return self._get_raw_files(files)
+
+        commits = [self._resolve_head(revision, path)
+                   for path, revision in files]
+
+        try:
+            objects = self._lookup_objects(commits, '--batch')
+        except GitMirrorError, e:
+            self._fall_back_to_raw_files(e)
+
+            return self._get_raw_files(files)
+
+        results = []
+
+        for (path, revision), commit, (obj_type, contents) in \
+            zip(files, commits, objects):
+            if obj_type is None:
+                raise FileNotFoundError(path, revision)
+            elif obj_type != 'blob':
+                raise SCMError('%s is a %s, not a blob' % (commit, obj_type))
+
+            results.append(contents)
+
+        return results
+
+    def get_file_exists(self, path, revision):
+        if self._use_raw_files():
+            return self._get_raw_file_exists(path, revision)
+
+        try:
             contents = self._cat_file(path, revision, "-t")
-            return contents and contents.strip() == "blob"
+        except GitMirrorError, e:
+            self._fall_back_to_raw_files(e)
+
+            return self._get_raw_file_exists(path, revision)
+
+        return contents and contents.strip() == "blob"
+
+    def get_files_exist(self, files):
+        """Returns whether each of several files exists.
+
+        For local repositories and mirrors, the files are all checked by
+        one git-cat-file(1) process. Otherwise, each file is fetched from
+        the raw file URL.
+        """
+        if self._use_raw_files():
+            return [self._get_raw_file_exists(path, revision)
+                    for path, revision in files]
+
+        commits = [self._resolve_head(revision, path)
+                   for path, revision in files]
+
+        try:
+            objects = self._lookup_objects(commits, '--batch-check')
+        except GitMirrorError, e:
+            self._fall_back_to_raw_files(e)
+
+            return [self._get_raw_file_exists(path, revision)
+                    for path, revision in files]
+
+        return [obj_type == 'blob' for obj_type, contents in objects]
 
     def validate_sha1_format(self, path, sha1):
-        """Validates that a SHA1 is of the right length for this repository."""
-        if self.raw_file_url and len(sha1) != self.FULL_SHA1_LENGTH:
-            raise ShortSHA1Error(path, sha1)
+        """Validates that a SHA1 is of the right length for this repository.
 
-    def _run_git(self, args):
+        Only full SHA1s can be fetched from raw file URLs. Mirrored
+        repositories accept short SHA1s, since the raw file URL is only
+        used when the mirror isn't available.
+        """
+        if self.raw_file_url and not self.mirror:
+            self._validate_raw_sha1_format(path, sha1)
+
+    def _run_git(self, args, stdin=None):
         """Runs a git command, returning a subprocess.Popen."""
         return SCMTool.popen(['git'] + args,
-                             local_site_name=self.local_site_name)
+                             local_site_name=self.local_site_name,
+                             stdin=stdin)
+
+    def _use_raw_files(self):
+        """Returns whether files should be fetched from the raw file URL.
+
+        If a mirror hasn't been cloned yet, it's cloned in the background
+        while files are fetched from the raw file URL. Without a raw file
+        URL, the mirror is cloned when it's first read from.
+        """
+        mirror = self.mirror
+
+        if mirror and self.raw_file_url:
+            mirror.start_clone()
+
+        return self.uses_raw_files()
+
+    def _fall_back_to_raw_files(self, e):
+        """Handles a failure to clone or update the mirror.
+
+        Files are fetched from the raw file URL instead, if there is one.
+        Otherwise, the error is raised again.
+        """
+        if not self.raw_file_url:
+            raise e
+
+        logging.warning('Git: Fetching files from %s instead of the local '
+                        'mirror: %s' % (self.raw_file_url, e))
+
+    def _validate_raw_sha1_format(self, path, sha1):
+        if len(sha1) != self.FULL_SHA1_LENGTH:
+            raise ShortSHA1Error(path, sha1)
+
+    def _get_raw_file_client(self):
+        return get_raw_file_client(self.raw_file_url, self.username,
+                                   self.password)
+
+    def _get_raw_files(self, files):
+        """Fetches files from the raw file URL.
+
+        The files are fetched several at a time, over connections shared
+        with other requests for this repository.
+        """
+        urls = []
+
+        for path, revision in files:
+            self._validate_raw_sha1_format(path, revision)
+            urls.append(self._build_raw_url(path, revision))
+
+        for url in urls:
+            logging.info('Fetching file from %s' % url)
+
+        try:
+            results = self._get_raw_file_client().fetch_many(urls,
+                                                             self.encoding)
+        except Exception, e:
+            logging.error("Git: Error fetching files from %s: %s" %
+                          (self.raw_file_url, e))
+            raise SCMError("Error fetching files from %s: %s" %
+                           (self.raw_file_url, e))
+
+        contents = []
+
+        for url, (status, text) in zip(urls, results):
+            if status != requests.codes.ok:
+                logging.error("Git: HTTP error code %d when fetching file "
+                              "from %s" % (status, url))
+                raise SCMError("Error fetching file from %s: HTTP error %d" %
+                               (url, status))
+
+            contents.append(text)
+
+        return contents
+
+    def _get_raw_file_exists(self, path, revision):
+        self._validate_raw_sha1_format(path, revision)
+
+        # We want to make sure we can access the file successfully,
+        # without any HTTP errors. A successful access means the file
+        # exists. The contents themselves are meaningless, so ignore
+        # them.
+        url = self._build_raw_url(path, revision)
+
+        try:
+            status, contents = self._get_raw_file_client().fetch(url)
+        except Exception, e:
+            logging.error("Git: Error fetching file from %s: %s" % (url, e))
+            return False
+
+        if status != requests.codes.ok and status != 404:
+            logging.error("Git: HTTP error code %d when fetching "
+                          "file from %s" % (status, url))
+
+        return status == requests.codes.ok
 
     def _build_raw_url(self, path, revision):
         url = self.raw_file_url
@@ -403,27 +1094,65 @@ class GitClient(object):
         Call git-cat-file(1) to get content or type information for a
         repository object.
 
-        If called with just "commit", gets the content of a blob (or
+        If called with just "blob", gets the content of a blob (or
         raises an exception if the commit is not a blob).
 
-        Otherwise, "option" can be used to pass a switch to git-cat-file,
-        e.g. to test or existence or get the type of "commit".
+        If called with "-t", gets the type of "commit", which can be used
+        to test for existence.
+
+        These are handled by long-running git-cat-file(1) processes shared
+        between requests, rather than a new process each time.
         """
         commit = self._resolve_head(revision, path)
 
-        p = self._run_git(['--git-dir=%s' % self.git_dir, 'cat-file',
-                           option, commit])
-        contents = p.stdout.read()
-        errmsg = p.stderr.read()
-        failure = p.wait()
+        if option == "blob":
+            obj_type, contents = self._lookup_objects([commit], '--batch')[0]
 
-        if failure:
-            if errmsg.startswith("fatal: Not a valid object name"):
+            if obj_type is None:
                 raise FileNotFoundError(commit)
-            else:
-                raise SCMError(errmsg)
+            elif obj_type != "blob":
+                raise SCMError('%s is a %s, not a blob' % (commit, obj_type))
 
-        return contents
+            return contents
+        elif option == "-t":
+            obj_type = self._lookup_objects([commit], '--batch-check')[0][0]
+
+            if obj_type is None:
+                raise FileNotFoundError(commit)
+
+            return obj_type
+        else:
+            raise ValueError('Unsupported git cat-file option: %s' % option)
+
+    def _lookup_objects(self, names, batch_option):
+        mirror = self.mirror
+
+        if not mirror:
+            return _cat_file_pool.lookup(self.git_dir, batch_option, names,
+                                         self.local_site_name)
+
+        mirror.ensure_cloned()
+
+        # Make sure HEAD isn't too far out of date.
+        if [name for name in names if name.startswith('HEAD:')]:
+            mirror.fetch(mirror.head_fetch_interval)
+
+        results = _cat_file_pool.lookup(mirror.git_dir, batch_option, names,
+                                        self.local_site_name)
+        missing = [i for i, (obj_type, contents) in enumerate(results)
+                   if obj_type is None]
+
+        # Anything missing may have been pushed since the mirror was last
+        # fetched.
+        if missing and mirror.fetch():
+            found = _cat_file_pool.lookup(mirror.git_dir, batch_option,
+                                          [names[i] for i in missing],
+                                          self.local_site_name)
+
+            for i, result in zip(missing, found):
+                results[i] = result
+
+        return results
 
     def _resolve_head(self, revision, path):
         if revision == HEAD:
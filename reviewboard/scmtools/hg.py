@@ -11,6 +11,8 @@ from reviewboard.diffviewer.parser import DiffParser, DiffParserError
 from reviewboard.scmtools.git import GitDiffParser
 from reviewboard.scmtools.core import \
     FileNotFoundError, SCMTool, HEAD, PRE_CREATION, UNKNOWN
+from reviewboard.scmtools.errors import SCMError
+from reviewboard.scmtools.rawfiles import get_raw_file_client
 
 
 class HgTool(SCMTool):
@@ -35,6 +37,13 @@ class HgTool(SCMTool):
     def get_file(self, path, revision=HEAD):
         return self.client.cat_file(path, str(revision))
 
+    def get_files(self, files):
+        if isinstance(self.client, HgWebClient):
+            return self.client.cat_files([(path, str(revision))
+                                          for path, revision in files])
+        else:
+            return super(HgTool, self).get_files(files)
+
     def parse_diff_revision(self, file_str, revision_str):
         revision = revision_str
         if file_str == "/dev/null":
@@ -50,7 +59,14 @@ class HgTool(SCMTool):
         return ['diff_path', 'parent_diff_path']
 
     def get_parser(self, data):
-        if data.lstrip().startswith('diff --git'):
+        if hasattr(data, 'read'):
+            # Peek at the start of the diff without consuming it.
+            start = data.read(8192)
+            data.seek(0)
+        else:
+            start = data
+
+        if start.lstrip().startswith('diff --git'):
             return GitDiffParser(data)
         else:
             return HgDiffParser(data)
@@ -167,47 +183,98 @@ class HgDiffParser(DiffParser):
 
 class HgWebClient(object):
     FULL_FILE_URL = '%(url)s/%(rawpath)s/%(revision)s/%(quoted_path)s'
+    RAW_PATHS = ['raw-file', 'raw']
+
+    # The raw file URL form that each hgweb server has been found to
+    # support, so that the others don't have to be tried for every file.
+    _supported_rawpaths = {}
 
     def __init__(self, repoPath, username, password):
         self.url = repoPath
         self.username = username
         self.password = password
+        self.client = get_raw_file_client(self.url, username, password)
         logging.debug('Initialized HgWebClient with url=%r, username=%r',
                       self.url, self.username)
 
     def cat_file(self, path, rev="tip"):
-        if rev == HEAD or rev == UNKNOWN:
-            rev = "tip"
-        elif rev == PRE_CREATION:
-            rev = ""
+        return self.cat_files([(path, rev)])[0]
+
+    def cat_files(self, files):
+        """Returns the contents of several files at once.
+
+        ``files`` is a list of (path, revision) tuples. The files are
+        fetched several at a time, over connections shared with other
+        requests for this repository.
+        """
+        files = [(path, self._normalize_revision(rev))
+                 for path, rev in files]
+        results = [None] * len(files)
+        pending = range(len(files))
+
+        for rawpath in self._get_rawpaths():
+            if not pending:
+                break
+
+            urls = [self.FULL_FILE_URL % {
+                        'url': self.url.rstrip('/'),
+                        'rawpath': rawpath,
+                        'revision': files[i][1],
+                        'quoted_path': urllib_quote(files[i][0].lstrip('/')),
+                    }
+                    for i in pending]
+
+            for url in urls:
+                logging.info('Fetching file from %s' % url)
+
+            try:
+                fetched = self.client.fetch_many(urls)
+            except Exception, e:
+                logging.error('%s: Error fetching files from %s: %s' %
+                              (self.__class__.__name__, self.url, e))
+                raise SCMError('Error fetching files from %s: %s' %
+                               (self.url, e))
+
+            not_found = []
+
+            for i, url, (status, text) in zip(pending, urls, fetched):
+                if status == requests.codes.ok:
+                    results[i] = text
+                    self._supported_rawpaths[self.url] = rawpath
+                elif status == 404:
+                    # The file may not exist, or the server may not support
+                    # this form of URL.
+                    not_found.append(i)
+                else:
+                    logging.error('%s: HTTP error code %d when fetching '
+                                  'file from %s' %
+                                  (self.__class__.__name__, status, url))
+                    raise SCMError('Error fetching file from %s: HTTP '
+                                   'error %d' % (url, status))
 
-        found = False
+            pending = not_found
 
-        for rawpath in ["raw-file", "raw"]:
-            url = ''
+        if pending:
+            raise FileNotFoundError(*files[pending[0]])
 
-            try:
-                url = self.FULL_FILE_URL % {
-                    'url': self.url.rstrip('/'),
-                    'rawpath': rawpath,
-                    'revision': rev,
-                    'quoted_path': urllib_quote(path.lstrip('/')),
-                }
-                logging.info('Fetching file from %s' % url)
-                auth = requests.auth.HTTPBasicAuth(self.username, self.password)
-                response = requests.get(url, auth=auth)
-                if response.status_code == requests.codes.ok:
-                    return response.text
-                elif response.status_code != 404:
-                    response.raise_for_status()
+        return results
 
-            except Exception, e:
-                logging.error('%s: Error fetching file from %s: %s' %
-                              (self.__class__.__name__, url, e))
-                raise SCMError('Error fetching file from %s: %s' % (url, e))
+    def _normalize_revision(self, rev):
+        if rev == HEAD or rev == UNKNOWN:
+            return "tip"
+        elif rev == PRE_CREATION:
+            return ""
+        else:
+            return rev
 
-        if not found:
-            raise FileNotFoundError(path, rev)
+    def _get_rawpaths(self):
+        rawpath = self._supported_rawpaths.get(self.url)
+
+        if rawpath:
+            return [rawpath] + [other for other in self.RAW_PATHS
+                                if other != rawpath]
+        else:
+            return self.RAW_PATHS
 
     def get_filenames(self, rev):
         raise NotImplementedError
@@ -2,6 +2,7 @@ from scmtools.core import FileNotFoundError, SCMTool, HEAD
 
 class LocalFileTool(SCMTool):
     name = "Local File"
+    shareable = True
 
     def __init__(self, repository):
         self.repopath = repository.path
@@ -1,12 +1,22 @@
+import threading
+
 from django.contrib.auth.models import User
 from django.core.exceptions import ImproperlyConfigured
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
+from reviewboard.scmtools.filestore import get_file_store, \
+                                          is_storable_revision
 from reviewboard.scmtools.managers import RepositoryManager, ToolManager
 from reviewboard.site.models import LocalSite
 
 
+# SCMTool instances that can be shared, cached per process. This maps a
+# repository ID to a (cache key, tool) tuple. See Repository.get_scmtool.
+_scmtool_cache = {}
+_scmtool_cache_lock = threading.Lock()
+
+
 class Tool(models.Model):
     name = models.CharField(max_length=32, unique=True)
     class_name = models.CharField(max_length=128, unique=True)
@@ -119,8 +129,110 @@ class Repository(models.Model):
     objects = RepositoryManager()
 
     def get_scmtool(self):
+        """
+        Returns an instance of the SCMTool for this repository.
+
+        Creating a tool can mean setting up clients or running commands,
+        so tools that can be shared (see SCMTool.shareable) are cached for
+        the life of the process and handed out to every caller.
+
+        The cache is keyed by the fields the tool is created from, so a
+        repository that's been changed in another process gets a new
+        tool. It's cleared for the repository when it's saved or deleted.
+        """
+        if self.pk is None:
+            return self.tool.get_scmtool_class()(self)
+
+        key = self._get_scmtool_cache_key()
+
+        _scmtool_cache_lock.acquire()
+
+        try:
+            cached = _scmtool_cache.get(self.pk)
+        finally:
+            _scmtool_cache_lock.release()
+
+        if cached and cached[0] == key:
+            return cached[1]
+
+        # The tool is created outside of the lock, since this may take a
+        # while. If two threads do this at once, the last one wins.
         cls = self.tool.get_scmtool_class()
-        return cls(self)
+        tool = cls(self)
+
+        if cls.shareable:
+            _scmtool_cache_lock.acquire()
+
+            try:
+                _scmtool_cache[self.pk] = (key, tool)
+            finally:
+                _scmtool_cache_lock.release()
+
+        return tool
+
+    def clear_scmtool_cache(self):
+        """Removes any cached SCMTool instance for this repository."""
+        _scmtool_cache_lock.acquire()
+
+        try:
+            _scmtool_cache.pop(self.pk, None)
+        finally:
+            _scmtool_cache_lock.release()
+
+    def get_file(self, path, revision):
+        """
+        Returns the contents of a file at a revision.
+
+        Files at concrete revisions are looked up in the file store first,
+        if it's enabled, and stored there once they've been fetched from
+        the repository. See reviewboard.scmtools.filestore.
+        """
+        return self.get_files([(path, revision)])[0]
+
+    def get_files(self, files):
+        """
+        Returns the contents of several files at once.
+
+        ``files`` is a list of (path, revision) tuples. This works like
+        get_file, and any files that aren't in the file store are fetched
+        with a single call to SCMTool.get_files.
+        """
+        if self.pk is None:
+            store = None
+        else:
+            store = get_file_store()
+
+        contents = [None] * len(files)
+        to_fetch = []
+
+        for i, (path, revision) in enumerate(files):
+            if store and is_storable_revision(revision):
+                contents[i] = store.get(self.pk, path, revision)
+
+            if contents[i] is None:
+                to_fetch.append(i)
+
+        if len(to_fetch) == 1:
+            fetched = [self.get_scmtool().get_file(*files[to_fetch[0]])]
+        elif to_fetch:
+            fetched = self.get_scmtool().get_files([files[i]
+                                                    for i in to_fetch])
+        else:
+            fetched = []
+
+        for i, data in zip(to_fetch, fetched):
+            contents[i] = data
+            path, revision = files[i]
+
+            if store and is_storable_revision(revision):
+                store.set(self.pk, path, revision, data)
+
+        return contents
+
+    def _get_scmtool_cache_key(self):
+        return (self.tool_id, self.path, self.mirror_path,
+                self.raw_file_url, self.username, self.password,
+                self.encoding, self.local_site_id)
 
     def is_accessible_by(self, user):
         """Returns whether or not the user has access to the repository.
@@ -147,6 +259,14 @@ class Repository(models.Model):
         return (user.has_perm('scmtools.change_repository') or
                 (self.local_site and self.local_site.is_mutable_by(user)))
 
+    def save(self, *args, **kwargs):
+        super(Repository, self).save(*args, **kwargs)
+        self.clear_scmtool_cache()
+
+    def delete(self, *args, **kwargs):
+        self.clear_scmtool_cache()
+        super(Repository, self).delete(*args, **kwargs)
+
     def __unicode__(self):
         return self.name
 
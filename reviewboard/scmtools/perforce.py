@@ -10,16 +10,19 @@ import time
 
 from djblets.util.filesystem import is_exe_in_path
 try:
+    import P4
     from P4 import P4Exception
 except ImportError:
-    pass
+    P4 = None
 
 from reviewboard.diffviewer.parser import DiffParser
 from reviewboard.scmtools.core import SCMTool, ChangeSet, \
                                       HEAD, PRE_CREATION
 from reviewboard.scmtools.errors import SCMError, EmptyChangeSetError, \
                                         AuthenticationError, \
+                                        FileNotFoundError, \
                                         RepositoryNotFoundError
+from reviewboard.scmtools.pools import IdleResourcePool
 
 
 STUNNEL_SERVER, STUNNEL_CLIENT = (0, 1)
@@ -81,6 +84,191 @@ class STunnelProxy(object):
                 pass
 
 
+class PerforceConnectionPool(IdleResourcePool):
+    """A pool of connections to Perforce servers.
+
+    Connections are kept per server and set of credentials, and are reused
+    across requests instead of connecting (and logging in) for every
+    command. When stunnel is used, a single tunnel is shared by all
+    connections to the same server.
+
+    Connections that have been idle for a while are checked before they're
+    reused. Tunnels are shut down once nothing is using them.
+    """
+    health_check_interval = 60
+
+    def __init__(self):
+        super(PerforceConnectionPool, self).__init__()
+        self._in_use = {}
+        self._tunnels = {}
+
+    def acquire(self, client):
+        """Returns a connected P4 instance for the client's server."""
+        key = self._make_key(client)
+
+        self._lock.acquire()
+
+        try:
+            self._check_pid()
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+        try:
+            return super(PerforceConnectionPool, self).acquire(key)
+        except:
+            self._lock.acquire()
+
+            try:
+                self._in_use[key] -= 1
+            finally:
+                self._lock.release()
+
+            raise
+
+    def release(self, client, p4):
+        """Returns a connection to the pool once a command has finished."""
+        key = self._make_key(client)
+
+        self._lock.acquire()
+
+        try:
+            forked = self._check_pid()
+
+            if not forked:
+                self._in_use[key] -= 1
+        finally:
+            self._lock.release()
+
+        if forked:
+            # This connection was acquired before a fork, and belongs to
+            # the parent process.
+            return
+
+        if self._is_connected(p4):
+            super(PerforceConnectionPool, self).release(key, p4)
+        else:
+            self._close(p4)
+
+    def reap_idle(self):
+        """Closes idle connections and any tunnels no longer in use."""
+        super(PerforceConnectionPool, self).reap_idle()
+
+        tunnels = []
+
+        self._lock.acquire()
+
+        try:
+            self._check_pid()
+
+            used_ports = set([key[0] for key in self._idle.iterkeys()])
+            used_ports.update([key[0]
+                               for key, count in self._in_use.iteritems()
+                               if count > 0])
+
+            for p4port in self._tunnels.keys():
+                if p4port not in used_ports:
+                    tunnels.append(self._tunnels.pop(p4port))
+        finally:
+            self._lock.release()
+
+        for proxy in tunnels:
+            try:
+                proxy.shutdown()
+            except:
+                pass
+
+    def _create(self, key):
+        p4port, username, password, encoding, use_stunnel = key
+
+        p4 = P4.P4()
+        p4.user = username
+        p4.password = password
+
+        if encoding:
+            p4.charset = encoding
+
+        p4.exception_level = 1
+
+        if use_stunnel:
+            p4.port = '127.0.0.1:%d' % self._get_tunnel(p4port).port
+        else:
+            p4.port = p4port
+
+        p4.connect()
+
+        return p4
+
+    def _get_tunnel(self, p4port):
+        """Returns a running stunnel client for the server.
+
+        The tunnel is shared by all connections to the server, and is
+        restarted if its process has gone away.
+        """
+        self._lock.acquire()
+
+        try:
+            proxy = self._tunnels.get(p4port)
+
+            if proxy is not None and not self._is_tunnel_alive(proxy):
+                proxy = None
+
+            if proxy is None:
+                proxy = STunnelProxy(STUNNEL_CLIENT, p4port)
+                proxy.start_client()
+                self._tunnels[p4port] = proxy
+
+            return proxy
+        finally:
+            self._lock.release()
+
+    def _is_tunnel_alive(self, proxy):
+        try:
+            os.kill(proxy.pid, 0)
+            return True
+        except (OSError, TypeError):
+            return False
+
+    def _is_connected(self, p4):
+        try:
+            return p4.connected()
+        except AttributeError:
+            return False
+
+    def _is_reusable(self, p4, last_used):
+        if time.time() - last_used <= self.health_check_interval:
+            return True
+
+        if not self._is_connected(p4):
+            return False
+
+        try:
+            p4.run_info()
+            return True
+        except P4Exception:
+            return False
+
+    def _close(self, p4):
+        try:
+            if p4.connected():
+                p4.disconnect()
+        except (AttributeError, P4Exception):
+            pass
+
+    def _make_key(self, client):
+        return (client.p4port, client.username, client.password,
+                client.encoding, client.use_stunnel)
+
+    def _reset(self):
+        # The tunnels belong to the parent process as well.
+        super(PerforceConnectionPool, self)._reset()
+        self._in_use = {}
+        self._tunnels = {}
+
+
+_connection_pool = PerforceConnectionPool()
+
+
 class PerforceClient(object):
     def __init__(self, p4port, username, password, encoding, use_stunnel=False):
         self.p4port = p4port
@@ -88,55 +276,16 @@ class PerforceClient(object):
         self.password = password
         self.encoding = encoding
         self.use_stunnel = use_stunnel
-        self.proxy = None
 
-        import P4
-        self.p4 = P4.P4()
+        # The connections themselves are made through the connection pool,
+        # but there's no point in creating a client that can't make any.
+        if P4 is None:
+            raise ImportError('P4Python is not installed')
 
         if use_stunnel and not is_exe_in_path('stunnel'):
             raise AttributeError('stunnel proxy was requested, but stunnel '
                                  'binary is not in the exec path.')
 
-    def _connect(self):
-        """
-        Connect to the perforce server.
-
-        This connects p4python to the remote server, optionally using a stunnel
-        proxy.
-        """
-        self.p4.user = self.username
-        self.p4.password = self.password
-        if self.encoding:
-            self.p4.charset = self.encoding
-        self.p4.exception_level = 1
-
-        if self.use_stunnel:
-            # Spin up an stunnel client and then redirect through that
-            self.proxy = STunnelProxy(STUNNEL_CLIENT, self.p4port)
-            self.proxy.start_client()
-            self.p4.port = '127.0.0.1:%d' % self.proxy.port
-        else:
-            self.p4.port = self.p4port
-        self.p4.connect()
-
-    def _disconnect(self):
-        """
-        Disconnect from the perforce server, and also shut down the stunnel
-        proxy (if it exists).
-        """
-        try:
-            if self.p4.connected():
-                self.p4.disconnect()
-        except AttributeError:
-            pass
-
-        if self.proxy:
-            try:
-                self.proxy.shutdown()
-            except:
-                pass
-            self.proxy = None
-
     @staticmethod
     def _convert_p4exception_to_scmexception(e):
         error = str(e)
@@ -148,88 +297,215 @@ class PerforceClient(object):
             raise SCMError(error)
 
     def _run_worker(self, worker):
-        result = None
+        """
+        Runs a worker function with a pooled connection to the server.
+
+        The worker is passed the connected P4 instance.
+        """
+        p4 = None
 
-        # TODO: Move to using with: when we require a minimum of Python 2.5.
-        #       We should make it auto-disconnect.
         try:
-            self._connect()
-            result = worker()
-            self._disconnect()
+            p4 = _connection_pool.acquire(self)
+            return worker(p4)
         except P4Exception, e:
-            self._disconnect()
             self._convert_p4exception_to_scmexception(e)
-        except:
-            self._disconnect();
-            raise
-
-        return result
+        finally:
+            if p4 is not None:
+                _connection_pool.release(self, p4)
 
-    def _get_changeset(self, changesetid):
-        return self.p4.run_describe('-s', str(changesetid))
+    def _get_changeset(self, p4, changesetid):
+        return p4.run_describe('-s', str(changesetid))
 
     def get_changeset(self, changesetid):
         """
         Get the contents of a changeset description.
         """
-        return self._run_worker(lambda: self._get_changeset(changesetid))
+        return self._run_worker(
+            lambda p4: self._get_changeset(p4, changesetid))
 
-    def _get_pending_changesets(self, userid):
-        changesets = self.p4.run_changes('-s', 'pending', '-u', userid)
-        return map(self._get_changeset, [x.split()[1] for x in changesets])
+    def _get_pending_changesets(self, p4, userid):
+        changesets = p4.run_changes('-s', 'pending', '-u', userid)
+        return [self._get_changeset(p4, x.split()[1]) for x in changesets]
 
     def get_pending_changesets(self, userid):
         """
         Get a list of changeset descriptions for all pending changesets for a
         given user.
         """
-        return self._run_worker(lambda: self._get_pending_changesets(userid))
+        return self._run_worker(
+            lambda p4: self._get_pending_changesets(p4, userid))
 
-    def _get_file(self, path, revision):
+    def get_file(self, path, revision):
+        """
+        Get the contents of a file, at a specific revision.
+        """
         if revision == PRE_CREATION:
             return ''
-        elif revision == HEAD:
-            depot_path = path
-        else:
-            depot_path = '%s#%s' % (path, revision)
-
-        args = ['p4', '-p', self.p4.port]
-        if self.p4.user:
-            args.extend(['-u', self.p4.user])
-        if self.p4.password:
-            args.extend(['-P', self.p4.password])
-        if self.p4.charset:
-            args.extend(['-C', self.p4.charset])
-        args.extend(['print', '-q', depot_path])
-
-        p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-
-        result, errdata = p.communicate()
-        failure = p.poll()
-
-        if failure:
-            error = errdata.splitlines()
-            # The command-line output is the same as the contents of a
-            # P4Exception except they're prefixed with a line that says
-            # "Perforce client error:", and the lines of the error are indented
-            # with tabs.
-            if error[0].startswith('Perforce client error:'):
-                error = error[1:]
-            text = '\n'.join(line.lstrip('\t') for line in error)
-
-            self._convert_p4exception_to_scmexception(Exception(text))
+
+        return self.get_files([(path, revision)])[0]
+
+    def _get_file_specs(self, files):
+        """
+        Returns the file specs to look up for a list of files.
+
+        This returns a tuple of (head specs, revision specs). Files at HEAD
+        are kept apart from files at specific revisions, so that they can
+        be looked up separately. Otherwise, if both //a#3 and //a were
+        requested, there'd be no telling which result was for which.
+        """
+        head_specs = []
+        rev_specs = []
+
+        for path, revision in files:
+            if revision == PRE_CREATION:
+                continue
+
+            spec = self._get_file_spec(path, revision)
+
+            if revision == HEAD:
+                specs = head_specs
+            else:
+                specs = rev_specs
+
+            if spec not in specs:
+                specs.append(spec)
+
+        return head_specs, rev_specs
+
+    def _get_file_spec(self, path, revision):
+        if revision == HEAD:
+            return path
         else:
-            return result
+            return '%s#%s' % (path, revision)
 
-    def get_file(self, path, revision):
+    def _run_for_specs(self, run, specs, get_spec):
         """
-        Get the contents of a file, at a specific revision.
+        Runs a command on several file specs at once.
+
+        Each file in the output starts with a dict of tagged information,
+        which may be followed by other items (such as the file's contents,
+        for print). This returns a dictionary mapping each spec to the list
+        of items for its file. ``get_spec`` returns the spec that a dict
+        of tagged information is for.
+
+        Files that don't exist only generate warnings, so they're left out.
+        """
+        results = {}
+
+        if not specs:
+            return results
+
+        items = None
+
+        for item in run(*specs):
+            if isinstance(item, dict):
+                spec = get_spec(item)
+
+                if spec in specs and spec not in results:
+                    items = [item]
+                    results[spec] = items
+                else:
+                    items = None
+            elif items is not None:
+                items.append(item)
+
+        # The depot paths in the output may not match the paths we were
+        # given exactly (for instance, if we were given client paths).
+        # These are run on their own, so that the results can't be
+        # confused with those of another file.
+        for spec in specs:
+            if spec in results:
+                continue
+
+            items = None
+
+            for item in run(spec):
+                if isinstance(item, dict):
+                    if items is not None:
+                        break
+
+                    items = [item]
+                elif items is not None:
+                    items.append(item)
+
+            if items is not None:
+                results[spec] = items
+
+        return results
+
+    def _get_files(self, p4, files):
+        head_specs, rev_specs = self._get_file_specs(files)
+
+        # A single print of the files gives us each file's tagged
+        # information, followed by its contents.
+        found = self._run_for_specs(
+            p4.run_print, head_specs,
+            lambda item: item.get('depotFile'))
+        found.update(self._run_for_specs(
+            p4.run_print, rev_specs,
+            lambda item: '%s#%s' % (item.get('depotFile'), item.get('rev'))))
+
+        results = []
+
+        for path, revision in files:
+            if revision == PRE_CREATION:
+                results.append('')
+                continue
+
+            spec = self._get_file_spec(path, revision)
+
+            if spec not in found:
+                raise FileNotFoundError(path, revision)
+
+            results.append(''.join(found[spec][1:]))
+
+        return results
+
+    def get_files(self, files):
+        """
+        Get the contents of several files over a single connection.
+
+        ``files`` is a list of (path, revision) tuples.
+        """
+        return self._run_worker(lambda p4: self._get_files(p4, files))
+
+    def _get_files_exist(self, p4, files):
+        head_specs, rev_specs = self._get_file_specs(files)
+
+        # For a specific revision, fstat's "head" information is for that
+        # revision.
+        found = self._run_for_specs(
+            p4.run_fstat, head_specs,
+            lambda item: item.get('depotFile'))
+        found.update(self._run_for_specs(
+            p4.run_fstat, rev_specs,
+            lambda item: '%s#%s' % (item.get('depotFile'),
+                                    item.get('headRev'))))
+
+        results = []
+
+        for path, revision in files:
+            if revision == PRE_CREATION:
+                results.append(False)
+                continue
+
+            items = found.get(self._get_file_spec(path, revision))
+            results.append(
+                items is not None and
+                'delete' not in items[0].get('headAction', ''))
+
+        return results
+
+    def get_files_exist(self, files):
         """
-        return self._run_worker(lambda: self._get_file(path, revision))
+        Check whether several files exist, with a single 'p4 fstat'.
 
-    def _get_files_at_revision(self, revision_str):
-        return self.p4.run_files(revision_str)
+        ``files`` is a list of (path, revision) tuples.
+        """
+        return self._run_worker(lambda p4: self._get_files_exist(p4, files))
+
+    def _get_files_at_revision(self, p4, revision_str):
+        return p4.run_files(revision_str)
 
     def get_files_at_revision(self, revision_str):
         """
@@ -237,13 +513,15 @@ class PerforceClient(object):
         to 'p4 files'
         """
         return self._run_worker(
-            lambda: self._get_files_at_revision(revision_str))
+            lambda p4: self._get_files_at_revision(p4, revision_str))
 
 
 class PerforceTool(SCMTool):
     name = "Perforce"
     uses_atomic_revisions = True
     supports_authentication = True
+    files_exist_fetches_contents = False
+    shareable = True
     dependencies = {
         'modules': ['P4'],
     }
@@ -311,6 +589,12 @@ class PerforceTool(SCMTool):
     def get_file(self, path, revision=HEAD):
         return self.client.get_file(path, revision)
 
+    def get_files(self, files):
+        return self.client.get_files(files)
+
+    def files_exist(self, files):
+        return self.client.get_files_exist(files)
+
     def parse_diff_revision(self, file_str, revision_str):
         # Perforce has this lovely idiosyncracy that diffs show revision #1 both
         # for pre-creation and when there's an actual revision.
@@ -0,0 +1,178 @@
+"""
+Keeps processes and connections to repositories around between requests.
+
+Starting a process or connecting to a server for every file is slow, so
+SCMTools that talk to something long-running keep what they've started in
+an IdleResourcePool, keyed by whatever identifies the repository. The pool
+hands idle resources back out, checks that they're still usable first, and
+closes any that have been idle for too long from a background thread.
+"""
+import os
+import threading
+import time
+
+
+class IdleResourcePool(object):
+    """A pool of idle resources, such as processes or connections.
+
+    Resources are kept per key, and are reused across requests. Up to
+    ``max_idle`` resources are kept for each key, and any that have been
+    idle for longer than ``idle_timeout`` seconds are closed by a reaper
+    thread, which is started the first time a resource is released.
+
+    Subclasses implement _create and _close, and can override
+    _is_reusable to check a resource before it's handed out again.
+    """
+    max_idle = 4
+    idle_timeout = 300
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+        self._reaper = None
+
+    def acquire(self, key):
+        """Returns an idle resource for the key, or a new one."""
+        while True:
+            self._lock.acquire()
+
+            try:
+                self._check_pid()
+                resources = self._idle.get(key)
+
+                if not resources:
+                    break
+
+                resource, last_used = resources.pop()
+            finally:
+                self._lock.release()
+
+            # Checking a resource may mean talking to it, so it's done
+            # outside the lock.
+            if self._is_reusable(resource, last_used):
+                return resource
+
+            self._close(resource)
+
+        return self._create(key)
+
+    def release(self, key, resource):
+        """Returns a resource to the pool once it's no longer in use.
+
+        If there are already enough idle resources for the key, the
+        resource is closed instead.
+        """
+        self._lock.acquire()
+
+        try:
+            if self._check_pid():
+                # This resource was acquired before a fork, and belongs to
+                # the parent process.
+                return
+
+            resources = self._idle.setdefault(key, [])
+
+            if len(resources) < self.max_idle:
+                resources.append((resource, time.time()))
+                resource = None
+
+            if not self._reaper:
+                self._reaper = threading.Thread(target=self._reap_loop)
+                self._reaper.setDaemon(True)
+                self._reaper.start()
+        finally:
+            self._lock.release()
+
+        if resource is not None:
+            self._close(resource)
+
+    def close_idle(self, matches=None):
+        """Closes idle resources.
+
+        If ``matches`` is given, only resources with keys for which it
+        returns True are closed.
+        """
+        closed = []
+
+        self._lock.acquire()
+
+        try:
+            self._check_pid()
+
+            for key in self._idle.keys():
+                if matches is None or matches(key):
+                    closed += self._idle.pop(key)
+        finally:
+            self._lock.release()
+
+        for resource, last_used in closed:
+            self._close(resource)
+
+    def close_all(self):
+        """Closes all idle resources."""
+        self.close_idle()
+
+    def reap_idle(self):
+        """Closes any resources that have been idle for too long."""
+        expired = []
+        cutoff = time.time() - self.idle_timeout
+
+        self._lock.acquire()
+
+        try:
+            self._check_pid()
+
+            for key, resources in self._idle.items():
+                expired += [resource for resource, last_used in resources
+                            if last_used < cutoff]
+                resources = [(resource, last_used)
+                             for resource, last_used in resources
+                             if last_used >= cutoff]
+
+                if resources:
+                    self._idle[key] = resources
+                else:
+                    del self._idle[key]
+        finally:
+            self._lock.release()
+
+        for resource in expired:
+            self._close(resource)
+
+    def _create(self, key):
+        raise NotImplementedError
+
+    def _close(self, resource):
+        raise NotImplementedError
+
+    def _is_reusable(self, resource, last_used):
+        return True
+
+    def _reset(self):
+        """Forgets everything in the pool. The caller must hold the lock.
+
+        Subclasses that keep more state can extend this.
+        """
+        self._idle = {}
+        self._reaper = None
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            self.reap_idle()
+
+    def _check_pid(self):
+        """Resets the pool if this process was forked.
+
+        The resources belong to the parent process, so the child needs to
+        make its own, and start its own reaper thread. Returns True if the
+        pool was reset.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._reset()
+
+            return True
+
+        return False
@@ -0,0 +1,193 @@
+"""
+Fetches files from repositories over HTTP.
+
+Repositories that are read through raw file URLs (such as remote Git
+repositories with a raw file URL mask, or Mercurial repositories served
+by hgweb) fetch one URL per file. RawFileClient keeps a requests session
+per repository, so that connections are kept alive and reused across
+files and requests, and fetches the files for a diff several at a time.
+"""
+import threading
+
+import requests
+
+from reviewboard.lrucache import LRUCache
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class RawFileClient(object):
+    """
+    Fetches raw files over HTTP for a repository.
+
+    If the server sends an ETag or Last-Modified header with a file, the
+    file is kept around, and fetching the same URL again sends a
+    conditional request. If the server says the file hasn't changed, the
+    kept copy is returned without transferring it again. Files at a fixed
+    revision never change, but this saves transfers for files at HEAD.
+    """
+    # The maximum number of files fetched at once by fetch_many.
+    max_concurrent_requests = 4
+
+    # The total size of the files kept around for conditional requests,
+    # and the largest file that will be kept. The least recently used
+    # files are dropped to stay under the total.
+    max_conditional_total_size = 4 * 1024 * 1024
+    max_conditional_size = 1024 * 1024
+
+    def __init__(self, username=None, password=None):
+        self.session = requests.session()
+
+        if username or password:
+            self.session.auth = requests.auth.HTTPBasicAuth(username,
+                                                            password)
+
+        self._conditional = LRUCache()
+        self._conditional_size = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, url, encoding=None):
+        """
+        Fetches a file, returning a tuple of (status code, contents).
+
+        The contents are decoded from the response, using ``encoding`` if
+        it's given. HTTP errors are returned as status codes, rather than
+        raised, but connection errors are raised.
+        """
+        headers = {}
+
+        self._lock.acquire()
+
+        try:
+            entry = self._conditional.get(url)
+        finally:
+            self._lock.release()
+
+        if entry:
+            etag, last_modified, text = entry
+
+            if etag:
+                headers['If-None-Match'] = etag
+
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = self.session.get(url, headers=headers)
+
+        if response.status_code == 304 and entry:
+            return requests.codes.ok, text
+
+        if encoding:
+            response.encoding = encoding
+
+        text = response.text
+
+        if response.status_code == requests.codes.ok:
+            self._store_conditional(url, response, text)
+
+        return response.status_code, text
+
+    def fetch_many(self, urls, encoding=None):
+        """
+        Fetches several files, returning a list of results from fetch.
+
+        Up to max_concurrent_requests files are fetched at once, over the
+        same kept-alive connections. If any fetches raise an exception,
+        the first one in the list is raised once they're all done.
+        """
+        results = [None] * len(urls)
+        errors = [None] * len(urls)
+        indexes = range(len(urls))
+        indexes_lock = threading.Lock()
+
+        def worker():
+            while True:
+                indexes_lock.acquire()
+
+                try:
+                    if not indexes:
+                        return
+
+                    i = indexes.pop(0)
+                finally:
+                    indexes_lock.release()
+
+                try:
+                    results[i] = self.fetch(urls[i], encoding)
+                except Exception, e:
+                    errors[i] = e
+
+        num_workers = min(self.max_concurrent_requests, len(urls))
+
+        if num_workers <= 1:
+            worker()
+        else:
+            threads = [threading.Thread(target=worker)
+                       for i in xrange(num_workers)]
+
+            for thread in threads:
+                thread.setDaemon(True)
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+        for error in errors:
+            if error is not None:
+                raise error
+
+        return results
+
+    def _store_conditional(self, url, response, text):
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+
+        if ((not etag and not last_modified) or
+            len(text) > self.max_conditional_size):
+            return
+
+        self._lock.acquire()
+
+        try:
+            self._discard_conditional(url)
+            self._conditional.set(url, (etag, last_modified, text))
+            self._conditional_size += len(text)
+
+            while self._conditional_size > self.max_conditional_total_size:
+                old_url, entry = self._conditional.popitem()
+                self._conditional_size -= len(entry[2])
+        finally:
+            self._lock.release()
+
+    def _discard_conditional(self, url):
+        """Drops a kept file. The caller must hold the lock."""
+        entry = self._conditional.pop(url, None)
+
+        if entry:
+            self._conditional_size -= len(entry[2])
+
+
+def get_raw_file_client(url, username=None, password=None):
+    """
+    Returns the RawFileClient for a repository.
+
+    Clients are shared by everything in the process that fetches from the
+    repository with the same credentials, so that they can share
+    connections.
+    """
+    key = (url, username, password)
+
+    _clients_lock.acquire()
+
+    try:
+        client = _clients.get(key)
+
+        if client is None:
+            client = RawFileClient(username, password)
+            _clients[key] = client
+
+        return client
+    finally:
+        _clients_lock.release()
@@ -1,17 +1,25 @@
 import logging
 import os
 import re
+import threading
 import urllib
 import urlparse
 
 try:
-    from pysvn import ClientError, Revision, opt_revision_kind
+    from pysvn import ClientError, Revision, node_kind, opt_revision_kind
 except ImportError:
     pass
 
+try:
+    # This is only available with pysvn 1.6 and higher.
+    from pysvn import depth
+except ImportError:
+    depth = None
+
 from django.utils.translation import ugettext as _
 
 from reviewboard.diffviewer.parser import DiffParser
+from reviewboard.lrucache import LRUCache
 from reviewboard.scmtools import sshutils
 from reviewboard.scmtools.certs import Certificate
 from reviewboard.scmtools.core import SCMTool, HEAD, PRE_CREATION, UNKNOWN
@@ -42,6 +50,8 @@ class SVNTool(SCMTool):
     name = "Subversion"
     uses_atomic_revisions = True
     supports_authentication = True
+    files_exist_fetches_contents = False
+    shareable = True
     dependencies = {
         'modules': ['pysvn'],
     }
@@ -52,6 +62,9 @@ class SVNTool(SCMTool):
     URL_KEYWORDS      = ['HeadURL', 'URL']
     ID_KEYWORDS       = ['Id']
 
+    # The number of directories whose svn:keywords properties are cached.
+    KEYWORDS_CACHE_SIZE = 1000
+
     # Mapping of keywords to known aliases
     keywords = {
         # Standard keywords
@@ -77,13 +90,21 @@ class SVNTool(SCMTool):
         super(SVNTool, self).__init__(repository)
 
         if repository.local_site:
-            local_site_name = repository.local_site.name
+            self.local_site_name = repository.local_site.name
         else:
-            local_site_name = None
+            self.local_site_name = None
+
+        # The svn:keywords properties of the files in each directory and
+        # revision looked up. See __get_keywords.
+        self._keywords_cache = LRUCache(self.KEYWORDS_CACHE_SIZE)
+        self._keywords_cache_lock = threading.Lock()
 
-        self.config_dir, self.client = \
+        # pysvn clients can't be used by several threads at once, so each
+        # thread using this tool gets its own. See _get_client.
+        self._thread_state = threading.local()
+        self.config_dir, self._thread_state.client = \
             self.build_client(repository.username, repository.password,
-                              local_site_name)
+                              self.local_site_name)
 
         # svnlook uses 'rev 0', while svn diff uses 'revision 0'
         self.revision_re = re.compile("""
@@ -102,6 +123,19 @@ class SVNTool(SCMTool):
                                             # uses 'revision 0'
             """, re.VERBOSE)
 
+    def _get_client(self):
+        client = getattr(self._thread_state, 'client', None)
+
+        if client is None:
+            client = self.build_client(self.repository.username,
+                                       self.repository.password,
+                                       self.local_site_name)[1]
+            self._thread_state.client = client
+
+        return client
+
+    client = property(_get_client)
+
     def get_file(self, path, revision=HEAD):
         if not path:
             raise FileNotFoundError(path, revision)
@@ -109,17 +143,8 @@ class SVNTool(SCMTool):
         try:
             normpath = self.__normalize_path(path)
 
-            # SVN expects to have URLs escaped. Take care to only
-            # escape the path part of the URL.
             if self.client.is_url(normpath):
-                pathtuple = urlparse.urlsplit(normpath)
-                path = pathtuple[2]
-                if isinstance(path, unicode):
-                    path = path.encode('utf-8', 'ignore')
-                normpath = urlparse.urlunsplit((pathtuple[0],
-                                                pathtuple[1],
-                                                urllib.quote(path),
-                                                '',''))
+                normpath = self.__quote_url(normpath)
 
             normrev  = self.__normalize_revision(revision)
 
@@ -128,11 +153,10 @@ class SVNTool(SCMTool):
             # Find out if this file has any keyword expansion set.
             # If it does, collapse these keywords. This is because SVN
             # will return the file expanded to us, which would break patching.
-            keywords = self.client.propget("svn:keywords", normpath, normrev,
-                                           recurse=True)
+            keywords = self.__get_keywords(normpath, normrev, revision)
 
-            if normpath in keywords:
-                data = self.collapse_keywords(data, keywords[normpath])
+            if keywords:
+                data = self.collapse_keywords(data, keywords)
 
             return data
         except ClientError, e:
@@ -150,6 +174,115 @@ class SVNTool(SCMTool):
             else:
                 raise SCMError(e)
 
+    def files_exist(self, files):
+        """
+        Checks whether several files exist.
+
+        Rather than fetching each file, the files are grouped by directory
+        and revision, and each directory is listed with a single info2
+        call. Any file that doesn't show up in its directory's listing is
+        double-checked on its own, so that differences in how URLs are
+        written can't cause a file to be reported as missing.
+        """
+        if depth is None or not self.client.is_url(self.repopath):
+            return super(SVNTool, self).files_exist(files)
+
+        results = [False] * len(files)
+        groups = {}
+
+        for i, (path, revision) in enumerate(files):
+            if path and revision not in (PRE_CREATION, UNKNOWN):
+                url = self.__quote_url(self.__normalize_path(path))
+                dirname = url.rsplit('/', 1)[0]
+                groups.setdefault((dirname, revision), []).append((i, url))
+
+        for (dirname, revision), group in groups.iteritems():
+            normrev = self.__normalize_revision(revision)
+
+            try:
+                entries = self.client.info2(dirname,
+                                            revision=normrev,
+                                            peg_revision=normrev,
+                                            depth=depth.immediates)
+            except ClientError:
+                entries = []
+
+            file_urls = set([self.__unquote_url(info['URL'])
+                             for name, info in entries
+                             if info['kind'] == node_kind.file])
+
+            for i, url in group:
+                results[i] = self.__unquote_url(url) in file_urls
+
+        for i, (path, revision) in enumerate(files):
+            if not results[i] and revision not in (PRE_CREATION, UNKNOWN):
+                results[i] = self.file_exists(path, revision)
+
+        return results
+
+    def __get_keywords(self, normpath, normrev, revision):
+        """
+        Returns the svn:keywords property of a file, or None if it's not set.
+
+        Rather than asking for the property of each file, the properties of
+        every file in the file's directory are fetched with one propget
+        call. For files at a specific revision, these are cached, so that
+        other files in the same directory and revision don't need another
+        trip to the server.
+        """
+        if depth is None or revision == HEAD:
+            keywords = self.client.propget("svn:keywords", normpath, normrev,
+                                           recurse=True)
+
+            return keywords.get(normpath)
+
+        dirname = normpath.rsplit('/', 1)[0]
+        key = (dirname, str(revision))
+
+        self._keywords_cache_lock.acquire()
+
+        try:
+            dir_keywords = self._keywords_cache.get(key)
+        finally:
+            self._keywords_cache_lock.release()
+
+        if dir_keywords is None:
+            try:
+                keywords = self.client.propget("svn:keywords", dirname,
+                                               normrev,
+                                               depth=depth.immediates)
+            except ClientError, e:
+                # The directory may not be readable, even though the file
+                # is. Fall back on asking for the file's property.
+                logging.debug('SVN: Unable to get svn:keywords for %s: %s' %
+                              (dirname, e))
+                keywords = self.client.propget("svn:keywords", normpath,
+                                               normrev, recurse=True)
+
+                return keywords.get(normpath)
+
+            dir_keywords = dict([
+                (self.__normalize_keywords_path(path), value)
+                for path, value in keywords.iteritems()
+            ])
+
+            self._keywords_cache_lock.acquire()
+
+            try:
+                self._keywords_cache.set(key, dir_keywords)
+            finally:
+                self._keywords_cache_lock.release()
+
+        return dir_keywords.get(self.__normalize_keywords_path(normpath))
+
+    def __normalize_keywords_path(self, path):
+        # URLs in the results may not be quoted the same way as the URLs
+        # we asked for.
+        if self.client.is_url(path):
+            return self.__unquote_url(path)
+        else:
+            return path
+
     def collapse_keywords(self, data, keyword_str):
         """
         Collapse SVN keywords in string.
@@ -250,6 +383,23 @@ class SVNTool(SCMTool):
 
         return r
 
+    def __quote_url(self, url):
+        # SVN expects to have URLs escaped. Take care to only
+        # escape the path part of the URL.
+        pathtuple = urlparse.urlsplit(url)
+        path = pathtuple[2]
+        if isinstance(path, unicode):
+            path = path.encode('utf-8', 'ignore')
+        return urlparse.urlunsplit((pathtuple[0],
+                                    pathtuple[1],
+                                    urllib.quote(path),
+                                    '',''))
+
+    def __unquote_url(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8', 'ignore')
+        return urllib.unquote(url)
+
     def __normalize_path(self, path):
         if path.startswith(self.repopath):
             return path
@@ -1,11 +1,16 @@
+import BaseHTTPServer
 import errno
+import hashlib
 import imp
 import os
 import nose
 import paramiko
 import shutil
+import signal
 import socket
 import tempfile
+import threading
+import time
 try:
     from hashlib import md5
 except ImportError:
@@ -13,6 +18,7 @@ except ImportError:
 
 from django.contrib.auth.models import AnonymousUser, User
 from django.test import TestCase as DjangoTestCase
+from djblets.siteconfig.models import SiteConfiguration
 from djblets.util.filesystem import is_exe_in_path
 try:
     imp.find_module("P4")
@@ -24,14 +30,24 @@ from reviewboard.diffviewer.diffutils import patch
 from reviewboard.diffviewer.parser import DiffParserError
 from reviewboard.reviews.models import Group
 from reviewboard.scmtools import sshutils
-from reviewboard.scmtools.core import HEAD, PRE_CREATION, ChangeSet, Revision
+from reviewboard.scmtools.core import HEAD, PRE_CREATION, UNKNOWN, ChangeSet, \
+                                     Revision, SCMTool
+from reviewboard.scmtools.cvs import CVSServerSession, \
+                                     scramble_pserver_password, \
+                                     _session_pool
 from reviewboard.scmtools.errors import SCMError, FileNotFoundError, \
                                         RepositoryNotFoundError, \
                                         AuthenticationError
+from reviewboard.scmtools.filestore import FileStore, is_storable_revision
 from reviewboard.scmtools.forms import RepositoryForm
-from reviewboard.scmtools.git import ShortSHA1Error
+from reviewboard.scmtools.git import GitCatFileError, GitCatFileProcess, \
+                                      GitClient, GitMirror, GitMirrorError, \
+                                      ShortSHA1Error, _cat_file_pool
+from reviewboard.scmtools.hg import HgWebClient
 from reviewboard.scmtools.models import Repository, Tool
 from reviewboard.scmtools.perforce import STunnelProxy, STUNNEL_SERVER
+from reviewboard.scmtools.rawfiles import RawFileClient
+from reviewboard.scmtools.svn import depth as svn_depth
 from reviewboard.site.models import LocalSite
 
 
@@ -154,6 +170,71 @@ class CoreTests(DjangoTestCase):
         self.assert_(len(cs.files) == 0)
 
 
+class FileStoreTests(DjangoTestCase):
+    """Unit tests for the repository file store."""
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp(prefix='rb-tests-')
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_get_and_set(self):
+        """Testing FileStore.get and set"""
+        store = FileStore(self.store_dir, 1024 * 1024)
+        self.assertEqual(store.get(1, 'README', '123'), None)
+
+        store.set(1, 'README', '123', 'Hello\n')
+        store.set(2, 'README', '456', 'Hello\n')
+        self.assertEqual(store.get(1, 'README', '123'), 'Hello\n')
+        self.assertEqual(store.get(2, 'README', '456'), 'Hello\n')
+        self.assertEqual(store.get(1, 'README', '456'), None)
+
+        # Both files have the same contents, so they're only stored once.
+        self.assertEqual(len(os.listdir(os.path.join(self.store_dir,
+                                                     'blobs'))), 1)
+
+        # Compressed contents can be read with compression turned off.
+        store = FileStore(self.store_dir, 1024 * 1024, compress=True)
+        store.set(1, 'NEWS', '123', 'News\n')
+        self.assertEqual(store.get(1, 'NEWS', '123'), 'News\n')
+
+        store = FileStore(self.store_dir, 1024 * 1024)
+        self.assertEqual(store.get(1, 'NEWS', '123'), 'News\n')
+        self.assertEqual(store.get(1, 'README', '123'), 'Hello\n')
+
+        # Unicode contents come back as unicode.
+        store.set(1, 'AUTHORS', '123', u'J\xe9r\xf4me\n')
+        data = store.get(1, 'AUTHORS', '123')
+        self.assertTrue(isinstance(data, unicode))
+        self.assertEqual(data, u'J\xe9r\xf4me\n')
+
+    def test_evict(self):
+        """Testing FileStore.evict"""
+        store = FileStore(self.store_dir, 100)
+        store.set(1, 'a', '1', 'a' * 40)
+        store.set(1, 'b', '1', 'b' * 40)
+
+        # Make the first file the most recently used one.
+        for i, path in enumerate(('b', 'a')):
+            data_hash = hashlib.sha1(path * 40).hexdigest()
+            os.utime(store._get_blob_path(data_hash, False), (i, i))
+
+        store.set(1, 'c', '1', 'c' * 40)
+        store.evict()
+
+        self.assertEqual(store.get(1, 'a', '1'), 'a' * 40)
+        self.assertEqual(store.get(1, 'b', '1'), None)
+        self.assertEqual(store.get(1, 'c', '1'), 'c' * 40)
+
+    def test_is_storable_revision(self):
+        """Testing is_storable_revision"""
+        self.assertTrue(is_storable_revision('123'))
+        self.assertTrue(is_storable_revision(Revision('123')))
+        self.assertFalse(is_storable_revision(HEAD))
+        self.assertFalse(is_storable_revision(UNKNOWN))
+        self.assertFalse(is_storable_revision(PRE_CREATION))
+
+
 class SSHUtilsTests(SCMTestCase):
     """Unit tests for sshutils."""
     def setUp(self):
@@ -353,6 +434,40 @@ class CVSTests(SCMTestCase):
         self.assertRaises(FileNotFoundError,
                           lambda: self.tool.get_file('hello', PRE_CREATION))
 
+    def test_get_file_session(self):
+        """Testing CVSTool.get_file reusing a CVS server session"""
+        _session_pool.close_all()
+
+        self.assertEqual(self.tool.get_file('test/testfile', Revision('1.1')),
+                         'test content\n')
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.tool.get_file('test/testfile2',
+                                                     Revision('1.1')))
+        self.assertEqual(self.tool.get_file('test/testfile', Revision('1.1')),
+                         'test content\n')
+
+        key = (self.tool.client.cvsroot, None)
+        self.assertEqual(len(_session_pool._idle[key]), 1)
+
+        _session_pool.close_all()
+
+    def test_session_cvsroot_parsing(self):
+        """Testing parsing a CVSROOT for a CVS server session"""
+        parse = CVSServerSession.parse_cvsroot
+
+        self.assertEqual(parse(':pserver:anon:pw@example.com:123/cvsroot'),
+                         ('pserver', 'anon', 'pw', 'example.com', 123,
+                          '/cvsroot'))
+        self.assertEqual(parse(':ext:user@example.com:/cvsroot'),
+                         ('ext', 'user', None, 'example.com', None,
+                          '/cvsroot'))
+        self.assertEqual(parse(':local:/cvsroot'),
+                         ('local', None, None, None, None, '/cvsroot'))
+        self.assertEqual(parse(':gserver:example.com:/cvsroot'), None)
+
+        self.assertEqual(scramble_pserver_password(''), 'A')
+        self.assertEqual(scramble_pserver_password('anoncvs'), 'Ay=0=h<Z')
+
     def test_revision_parsing(self):
         """Testing revision number parsing"""
         self.assertEqual(self.tool.parse_diff_revision('', 'PRE-CREATION')[1],
@@ -458,6 +573,21 @@ class CVSTests(SCMTestCase):
         self._test_ssh_with_site(self.cvs_ssh_path, 'CVSROOT/modules')
 
 
+class PropgetCountingClient(object):
+    """Wraps a pysvn client, recording the propget calls made through it."""
+    def __init__(self, client):
+        self.client = client
+        self.propget_calls = []
+
+    def propget(self, prop_name, url_or_path, *args, **kwargs):
+        self.propget_calls.append((url_or_path, kwargs.get('depth')))
+
+        return self.client.propget(prop_name, url_or_path, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
 class SubversionTests(SCMTestCase):
     """Unit tests for subversion."""
     fixtures = ['test_scmtools.json']
@@ -517,6 +647,17 @@ class SubversionTests(SCMTestCase):
                           lambda: self.tool.get_file('hello',
                                                      PRE_CREATION))
 
+    def test_files_exist(self):
+        """Testing SVNTool.files_exist"""
+        self.assertEqual(
+            self.tool.files_exist([
+                ('trunk/doc/misc-docs/Makefile', Revision('2')),
+                ('/trunk/doc/misc-docs/Makefile', HEAD),
+                ('trunk/doc/misc-docs/Makefile2', HEAD),
+                ('trunk/doc/misc-docs/Makefile', PRE_CREATION),
+            ]),
+            [True, True, False, False])
+
     def test_revision_parsing(self):
         """Testing revision number parsing"""
         self.assertEqual(self.tool.parse_diff_revision('', '(working copy)')[1],
@@ -583,6 +724,32 @@ class SubversionTests(SCMTestCase):
         file = self.tool.get_file(filename, rev)
         patch(diff, file, filename)
 
+    def test_keywords_cache(self):
+        """Testing SVNTool.get_file caching svn:keywords by directory"""
+        if svn_depth is None:
+            raise nose.SkipTest('pysvn 1.6 or higher is required')
+
+        client = PropgetCountingClient(self.tool.client)
+        self.tool._thread_state.client = client
+
+        filename = 'trunk/doc/misc-docs/Makefile'
+        rev = Revision('4')
+        file = self.tool.get_file(filename, rev)
+        self.assertTrue(file.startswith('# $Id$\n# $Rev$\n'))
+
+        # The keywords for the whole directory were fetched at once.
+        self.assertEqual(len(self.tool._keywords_cache), 1)
+        self.assertEqual(len(client.propget_calls), 1)
+
+        url, depth = client.propget_calls[0]
+        self.assertTrue(url.endswith('/trunk/doc/misc-docs'))
+        self.assertEqual(depth, svn_depth.immediates)
+
+        # Fetching the file again uses the cached keywords.
+        self.assertEqual(self.tool.get_file(filename, rev), file)
+        self.assertEqual(len(self.tool._keywords_cache), 1)
+        self.assertEqual(len(client.propget_calls), 1)
+
     def test_unterminated_keyword_diff(self):
         """Testing parsing SVN diff with unterminated keywords"""
         diff = "Index: Makefile\n" \
@@ -606,6 +773,62 @@ class SubversionTests(SCMTestCase):
         patch(diff, file, filename)
 
 
+class FakeP4(object):
+    """A stand-in for a P4 connection, for testing lookups of file specs.
+
+    ``files`` maps depot paths to a list of the contents of each revision.
+    ``aliases`` maps other paths (such as client paths) to depot paths.
+    """
+    def __init__(self, files, aliases={}):
+        self.files = files
+        self.aliases = aliases
+
+    def run_print(self, *specs):
+        results = []
+
+        for spec in specs:
+            info = self._lookup(spec)
+
+            if info:
+                depot_path, rev = info
+                results += [{'depotFile': depot_path, 'rev': str(rev)},
+                            self.files[depot_path][rev - 1]]
+
+        return results
+
+    def run_fstat(self, *specs):
+        results = []
+
+        for spec in specs:
+            info = self._lookup(spec)
+
+            if info:
+                depot_path, rev = info
+                results.append({'depotFile': depot_path,
+                                'headRev': str(rev),
+                                'headAction': 'edit'})
+
+        return results
+
+    def _lookup(self, spec):
+        if '#' in spec:
+            path, rev = spec.split('#', 1)
+            rev = int(rev)
+        else:
+            path, rev = spec, None
+
+        depot_path = self.aliases.get(path, path)
+        revisions = self.files.get(depot_path, [])
+
+        if rev is None:
+            rev = len(revisions)
+
+        if 0 < rev <= len(revisions):
+            return depot_path, rev
+
+        return None
+
+
 class PerforceTests(SCMTestCase):
     """Unit tests for perforce.
 
@@ -715,6 +938,63 @@ class PerforceTests(SCMTestCase):
         self.assertEqual(md5(file).hexdigest(),
                          '227bdd87b052fcad9369e65c7bf23fd0')
 
+    def test_get_files(self):
+        """Testing PerforceTool.get_files"""
+        try:
+            files = self.tool.get_files([
+                ('//public/perforce/api/python/P4Client/p4.py', 1),
+                ('//depot/foo', PRE_CREATION),
+                ('//public/perforce/api/python/P4Client/p4.py', 1),
+            ])
+        except Exception, e:
+            if str(e).startswith('Connect to server failed'):
+                raise nose.SkipTest(
+                    'Connection to public.perforce.com failed.  No internet?')
+            else:
+                raise
+
+        self.assertEqual(len(files), 3)
+        self.assertEqual(md5(files[0]).hexdigest(),
+                         '227bdd87b052fcad9369e65c7bf23fd0')
+        self.assertEqual(files[1], '')
+        self.assertEqual(files[2], files[0])
+
+    def test_get_files_at_head_and_revision(self):
+        """Testing PerforceTool.get_files with a file at HEAD and a revision"""
+        p4 = FakeP4({'//depot/foo': ['rev 1\n', 'rev 2\n']},
+                    aliases={'//depot/Foo': '//depot/foo'})
+        client = self.tool.client
+
+        self.assertEqual(
+            client._get_files(p4, [
+                ('//depot/foo', '1'),
+                ('//depot/foo', HEAD),
+                ('//depot/Foo', '1'),
+                ('//depot/Foo', HEAD),
+            ]),
+            ['rev 1\n', 'rev 2\n', 'rev 1\n', 'rev 2\n'])
+        self.assertRaises(FileNotFoundError,
+                          lambda: client._get_files(p4, [
+                              ('//depot/foo', HEAD),
+                              ('//depot/foo', '3'),
+                          ]))
+
+    def test_files_exist_at_head_and_revision(self):
+        """Testing PerforceTool.files_exist with HEAD and a revision"""
+        p4 = FakeP4({'//depot/foo': ['rev 1\n', 'rev 2\n']},
+                    aliases={'//depot/Foo': '//depot/foo'})
+
+        self.assertEqual(
+            self.tool.client._get_files_exist(p4, [
+                ('//depot/foo', '3'),
+                ('//depot/foo', HEAD),
+                ('//depot/foo', '1'),
+                ('//depot/bar', HEAD),
+                ('//depot/Foo', HEAD),
+                ('//depot/foo', PRE_CREATION),
+            ]),
+            [False, True, True, False, True, False])
+
     def test_empty_diff(self):
         """Testing Perforce empty diff parsing"""
         diff = "==== //depot/foo/proj/README#2 ==M== /src/proj/README ====\n"
@@ -1091,6 +1371,22 @@ class MercurialTests(SCMTestCase):
         self.assert_(tool.file_exists('TODO.rst', rev))
         self.assert_(not tool.file_exists('TODO.rstNotFound', rev))
 
+    def test_hgweb_raw_file_urls(self):
+        """Testing HgWebClient remembering the supported raw file URL form"""
+        client = HgWebClient('http://hg.example.com/repo', 'user', 'pass')
+        self.assertEqual(client._get_rawpaths(), ['raw-file', 'raw'])
+
+        # Clients for the same repository share connections.
+        client2 = HgWebClient('http://hg.example.com/repo', 'user', 'pass')
+        self.assertTrue(client2.client is client.client)
+
+        HgWebClient._supported_rawpaths[client.url] = 'raw'
+
+        try:
+            self.assertEqual(client2._get_rawpaths(), ['raw', 'raw-file'])
+        finally:
+            del HgWebClient._supported_rawpaths[client.url]
+
 
 class GitTests(SCMTestCase):
     """Unit tests for Git."""
@@ -1353,6 +1649,16 @@ class GitTests(SCMTestCase):
         self.assert_(not self.tool.file_exists("readme", "a62df6c"))
         self.assert_(not self.tool.file_exists("readme2", "ccffbb4"))
 
+    def test_files_exist(self):
+        """Testing GitTool.files_exist"""
+        self.assertEqual(
+            self.tool.files_exist([("readme", "e965047"),
+                                   ("readme", "d6613f5"),
+                                   ("readme", PRE_CREATION),
+                                   ("readme", "fffffff"),
+                                   ("readme", "a62df6c")]),
+            [True, True, False, False, False])
+
     def test_get_file(self):
         """Testing GitTool.get_file"""
 
@@ -1371,6 +1677,155 @@ class GitTests(SCMTestCase):
         self.assertRaises(FileNotFoundError,
                           lambda: self.tool.get_file("readme", "0000000"))
 
+    def test_get_files(self):
+        """Testing GitTool.get_files"""
+
+        self.assertEqual(
+            self.tool.get_files([("readme", "e965047"),
+                                 ("readme", PRE_CREATION),
+                                 ("readme", "d6613f5"),
+                                 ("readme", HEAD)]),
+            ['Hello\n', '', 'Hello there\n', 'Hello there\n'])
+        self.assertEqual(self.tool.get_files([]), [])
+
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.tool.get_files([("readme", "e965047"),
+                                                       ("hello", "0000000")]))
+
+    def test_cat_file_error_output(self):
+        """Testing git cat-file error output going to a file"""
+        process = GitCatFileProcess(os.path.join(self.local_repo_path, 'bad'),
+                                    '--batch')
+
+        try:
+            self.assertEqual(process.process.stderr, None)
+
+            try:
+                process.lookup('e965047')
+                self.fail('Expected a GitCatFileError')
+            except GitCatFileError, e:
+                self.assertTrue('not a git repository' in str(e).lower())
+        finally:
+            process.close()
+
+    def test_get_file_after_cat_file_exits(self):
+        """Testing GitTool.get_file after git cat-file exits unexpectedly"""
+        self.assertEqual(self.tool.get_file("readme", "e965047"), 'Hello\n')
+
+        for processes in _cat_file_pool._idle.itervalues():
+            for process, last_used in processes:
+                os.kill(process.process.pid, signal.SIGKILL)
+                process.process.wait()
+
+        self.assertEqual(self.tool.get_file("readme", "d6613f5"),
+                         'Hello there\n')
+
+    def test_mirror(self):
+        """Testing GitMirror"""
+        self.tempdir = tempfile.mkdtemp(prefix='rb-tests-home-')
+        self._set_home(self.tempdir)
+
+        mirror = GitMirror(self.local_repo_path)
+        self.assertTrue(mirror.git_dir.startswith(self.tempdir))
+
+        mirror.ensure_cloned()
+        self.assertTrue(mirror.is_cloned())
+        self.assertTrue(os.path.exists(mirror.lock_path))
+        self.assertEqual(
+            _cat_file_pool.lookup(mirror.git_dir, '--batch', ['e965047']),
+            [('blob', 'Hello\n')])
+
+        # The mirror was just cloned, so it's not fetched again right away.
+        self.assertFalse(mirror.fetch())
+        self.assertTrue(mirror.fetch(0))
+        self.assertEqual(
+            _cat_file_pool.lookup(mirror.git_dir, '--batch', ['d6613f5']),
+            [('blob', 'Hello there\n')])
+
+    def test_mirror_credentials(self):
+        """Testing GitMirror passing HTTP credentials to git"""
+        self.tempdir = tempfile.mkdtemp(prefix='rb-tests-home-')
+        self._set_home(self.tempdir)
+
+        mirror = GitMirror('https://example.com/repo.git',
+                           username='user', password=u'p@ss w\xf6rd')
+        os.makedirs(os.path.dirname(mirror.git_dir))
+
+        env = mirror._get_git_env()
+        askpass = env['GIT_ASKPASS']
+        self.assertEqual(os.stat(askpass).st_mode & 0777, 0700)
+
+        for prompt, expected in [
+            ("Username for 'https://example.com': ", 'user\n'),
+            ("Password for 'https://user@example.com': ",
+             'p@ss w\xc3\xb6rd\n'),
+        ]:
+            p = SCMTool.popen([askpass, prompt], env=env)
+            self.assertEqual(p.stdout.read(), expected)
+            self.assertEqual(p.wait(), 0)
+
+        # Only HTTP URLs need the credentials passed this way.
+        mirror = GitMirror('ssh://example.com/repo.git',
+                           username='user', password='pass')
+        self.assertEqual(mirror._get_git_env(), None)
+
+    def test_mirror_setting(self):
+        """Testing GitClient checking the mirror setting when it's used"""
+        siteconfig = SiteConfiguration.objects.get_current()
+        old_use_mirrors = siteconfig.get('scmtools_git_use_mirrors')
+        client = GitClient('git://example.com/repo.git')
+
+        try:
+            siteconfig.set('scmtools_git_use_mirrors', False)
+            self.assertEqual(client.mirror, None)
+
+            siteconfig.set('scmtools_git_use_mirrors', True)
+            self.assertTrue(isinstance(client.mirror, GitMirror))
+            self.assertEqual(client.mirror.url, 'git://example.com/repo.git')
+
+            # Local repositories are never mirrored.
+            self.assertEqual(self.tool.client.mirror, None)
+        finally:
+            siteconfig.set('scmtools_git_use_mirrors', old_use_mirrors)
+
+    def test_mirror_falls_back_to_raw_files(self):
+        """Testing GitClient falling back to the raw file URL when the mirror can't be updated"""
+        self.tempdir = tempfile.mkdtemp(prefix='rb-tests-home-')
+        self._set_home(self.tempdir)
+
+        client = GitClient('git://example.com/repo.git',
+                           raw_file_url='http://example.com/<revision>',
+                           use_mirror=True)
+        client._mirror = GitMirror(self.local_repo_path)
+        client._get_raw_files = lambda files: ['raw'] * len(files)
+        missing_sha1 = 'f' * 40
+
+        # The mirror is cloned in the background, and the raw file URL is
+        # used until it's ready.
+        self.assertTrue(client.uses_raw_files())
+        self.assertEqual(client.get_file('readme', 'e965047'), 'raw')
+
+        for i in range(50):
+            if not client.uses_raw_files():
+                break
+
+            time.sleep(0.1)
+
+        self.assertFalse(client.uses_raw_files())
+        self.assertEqual(client.get_file('readme', 'e965047'), 'Hello\n')
+
+        # Objects that aren't in the mirror are fetched from the raw file
+        # URL if the mirror can't be updated.
+        client.mirror.url = os.path.join(self.tempdir, 'missing')
+        client.mirror.min_fetch_interval = 0
+        self.assertEqual(client.get_files([('readme', 'e965047'),
+                                           ('readme', missing_sha1)]),
+                         ['raw', 'raw'])
+
+        client.raw_file_url = None
+        self.assertRaises(GitMirrorError,
+                          lambda: client.get_file('readme', missing_sha1))
+
     def test_parse_diff_revision_with_remote_and_short_SHA1_error(self):
         """Testing GitTool.parse_diff_revision with remote files and short SHA1 error"""
         self.assertRaises(
@@ -1383,6 +1838,154 @@ class GitTests(SCMTestCase):
             ShortSHA1Error,
             lambda: self.remote_tool.get_file('README', 'd7e96b3'))
 
+    def test_scmtool_cache(self):
+        """Testing Repository.get_scmtool caching shareable tools"""
+        self.repository.save()
+
+        tool = self.repository.get_scmtool()
+        self.assertTrue(self.repository.get_scmtool() is tool)
+
+        # Another instance of the same repository gets the same tool.
+        repository = Repository.objects.get(pk=self.repository.pk)
+        self.assertTrue(repository.get_scmtool() is tool)
+
+        # Saving the repository creates a new tool.
+        repository.save()
+        tool2 = repository.get_scmtool()
+        self.assertFalse(tool2 is tool)
+        self.assertTrue(repository.get_scmtool() is tool2)
+
+        # So does changing a field that the tool is created from, even
+        # without saving.
+        repository.encoding = 'latin1'
+        self.assertFalse(repository.get_scmtool() is tool2)
+
+        # Saving with positional arguments works as it does for any model.
+        tool3 = repository.get_scmtool()
+        repository.save(False, True)
+        self.assertEqual(Repository.objects.get(pk=repository.pk).encoding,
+                         'latin1')
+        self.assertFalse(repository.get_scmtool() is tool3)
+
+
+class RawFileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the server's files, with ETags, for RawFileClientTests."""
+    def do_GET(self):
+        if_none_match = self.headers.get('If-None-Match')
+        self.server.requests.append((self.path, if_none_match))
+
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+
+        data = self.server.files[self.path]
+        etag = '"%s"' % md5(data).hexdigest()
+
+        if if_none_match == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class RawFileClientTests(DjangoTestCase):
+    """Unit tests for RawFileClient."""
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                RawFileRequestHandler)
+        self.server.files = {}
+        self.server.requests = []
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+        # HTTPServer.serve_forever can't be stopped before Python 2.6, so
+        # requests are handled until the test is torn down.
+        self.serving = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+        self.client = RawFileClient()
+
+    def tearDown(self):
+        self.serving = False
+
+        # Connect once more, to wake up the server if it's waiting for a
+        # request.
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', self.server.server_port))
+        s.close()
+
+        self.thread.join()
+        self.server.server_close()
+
+    def _serve(self):
+        while self.serving:
+            self.server.handle_request()
+
+    def test_fetch_many(self):
+        """Testing RawFileClient.fetch_many"""
+        for i in range(10):
+            self.server.files['/file%d' % i] = 'Contents %d\n' % i
+
+        urls = ['%s/file%d' % (self.url, i) for i in range(10)]
+        urls.insert(3, '%s/missing' % self.url)
+
+        results = self.client.fetch_many(urls)
+        self.assertEqual(len(results), 11)
+        self.assertEqual(results[3][0], 404)
+        self.assertEqual([result for i, result in enumerate(results)
+                          if i != 3],
+                         [(200, 'Contents %d\n' % i) for i in range(10)])
+        self.assertEqual(len(self.server.requests), 11)
+        self.assertEqual(self.client.fetch_many([]), [])
+
+    def test_fetch_conditional(self):
+        """Testing RawFileClient.fetch with an unchanged file"""
+        self.server.files['/readme'] = 'Hello\n'
+        url = self.url + '/readme'
+
+        self.assertEqual(self.client.fetch(url), (200, 'Hello\n'))
+        self.assertEqual(self.client.fetch(url), (200, 'Hello\n'))
+
+        # The second request sent the first response's ETag, and the
+        # server said the file hadn't changed.
+        etag = '"%s"' % md5('Hello\n').hexdigest()
+        self.assertEqual(self.server.requests,
+                         [('/readme', None), ('/readme', etag)])
+
+        self.server.files['/readme'] = 'Hello there\n'
+        self.assertEqual(self.client.fetch(url), (200, 'Hello there\n'))
+
+    def test_fetch_conditional_total_size(self):
+        """Testing RawFileClient limiting the total size of kept files"""
+        self.client.max_conditional_total_size = 10
+
+        for name in ('a', 'b', 'c'):
+            self.server.files['/' + name] = name * 4
+            self.client.fetch('%s/%s' % (self.url, name))
+
+        self.assertEqual(self.client._conditional.keys(),
+                         [self.url + '/b', self.url + '/c'])
+        self.assertEqual(self.client._conditional_size, 8)
+
+        # Fetching a kept file makes it the most recently used.
+        self.client.fetch(self.url + '/b')
+        self.server.files['/d'] = 'dddd'
+        self.client.fetch(self.url + '/d')
+
+        self.assertEqual(self.client._conditional.keys(),
+                         [self.url + '/b', self.url + '/d'])
+        self.assertEqual(self.client._conditional_size, 8)
+
 
 class PolicyTests(DjangoTestCase):
     fixtures = ['test_scmtools']
@@ -48,10 +48,10 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
-    'django.middleware.gzip.GZipMiddleware', # Keep this first.
+    'reviewboard.middleware.GZipMiddleware', # Keep this first.
     'django.middleware.common.CommonMiddleware',
     'django.middleware.doc.XViewMiddleware',
-    'django.middleware.http.ConditionalGetMiddleware',
+    'reviewboard.middleware.ConditionalGetMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
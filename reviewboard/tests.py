@@ -0,0 +1,216 @@
+import gzip
+from StringIO import StringIO
+
+from django.http import HttpRequest
+from django.test import TestCase
+
+from reviewboard import http
+from reviewboard.http import StreamingHttpResponse
+from reviewboard.lrucache import LRUCache
+from reviewboard.middleware import ConditionalGetMiddleware, GZipMiddleware
+
+
+class StreamingHttpResponseTests(TestCase):
+    """Unit tests for StreamingHttpResponse."""
+    def testStreaming(self):
+        """Testing StreamingHttpResponse reading the stream as it's sent"""
+        read = []
+
+        def stream():
+            for chunk in ['abc', u'd\xe9f']:
+                read.append(chunk)
+                yield chunk
+
+        response = StreamingHttpResponse(stream(), mimetype='text/plain')
+        self.assertEqual(read, [])
+
+        chunks = iter(response)
+        self.assertEqual(chunks.next(), 'abc')
+        self.assertEqual(read, ['abc'])
+        self.assertEqual(chunks.next(), 'd\xc3\xa9f')
+
+    def testContent(self):
+        """Testing StreamingHttpResponse.content"""
+        response = StreamingHttpResponse(iter(['abc', 'def']))
+        self.assertEqual(response.content, 'abcdef')
+        self.assertEqual(response.content, 'abcdef')
+        self.assertEqual(list(response), ['abcdef'])
+
+        response.content = 'ghi'
+        self.assertEqual(list(response), ['ghi'])
+
+    def testClose(self):
+        """Testing StreamingHttpResponse.close closing database connections"""
+        closed = []
+        close_connection = http.close_connection
+        http.close_connection = lambda: closed.append(True)
+
+        try:
+            response = StreamingHttpResponse(iter(['abc']))
+            self.assertEqual(list(response), ['abc'])
+            self.assertEqual(closed, [])
+
+            response.close()
+            self.assertEqual(closed, [True])
+        finally:
+            http.close_connection = close_connection
+
+
+class MiddlewareTests(TestCase):
+    """Unit tests for the GZip and conditional GET middleware."""
+    def testGZipStreaming(self):
+        """Testing GZipMiddleware with a streaming response"""
+        read = []
+
+        def stream():
+            for chunk in ['abc', 'def' * 100]:
+                read.append(chunk)
+                yield chunk
+
+        request = self._make_request(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = StreamingHttpResponse(stream())
+        response = GZipMiddleware().process_response(request, response)
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue('Accept-Encoding' in response['Vary'])
+        self.assertEqual(read, [])
+
+        data = ''.join(response)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(data)).read(),
+                         'abc' + 'def' * 100)
+
+    def testGZipStreamingNotAccepted(self):
+        """Testing GZipMiddleware with a streaming response and no gzip"""
+        request = self._make_request()
+        response = StreamingHttpResponse(iter(['abc']))
+        response = GZipMiddleware().process_response(request, response)
+
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(''.join(response), 'abc')
+
+    def testGZipStreamingMSIE(self):
+        """Testing GZipMiddleware with a streaming binary response for MSIE"""
+        request = self._make_request(
+            HTTP_ACCEPT_ENCODING='gzip, deflate',
+            HTTP_USER_AGENT='Mozilla/4.0 (compatible; MSIE 6.0)')
+        response = StreamingHttpResponse(
+            iter(['abc']), content_type='application/octet-stream')
+        response = GZipMiddleware().process_response(request, response)
+
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(''.join(response), 'abc')
+
+    def testConditionalGetStreaming(self):
+        """Testing ConditionalGetMiddleware with a streaming response"""
+        last_modified = 'Sat, 01 Jan 2011 00:00:00 GMT'
+
+        response = StreamingHttpResponse(iter(['abc']))
+        response['Last-Modified'] = last_modified
+        response = ConditionalGetMiddleware().process_response(
+            self._make_request(), response)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('Date'))
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertEqual(''.join(response), 'abc')
+
+        response = StreamingHttpResponse(iter(['abc']))
+        response['Last-Modified'] = last_modified
+        response = ConditionalGetMiddleware().process_response(
+            self._make_request(HTTP_IF_MODIFIED_SINCE=last_modified),
+            response)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Content-Length'], '0')
+        self.assertEqual(''.join(response), '')
+
+    def testConditionalGetStreamingETag(self):
+        """Testing ConditionalGetMiddleware with a streaming response ETag"""
+        response = StreamingHttpResponse(iter(['abc']))
+        response['ETag'] = '"abc123"'
+        response = ConditionalGetMiddleware().process_response(
+            self._make_request(HTTP_IF_NONE_MATCH='"def456"'), response)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join(response), 'abc')
+
+        response = StreamingHttpResponse(iter(['abc']))
+        response['ETag'] = '"abc123"'
+        response = ConditionalGetMiddleware().process_response(
+            self._make_request(HTTP_IF_NONE_MATCH='"abc123"'), response)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(''.join(response), '')
+
+    def _make_request(self, **meta):
+        request = HttpRequest()
+        request.META.update(meta)
+
+        return request
+
+
+class LRUCacheTests(TestCase):
+    """Unit tests for LRUCache."""
+    def testGetAndSet(self):
+        """Testing LRUCache.get and LRUCache.set"""
+        cache = LRUCache()
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 1), 1)
+
+        cache.set('a', 1)
+        cache.set('b', None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 2), None)
+        self.assertTrue('b' in cache)
+        self.assertFalse('c' in cache)
+        self.assertEqual(len(cache), 2)
+
+        cache.set('a', 3)
+        self.assertEqual(cache.get('a'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def testOrder(self):
+        """Testing LRUCache keeping entries in order of use"""
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        self.assertEqual(cache.keys(), ['a', 'b', 'c'])
+
+        cache.get('a')
+        cache.set('b', 4)
+        self.assertEqual(cache.keys(), ['c', 'a', 'b'])
+
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a', 5), 5)
+        self.assertEqual(cache.keys(), ['c', 'b'])
+
+        self.assertEqual(cache.popitem(), ('c', 3))
+        self.assertEqual(cache.popitem(), ('b', 4))
+        self.assertRaises(KeyError, cache.popitem)
+
+    def testMaxEntries(self):
+        """Testing LRUCache removing entries past max_entries"""
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.keys(), ['a', 'c'])
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.keys(), [])
+
+    def testManyUses(self):
+        """Testing LRUCache with an entry used many times"""
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        for i in xrange(1000):
+            cache.get('a')
+
+        # Old uses of an entry are cleared out as they build up.
+        self.assertTrue(len(cache._order) < 100)
+        self.assertEqual(cache.keys(), ['b', 'a'])
@@ -10,8 +10,7 @@ from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.db.models import Q
-from django.http import HttpResponseRedirect, HttpResponse, \
-                        HttpResponseNotModified
+from django.http import HttpResponseRedirect, HttpResponseNotModified
 from django.template.defaultfilters import timesince
 from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext as _
@@ -40,9 +39,11 @@ from reviewboard.accounts.models import Profile
 from reviewboard.attachments.forms import UploadFileForm
 from reviewboard.attachments.models import FileAttachment
 from reviewboard.changedescs.models import ChangeDescription
-from reviewboard.diffviewer.diffutils import get_diff_files
+from reviewboard.diffviewer.diffutils import get_diff_files, \
+                                             unhighlight_regions
 from reviewboard.diffviewer.forms import EmptyDiffError
 from reviewboard.extensions.base import get_extension_manager
+from reviewboard.http import StreamingHttpResponse
 from reviewboard.reviews.errors import PermissionError
 from reviewboard.reviews.forms import UploadDiffForm, UploadScreenshotForm
 from reviewboard.reviews.models import BaseComment, Comment, DiffSet, \
@@ -883,6 +884,12 @@ class FileDiffResource(WebAPIResource):
                            'This is parsed from the diff, but is usually '
                            'not used for anything.',
         },
+        'stats': {
+            'type': dict,
+            'description': 'Statistics on the changes in the diff. This '
+                           'contains the number of ``lines_added`` and '
+                           '``lines_removed``, and the ``hunk_count``.',
+        },
     }
     item_child_resources = [filediff_comment_resource]
 
@@ -902,6 +909,9 @@ class FileDiffResource(WebAPIResource):
     def get_last_modified(self, request, obj, *args, **kwargs):
         return obj.diffset.timestamp
 
+    def serialize_stats_field(self, filediff):
+        return filediff.get_stats()
+
     def get_queryset(self, request, review_request_id, diff_revision,
                      *args, **kwargs):
         return self.model.objects.filter(
@@ -1092,13 +1102,18 @@ class FileDiffResource(WebAPIResource):
         except ObjectDoesNotExist:
             return DOES_NOT_EXIST
 
-        resp = HttpResponse(filediff.diff, mimetype='text/x-patch')
+        resp = StreamingHttpResponse(self._iter_patch(filediff),
+                                     mimetype='text/x-patch')
         filename = '%s.patch' % urllib_quote(filediff.source_file)
         resp['Content-Disposition'] = 'inline; filename=%s' % filename
         set_last_modified(resp, filediff.diffset.timestamp)
 
         return resp
 
+    def _iter_patch(self, filediff):
+        # The diff is only loaded once the response is being sent.
+        yield filediff.diff
+
     def _get_diff_data(self, request, mimetype, *args, **kwargs):
         try:
             review_request_resource.get_object(request, *args, **kwargs)
@@ -1121,7 +1136,8 @@ class FileDiffResource(WebAPIResource):
         payload = {
             'diff_data': {
                 'binary': f['binary'],
-                'chunks': f['chunks'],
+                'chunks': [self._serialize_chunk(chunk)
+                           for chunk in f['chunks']],
                 'num_changes': f['num_changes'],
                 'changed_chunk_indexes': f['changed_chunk_indexes'],
                 'new_file': f['newfile'],
@@ -1136,6 +1152,22 @@ class FileDiffResource(WebAPIResource):
 
         return resp
 
+    def _serialize_chunk(self, chunk):
+        # The markup in the lines of "replace" chunks has the changed
+        # regions highlighted, for the templates. The API returns the plain
+        # markup along with the regions.
+        if chunk['change'] != 'replace':
+            return chunk
+
+        chunk = chunk.copy()
+        chunk['lines'] = [
+            line[:2] + [unhighlight_regions(line[2]), line[3], line[4],
+                        unhighlight_regions(line[5])] + line[6:]
+            for line in chunk['lines']
+        ]
+
+        return chunk
+
     def get_href(self, obj, request, *args, **kwargs):
         """Returns the URL for this object"""
         base = review_request_resource.get_href(
@@ -1325,6 +1357,13 @@ class DiffResource(WebAPIResource):
             'type': 'reviewboard.webapi.resources.RepositoryResource',
             'description': 'The repository that the diff is applied against.',
         },
+        'stats': {
+            'type': dict,
+            'description': 'The totals of the statistics on each file in '
+                           'the diff. This contains the number of '
+                           '``lines_added`` and ``lines_removed``, and the '
+                           '``hunk_count``.',
+        },
     }
     item_child_resources = [filediff_resource]
 
@@ -1351,6 +1390,9 @@ class DiffResource(WebAPIResource):
         return self.model.objects.filter(
             history__review_request=review_request)
 
+    def serialize_stats_field(self, diffset):
+        return diffset.get_stats()
+
     def get_parent_object(self, diffset):
         history = diffset.history
 
@@ -1410,9 +1452,9 @@ class DiffResource(WebAPIResource):
             return DOES_NOT_EXIST
 
         tool = review_request.repository.get_scmtool()
-        data = tool.get_parser('').raw_diff(diffset)
-
-        resp = HttpResponse(data, mimetype='text/x-patch')
+        resp = StreamingHttpResponse(
+            tool.get_parser('').iter_raw_diff(diffset),
+            mimetype='text/x-patch')
 
         if diffset.name == 'diff':
             filename = 'bug%s.patch' % \
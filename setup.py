@@ -12,11 +12,14 @@ import sys
 from ez_setup import use_setuptools
 use_setuptools()
 
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
+from setuptools.command.build_ext import build_ext
 from setuptools.command.egg_info import egg_info
 from distutils.command.install_data import install_data
 from distutils.command.install import INSTALL_SCHEMES
 from distutils.core import Command
+from distutils.errors import CCompilerError, DistutilsExecError, \
+                             DistutilsPlatformError
 
 from reviewboard import get_package_version, is_release, VERSION
 
@@ -65,6 +68,37 @@ class BuildEggInfo(egg_info):
         egg_info.run(self)
 
 
+class BuildOptionalExt(build_ext):
+    # The C extensions all have pure Python fallbacks, so a missing or
+    # broken compiler shouldn't fail the install. Extension's optional
+    # argument does this too, but only on Python 2.7.
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError, e:
+            self.warn_not_built('the C extensions', e)
+
+    def build_extensions(self):
+        self.check_extensions_list(self.extensions)
+        built = []
+
+        for ext in self.extensions:
+            try:
+                self.build_extension(ext)
+                built.append(ext)
+            except (CCompilerError, DistutilsExecError,
+                    DistutilsPlatformError), e:
+                self.warn_not_built(ext.name, e)
+
+        # Anything that wasn't built is left out of the outputs, so that
+        # it isn't copied or installed.
+        self.extensions = built
+
+    def warn_not_built(self, name, e):
+        self.warn('Unable to build %s. The pure Python implementation '
+                  'will be used instead: %s' % (name, e))
+
+
 class BuildMedia(Command):
     user_options = []
 
@@ -83,6 +117,7 @@ class BuildMedia(Command):
 
 
 cmdclasses = {
+    'build_ext': BuildOptionalExt,
     'install_data': install_data,
     'egg_info': BuildEggInfo,
     'build_media': BuildMedia,
@@ -114,6 +149,12 @@ setup(name=PACKAGE_NAME,
       maintainer="Christian Hammond",
       maintainer_email="chipx86@chipx86.com",
       packages=find_packages(),
+      ext_modules=[
+          # This is optional. If it can't be built, MyersDiffer falls back
+          # on its pure Python implementation.
+          Extension('reviewboard.diffviewer._myersdiff',
+                    sources=['reviewboard/diffviewer/_myersdiff.c']),
+      ],
       entry_points = {
           'console_scripts': [
               'rb-site = reviewboard.cmdline.rbsite:main',